@@ -7,37 +7,49 @@
 
 
 import os
+import random
 import time
 import traceback
 import signal
+import threading
 
 __version__ = '2.1.0-beta'
 
 
-def run(config):
-    import lpbot.bot as bot
-    # import lpbot.web as web
-    import lpbot.logger
-    from lpbot.tools import stderr
+def _reconnect_delay(attempt, base, cap):
+    """Return how long to wait before reconnect number ``attempt``.
 
-    if config.core.delay is not None:
-        delay = config.core.delay
-    else:
-        delay = 20
+    The delay doubles with every failed attempt, up to ``cap`` seconds, and is
+    randomized between half and all of that, so that a netsplit doesn't bring
+    every bot on the network back at the same moment.
 
-    def signal_handler(sig, frame):
-        if sig == signal.SIGUSR1 or sig == signal.SIGTERM:
-            stderr('Got quit signal, shutting down.')
-            p.quit('Closing')
+    """
+    delay = min(cap, base * 2 ** min(attempt, 32))
+    return random.uniform(delay / 2, delay)
 
+
+def _run_network(p):
+    """Keep ``p`` connected, reconnecting whenever it's disconnected.
+
+    The first reconnect happens after ``core.delay`` seconds (20 by default),
+    and the wait doubles after each connection which doesn't stay up, to at
+    most ``core.reconnect_max`` seconds (600 by default). Returns once the bot
+    has quit.
+
+    """
+    from lpbot.tools import stderr
+
+    config = p.config
+    try:
+        delay = int(config.core.delay if config.core.delay is not None else 20)
+    except ValueError:
+        delay = None
+    reconnect_max = int(config.core.reconnect_max or 600)
+
+    attempt = 0
     while True:
         try:
-            p = bot.LpBot(config)
-            if hasattr(signal, 'SIGUSR1'):
-                signal.signal(signal.SIGUSR1, signal_handler)
-            if hasattr(signal, 'SIGTERM'):
-                signal.signal(signal.SIGTERM, signal_handler)
-            lpbot.logger.setup_logging(p)
+            started = time.time()
             p.run(config.core.host, int(config.core.port))
         except KeyboardInterrupt:
             break
@@ -55,11 +67,90 @@ def run(config):
             os.unlink(config.pid_file_path)
             os._exit(1)
 
-        if not isinstance(delay, int):
+        if delay is None:
             break
         if p.hasquit or config.exit_on_error:
             break
-        stderr('Warning: Disconnected. Reconnecting in %s seconds...' % delay)
-        time.sleep(delay)
+        if time.time() - started > reconnect_max:
+            # That connection was fine; whatever ended it, start over.
+            attempt = 0
+        wait = _reconnect_delay(attempt, delay, reconnect_max)
+        attempt += 1
+        stderr('Warning: Disconnected. Reconnecting in %.1f seconds...' % wait)
+        time.sleep(wait)
+        if p.hasquit:
+            break
+
+
+def run(config):
+    """Run lpbot until it quits.
+
+    The bots are kept for the whole run, so modules, ``memory`` and the job
+    scheduler survive a reconnect; only the connection's own state is reset.
+    With ``core.networks`` set, there is one bot per network, and with
+    ``core.shards`` set, that many per network. Each has its own connection
+    (on its own thread), and they all share the first one's modules,
+    database, memory and scheduler.
+
+    """
+    import lpbot.bot as bot
+    # import lpbot.web as web
+    import lpbot.logger
+    from lpbot.config import NetworkConfig
+    from lpbot.tools import stderr
+
+    def signal_handler(sig, frame):
+        if sig == signal.SIGUSR1 or sig == signal.SIGTERM:
+            stderr('Got quit signal, shutting down.')
+            for p in bots:
+                p.quit('Closing')
+
+    networks = [network.strip() for network in
+                config.core.get_list('networks') if network.strip()]
+    bots = []
+    for network in networks or [None]:
+        if network is None:
+            network_config = config
+        else:
+            network_config = NetworkConfig(config, network)
+        share_with = bots[0] if bots else None
+        lead = bot.LpBot(network_config, share_with)
+        bots.append(lead)
+        for shard in range(1, int(network_config.core.shards or 1)):
+            nick = '%s%d' % (network_config.core.nick, shard)
+            shard_config = NetworkConfig(config, network,
+                                         shard_of=network_config, nick=nick)
+            bots.append(bot.LpBot(shard_config, bots[0], shard_of=lead))
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, signal_handler)
+    if hasattr(signal, 'SIGTERM'):
+        signal.signal(signal.SIGTERM, signal_handler)
+    lpbot.logger.setup_logging(bots[0])
+
+    if len(bots) == 1:
+        _run_network(bots[0])
+    else:
+        threads = []
+        for p in bots:
+            t = threading.Thread(target=_run_network, args=(p,),
+                                 name='network:%s' % p.network)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        # Signals are only handled while the main thread is running Python
+        # code, so don't just block on join().
+        while any(t.is_alive() for t in threads):
+            try:
+                time.sleep(1.0)
+            except KeyboardInterrupt:
+                for p in bots:
+                    p.quit('KeyboardInterrupt')
+                    p.close_when_done()
+
+    bots[0]._shutdown()
+    # Make sure everything logged so far actually reaches raw.log.
+    for p in bots:
+        if p.raw_log is not None:
+            p.raw_log.stop()
     os.unlink(config.pid_file_path)
     os._exit(0)
@@ -6,20 +6,27 @@
 # Licensed under the Eiffel Forum License 2.
 
 
+import asyncio
 import time
 import imp
 import os
 import re
 import sys
 import threading
+import zlib
+from collections import OrderedDict
 from datetime import datetime
 
 from lpbot import tools
 import lpbot.irc as irc
 from lpbot.db import lpbotDB
+from lpbot.dispatch import DispatchIndex
+from lpbot.hostmask import mask_set, fold_nick
+from lpbot.membership import Memberships, PrivilegeLevelView
 from lpbot.tools import (stderr, PriorityQueue, Identifier, released, get_command_regexp,
                          iteritems, itervalues, deprecated_5)
-from lpbot.trigger import Trigger
+from lpbot.trigger import Trigger, TriggerLine, is_admin
+from lpbot.workers import WorkerPool
 import lpbot.module as module
 from lpbot.logger import get_logger
 
@@ -27,13 +34,38 @@ from lpbot.logger import get_logger
 LOGGER = get_logger(__name__)
 
 
+def shard_index(channel, count):
+    """Return which of ``count`` shards ``channel`` is assigned to.
+
+    This is rendezvous hashing: each shard gets a score for the channel, and
+    the highest one wins. Changing ``count`` only moves the channels of the
+    shards which were added or removed.
+
+    """
+    key = Identifier(channel).lower().encode('utf-8')
+    return max(range(count),
+               key=lambda index: zlib.crc32(b'%d:%s' % (index, key)))
+
+
 class LpBot(irc.Bot):
     NOLIMIT = module.NOLIMIT
+    privilege_levels = {'v': module.VOICE, 'h': module.HALFOP, 'o': module.OP,
+                        'a': module.ADMIN, 'q': module.OWNER}
+
+    routed_commands = frozenset(('PRIVMSG', 'NOTICE', 'JOIN', 'PART', 'MODE',
+                                 'KICK', 'TOPIC', 'NAMES', 'WHO'))
+    """Commands which are sent by the shard holding the channel they are for."""
+    broadcast_window = 10.0
+    """How long, in seconds, after one shard sees a NICK or QUIT, the same
+    line seen by another shard is taken for a copy of it."""
 
-    def __init__(self, config):
+    def __init__(self, config, share_with=None, shard_of=None):
         irc.Bot.__init__(self, config.core)
         self.config = config
         """The ``Config`` for the current lpbot instance."""
+        self.network = getattr(config, 'network', None)
+        """The name of the network this bot is connected to, when lpbot is
+        connected to several (see ``core.networks``), or ``None``."""
         self.doc = {}
         """
         A dictionary of command names to their docstring and example, if
@@ -53,10 +85,16 @@ class LpBot(irc.Bot):
         """
         self.acivity = {}
 
-        self.server_capabilities = set()
-        """A set containing the IRCv3 capabilities that the server supports.
+        self.server_capabilities = dict()
+        """A dict of the IRCv3 capabilities that the server supports.
 
-        For servers that do not support IRCv3, this will be an empty set."""
+        Each capability is mapped to the value the server advertised for it
+        (e.g. ``'max-bytes=4096,max-lines=24'`` for ``draft/multiline``), or
+        ``None`` if it had none. For servers that do not support IRCv3, this
+        will be empty."""
+        self._cap_ls = dict()
+        """The capabilities listed so far in a ``CAP LS`` reply which the
+        server has split over several lines."""
         self.enabled_capabilities = set()
         """A set containing the IRCv3 capabilities that the bot has enabled."""
         self._cap_reqs = dict()
@@ -66,25 +104,76 @@ class LpBot(irc.Bot):
         or ''), the name of the requesting module, and the function to call if
         the request is rejected."""
 
-        self.privileges = dict()
+        self.observers = {}
+        """A dictionary mapping events to the callables which observe them
+        (see ``module.observe``), in the order they're called."""
+
+        self.memberships = self._new_memberships()
+        """The ``Memberships`` store which tracks who is in this connection's
+        channels. Use ``channels_of`` to find the channels a nick shares with
+        lpbot on the whole network."""
+        self.privileges = self.memberships.privileges
         """A dictionary of channels to their users and privilege levels
 
         The value associated with each channel is a dictionary of Identifiers to a
         bitwise integer value, determined by combining the appropriate constants
-        from `module`."""
+        from `module`. It's a read-only view of ``memberships``."""
+        self._legacy_privilege_views()
 
-        self.db = lpbotDB(config)
-        """The bot's database."""
+        if share_with is None:
+            self.db = lpbotDB(config)
+            """The bot's database."""
 
-        self.memory = tools.lpbotMemory()
-        self.memory['owner_auth'] = False
-        """
-        A thread-safe dict for storage of runtime data to be shared between
-        modules. See `lpbotMemory <#tools.lpbot.lpbotMemory>`_
-        """
+            self.memory = tools.lpbotMemory()
+            self.memory['owner_auth'] = False
+            """
+            A thread-safe dict for storage of runtime data to be shared between
+            modules. See `lpbotMemory <#tools.lpbot.lpbotMemory>`_
+            """
 
-        self.scheduler = LpBot.JobScheduler(self)
-        self.scheduler.start()
+            self.workers = WorkerPool(
+                workers=int(config.core.workers or 16),
+                module_workers=int(config.core.module_workers or 8),
+                queue_size=int(config.core.worker_queue or 500),
+                overflow=config.core.worker_overflow or 'drop')
+            """The ``WorkerPool`` which runs threaded callables and interval
+            jobs."""
+
+            self.scheduler = LpBot.JobScheduler(self)
+            self.scheduler.start()
+
+            self.networks = {self.network: self}
+            """A dictionary mapping the names of all networks lpbot is
+            connected to to their bots. These share their modules, database,
+            memory, scheduler and workers."""
+        else:
+            # Another network's bot has loaded the modules already. Everything
+            # that isn't about the connection itself is shared with it.
+            self.db = share_with.db
+            self.memory = share_with.memory
+            self.scheduler = share_with.scheduler
+            self.workers = share_with.workers
+            self.doc = share_with.doc
+            self.stats = share_with.stats
+            self.times = share_with.times
+            self._cap_reqs = share_with._cap_reqs
+            self.networks = share_with.networks
+            if shard_of is None:
+                self.networks[self.network] = self
+
+        if shard_of is None:
+            self.shards = [self]
+            """All connections to this bot's network, in order, when its
+            channels are spread over several (see ``core.shards``)."""
+            self._broadcasts = OrderedDict()
+            self._broadcasts_lock = threading.Lock()
+        else:
+            self.shards = shard_of.shards
+            self.shards.append(self)
+            self._broadcasts = shard_of._broadcasts
+            self._broadcasts_lock = shard_of._broadcasts_lock
+        self.shard = len(self.shards) - 1
+        """The index of this connection in ``shards``."""
 
         # Set up block lists
         # Default to empty
@@ -101,7 +190,12 @@ class LpBot(irc.Bot):
             self.config.core.other_bots = False
             self.config.save()
 
-        self.setup()
+        if share_with is None:
+            self.setup()
+        else:
+            self.callables = share_with.callables
+            self.shutdown_methods = share_with.shutdown_methods
+            self.bind_commands()
 
     class JobScheduler(threading.Thread):
 
@@ -178,11 +272,13 @@ class LpBot(irc.Bot):
                 self._cleared = False
                 job = self._jobs.get()
                 with released(self._mutex):
-                    if job.func.thread:
-                        t = threading.Thread(
-                            target=self._call, args=(job.func,)
-                        )
-                        t.start()
+                    if asyncio.iscoroutinefunction(job.func):
+                        # Only starts it; it runs on the event loop
+                        self._call(job.func)
+                    elif job.func.thread:
+                        # A job still waiting for a worker isn't queued twice
+                        self.bot.workers.submit(job.func, self._call,
+                                                (job.func,), coalesce=True)
                     else:
                         self._call(job.func)
                     job.next()
@@ -195,9 +291,12 @@ class LpBot(irc.Bot):
             """Wrapper for collecting errors from modules."""
             # lpbot.bot.call is way too specialized to be used instead.
             try:
-                func(self.bot)
+                result = func(self.bot)
             except Exception:
                 self.bot.error()
+            else:
+                if asyncio.iscoroutine(result):
+                    self.bot.run_coroutine(result)
 
     class Job(object):
 
@@ -329,15 +428,24 @@ class LpBot(irc.Bot):
         else:
             stderr("Warning: Couldn't find any modules")
 
-        self.bind_commands()
+        for bot in self.connections():
+            bot.callables = self.callables
+            bot.shutdown_methods = self.shutdown_methods
+            bot.bind_commands()
+
+    def connections(self):
+        """Return every bot which shares this one's modules: each network's,
+        with all of its shards."""
+        return [shard for bot in list(itervalues(self.networks))
+                for shard in bot.shards]
 
     @staticmethod
     def is_callable(obj):
         """Return true if object is a lpbot callable.
 
         Object must be both be callable and have hashable. Furthermore, it must
-        have either "commands", "rule" or "interval" as attributes to mark it
-        as a lpbot callable.
+        have either "commands", "rule", "observe" or "interval" as attributes
+        to mark it as a lpbot callable.
 
         """
         if not callable(obj):
@@ -346,6 +454,7 @@ class LpBot(irc.Bot):
             return False
         if (hasattr(obj, 'commands') or
                 hasattr(obj, 'rule') or
+                hasattr(obj, 'observe') or
                 hasattr(obj, 'interval')):
             return True
         return False
@@ -396,11 +505,16 @@ class LpBot(irc.Bot):
                 if func in func_list:
                     func_list.remove(func)
 
+        connections = self.connections()
         for obj in itervalues(variables):
             if obj in self.callables:
                 self.callables.remove(obj)
-                for commands in itervalues(self.commands):
-                    remove_func(obj, commands)
+                # The callables are shared, but each bot binds them itself
+                for bot in connections:
+                    for commands in itervalues(bot.commands):
+                        remove_func(obj, commands)
+                    remove_func(obj, bot.observers)
+                    bot.dispatch_index.remove(obj)
             if obj in self.shutdown_methods:
                 try:
                     obj(self)
@@ -429,7 +543,12 @@ class LpBot(irc.Bot):
 
     def bind_commands(self):
         self.commands = {'high': {}, 'medium': {}, 'low': {}}
-        self.scheduler.clear_jobs()
+        observers = {}
+        index = DispatchIndex(self.config.core.prefix, self.nick)
+        # Interval jobs are only run once, however many networks share them.
+        schedule_jobs = self.scheduler.bot is self
+        if schedule_jobs:
+            self.scheduler.clear_jobs()
 
         def bind(priority, regexp, func):
             # Function name is no longer used for anything, as far as I know,
@@ -501,12 +620,17 @@ class LpBot(irc.Bot):
                     rules = [func.rule]
 
                 if isinstance(rules, list):
+                    nickname_commands = getattr(func, '_nickname_commands',
+                                                {})
                     for rule in rules:
                         pattern = self.sub(rule)
                         flags = re.IGNORECASE
                         if rule.find("\n") != -1:
                             flags |= re.VERBOSE
                         regexp = re.compile(pattern, flags)
+                        if rule in nickname_commands:
+                            index.name_nickname_commands(
+                                regexp, nickname_commands[rule])
                         bind(func.priority, regexp, func)
 
                 elif isinstance(func.rule, tuple):
@@ -544,25 +668,49 @@ class LpBot(irc.Bot):
                 for command in func.commands:
                     prefix = self.config.core.prefix
                     regexp = get_command_regexp(prefix, command)
+                    index.name_command(regexp, command)
                     bind(func.priority, regexp, func)
 
-            if hasattr(func, 'interval'):
+            if hasattr(func, 'observe'):
+                for event in func.observe:
+                    observers.setdefault(event, []).append(func)
+
+            if schedule_jobs and hasattr(func, 'interval'):
                 for interval in func.interval:
                     job = LpBot.Job(interval, func)
                     self.scheduler.add_job(job)
 
+        order = {'high': 0, 'medium': 1, 'low': 2}
+        for funcs in observers.values():
+            funcs.sort(key=lambda func: order.get(func.priority, 1))
+        self.observers = observers
+
+        for priority in index.priorities:
+            for regexp, funcs in self.commands[priority].items():
+                index.add(priority, regexp, funcs)
+        self.dispatch_index = index
+        """The ``DispatchIndex`` of ``commands`` which dispatch uses. Its
+        ``regexps_run`` and ``regexps_skipped`` count what the literal
+        prefilter has saved."""
+
     class LpbotWrapper(object):
+        """The bot, as callables see it: ``say`` and friends answer to where
+        ``trigger`` came from. ``trigger`` is a ``Trigger``, or the
+        ``TriggerLine`` all of a line's triggers share."""
+
+        __slots__ = ('_bot', '_trigger')
+
         def __init__(self, lpbot, trigger):
             # The custom __setattr__ for this class sets the attribute on the
             # original bot object. We don't want that for these, so we set them
-            # with the normal __setattr__.
-            object.__setattr__(self, '_bot', lpbot)
-            object.__setattr__(self, '_trigger', trigger)
+            # through their slots.
+            LpBot.LpbotWrapper._bot.__set__(self, lpbot)
+            LpBot.LpbotWrapper._trigger.__set__(self, trigger)
 
         def __dir__(self):
             classattrs = [attr for attr in self.__class__.__dict__
                           if not attr.startswith('__')]
-            return list(self.__dict__) + classattrs + dir(self._bot)
+            return classattrs + dir(self._bot)
 
         def say(self, string, max_messages=1):
             self._bot.msg(self._trigger.sender, string, max_messages)
@@ -596,14 +744,48 @@ class LpBot(irc.Bot):
             return setattr(self._bot, attr, value)
 
     def call(self, func, lpbot, trigger):
+        if self._rate_limited(func, trigger):
+            return
+
+        try:
+            exit_code = func(lpbot, trigger)
+        except Exception:
+            exit_code = None
+            self.error(trigger)
+
+        if asyncio.iscoroutine(exit_code):
+            # A coroutine function under a plain decorator; finish it on the
+            # event loop.
+            if not self.run_coroutine(
+                    self._await_call(func, trigger, exit_code)):
+                exit_code.close()
+            return
+        self._record_call(func, trigger, exit_code)
+
+    async def call_async(self, func, lpbot, trigger):
+        """Like ``call``, for coroutine functions. It runs on the event loop,
+        as a task of its own."""
+        if self._rate_limited(func, trigger):
+            return
+        await self._await_call(func, trigger, func(lpbot, trigger))
+
+    async def _await_call(self, func, trigger, coroutine):
+        try:
+            exit_code = await coroutine
+        except Exception:
+            exit_code = None
+            self.error(trigger)
+        self._record_call(func, trigger, exit_code)
+
+    def _rate_limited(self, func, trigger):
         nick = trigger.nick
         if nick not in self.times:
             self.times[nick] = dict()
 
-        if not trigger.admin and \
+        if func.rate > 0 and \
                 not func.unblockable and \
-                        func.rate > 0 and \
-                        func in self.times[nick]:
+                        func in self.times[nick] and \
+                        not trigger.admin:
             timediff = time.time() - self.times[nick][func]
             if timediff < func.rate:
                 self.times[nick][func] = time.time()
@@ -612,16 +794,12 @@ class LpBot(irc.Bot):
                     trigger.nick, func.__name__, trigger.sender, timediff,
                     func.rate
                 )
-                return
-
-        try:
-            exit_code = func(lpbot, trigger)
-        except Exception:
-            exit_code = None
-            self.error(trigger)
+                return True
+        return False
 
+    def _record_call(self, func, trigger, exit_code):
         if exit_code != module.NOLIMIT:
-            self.times[nick][func] = time.time()
+            self.times[trigger.nick][func] = time.time()
 
     def limit(self, trigger, func):
         if trigger.sender and not trigger.sender.is_nick():
@@ -631,9 +809,94 @@ class LpBot(irc.Bot):
                     return True
         return False
 
+    def shard_for(self, target):
+        """Return the connection which should send to ``target``.
+
+        A channel belongs to whichever shard is in it, or else the one it is
+        assigned to. Anything else (a nick, usually) is left to this bot.
+
+        """
+        if len(self.shards) == 1 or Identifier(target).is_nick():
+            return self
+        for shard in self.shards:
+            if target in shard.channels:
+                return shard
+        shard = self.shards[shard_index(target, len(self.shards))]
+        if not shard.connected:
+            return self
+        return shard
+
+    def channels_of(self, nick):
+        """Return the set of channels ``nick`` shares with lpbot on this
+        network, on any of its shards.
+
+        A ``NICK`` or ``QUIT`` is only passed to modules by the first shard
+        to see it, so this, rather than ``memberships.channels_of``, is what
+        tells them every channel it applies to.
+
+        """
+        if len(self.shards) == 1:
+            return self.memberships.channels_of(nick)
+        return frozenset().union(*[shard.memberships.channels_of(nick)
+                                   for shard in self.shards])
+
+    def is_assigned(self, channel):
+        """Whether this connection should join ``channel`` on its own."""
+        if len(self.shards) == 1:
+            return True
+        return shard_index(channel, len(self.shards)) == self.shard
+
+    def write(self, args, text=None):
+        # A list of targets (from join_channels, say) stays where it is
+        if (len(self.shards) > 1 and len(args) > 1 and
+                args[0] in self.routed_commands and ',' not in args[1]):
+            shard = self.shard_for(args[1])
+            if shard is not self:
+                return shard.write(args, text)
+        irc.Bot.write(self, args, text)
+
+    def msg(self, recipient, text, max_messages=1):
+        shard = self.shard_for(recipient)
+        if shard is not self:
+            return shard.msg(recipient, text, max_messages)
+        irc.Bot.msg(self, recipient, text, max_messages)
+
+    def _is_broadcast_duplicate(self, pretrigger):
+        """Whether another shard has already seen this NICK or QUIT.
+
+        ``_broadcasts`` maps each such line seen in the last
+        ``broadcast_window`` seconds to when it was first seen and the shards
+        which have seen it, oldest first. A shard seeing the same line twice
+        means it really happened twice, so that starts afresh.
+
+        """
+        now = time.monotonic()
+        # Tags such as the server time may differ between connections
+        key = (pretrigger.hostmask, pretrigger.event, tuple(pretrigger.args))
+        with self._broadcasts_lock:
+            broadcasts = self._broadcasts
+            while broadcasts:
+                seen, _ = next(iter(broadcasts.values()))
+                if now - seen <= self.broadcast_window:
+                    break
+                broadcasts.popitem(last=False)
+            entry = broadcasts.get(key)
+            if entry is not None and self.shard not in entry[1]:
+                entry[1].add(self.shard)
+                return True
+            broadcasts[key] = (now, set([self.shard]))
+            broadcasts.move_to_end(key)
+            return False
+
     def dispatch(self, pretrigger):
-        args = pretrigger.args
-        event, args, text = args[0], args[1:], args[-1]
+        event = pretrigger.event
+        text = pretrigger.args[-1] if pretrigger.args else ''
+
+        # Every shard which shares a channel with someone hears about their
+        # NICK or QUIT. Modules should only hear about it once; coretasks
+        # has to keep track of it on every connection.
+        duplicate = (event in ('NICK', 'QUIT') and len(self.shards) > 1 and
+                     self._is_broadcast_duplicate(pretrigger))
 
         if self.config.core.nick_blocks or self.config.core.host_blocks:
             nick_blocked = self._nick_blocked(pretrigger.nick)
@@ -641,38 +904,66 @@ class LpBot(irc.Bot):
         else:
             nick_blocked = host_blocked = None
 
-        list_of_blocked_functions = []
-        for priority in ('high', 'medium', 'low'):
-            items = self.commands[priority].items()
+        # Quick observers see the line before any rule; the rest get it once
+        # the rules (coretasks' among them) have been through it.
+        observers = ()
+        if event in self.observers:
+            observers = self._notify_observers(
+                pretrigger, nick_blocked or host_blocked, duplicate)
 
-            for regexp, funcs in items:
+        # Only the rules which could match this line are tried
+        index = self.dispatch_index
+        line = index.scan(text)
+
+        # Everything but the match is the same for each trigger of the line
+        context = wrapper = None
+        list_of_blocked_functions = []
+        for priority in index.priorities:
+            for _, regexp, funcs in index.candidates(priority, event, line):
                 match = regexp.match(text)
                 if not match:
                     continue
-                trigger = Trigger(self.config, pretrigger, match)
-                wrapper = self.LpbotWrapper(self, trigger)
+                if context is None:
+                    context = TriggerLine(self.config, pretrigger,
+                                          self.network)
+                    wrapper = self.LpbotWrapper(self, context)
+                    order_key = None
+                    if self.config.core.ordered_channels and context.sender:
+                        # One queue per channel, or per nick for private
+                        # messages, on each network
+                        order_key = (self.network, context.sender)
+                trigger = Trigger(self.config, pretrigger, match,
+                                  line=context)
 
                 for func in funcs:
-                    if (not trigger.admin and
+                    if ((nick_blocked or host_blocked) and
                             not func.unblockable and
-                            (nick_blocked or host_blocked)):
+                            not context.admin):
                         function_name = "%s.%s" % (
                             func.__module__, func.__name__
                         )
                         list_of_blocked_functions.append(function_name)
                         continue
 
-                    if event not in func.event:
+                    if duplicate and func.__module__ != 'coretasks':
                         continue
                     if self.limit(trigger, func):
                         continue
-                    if func.thread:
-                        targs = (func, wrapper, trigger)
-                        t = threading.Thread(target=self.call, args=targs)
-                        t.start()
+                    if asyncio.iscoroutinefunction(func):
+                        self.run_coroutine(
+                            self.call_async(func, wrapper, trigger))
+                    elif func.thread:
+                        # Never drop coretasks' calls, even when overloaded
+                        self.workers.submit(
+                            func, self.call, (func, wrapper, trigger),
+                            key=order_key,
+                            force=func.__module__ == 'coretasks')
                     else:
                         self.call(func, wrapper, trigger)
 
+        if observers:
+            self._queue_observers(observers, pretrigger)
+
         if list_of_blocked_functions:
             if nick_blocked and host_blocked:
                 block_type = 'both'
@@ -683,31 +974,56 @@ class LpBot(irc.Bot):
             LOGGER.info(
                 "[%s]%s prevented from using %s.",
                 block_type,
-                trigger.nick,
+                pretrigger.nick,
                 ', '.join(list_of_blocked_functions)
             )
 
-    def _host_blocked(self, host):
-        bad_masks = self.config.core.get_list('host_blocks')
-        for bad_mask in bad_masks:
-            bad_mask = bad_mask.strip()
-            if not bad_mask:
+    def _notify_observers(self, pretrigger, blocked, duplicate):
+        """Call the observers of ``pretrigger``'s event which don't run on a
+        thread, and return those which do."""
+        queued = []
+        for func in self.observers[pretrigger.event]:
+            if (blocked and not func.unblockable and
+                    not is_admin(self.config, pretrigger.nick,
+                                 pretrigger.host)):
                 continue
-            if (re.match(bad_mask + '$', host, re.IGNORECASE) or
-                        bad_mask == host):
-                return True
-        return False
+            if duplicate and func.__module__ != 'coretasks':
+                continue
+            if self.limit(pretrigger, func):
+                continue
+            if func.thread:
+                queued.append(func)
+            else:
+                self._observe(func, pretrigger)
+        return queued
+
+    def _queue_observers(self, funcs, pretrigger):
+        """Have the workers call ``funcs`` with ``pretrigger``, after every
+        observer queued before them on this connection."""
+        # One key per connection keeps them in order, and they wait in (and
+        # overflow from) the workers' queue like any threaded callable.
+        key = ('observers', self.network, self.shard)
+        for func in funcs:
+            self.workers.submit(func, self._observe, (func, pretrigger),
+                                key=key)
+
+    def _observe(self, func, pretrigger):
+        try:
+            result = func(self, pretrigger)
+        except Exception:
+            # Not sent to the channel; nobody there asked for anything
+            self.error()
+        else:
+            if asyncio.iscoroutine(result):
+                self.run_coroutine(result)
+
+    def _host_blocked(self, host):
+        # A mask may also be the very host, however it reads as a regex
+        return host in mask_set(self.config.core, 'host_blocks', fold=str)
 
     def _nick_blocked(self, nick):
-        bad_nicks = self.config.core.get_list('nick_blocks')
-        for bad_nick in bad_nicks:
-            bad_nick = bad_nick.strip()
-            if not bad_nick:
-                continue
-            if (re.match(bad_nick + '$', nick, re.IGNORECASE) or
-                        Identifier(bad_nick) == nick):
-                return True
-        return False
+        return nick in mask_set(self.config.core, 'nick_blocks',
+                                fold=fold_nick)
 
     @deprecated_5
     def debug(self, tag, text, level):
@@ -751,6 +1067,54 @@ class LpBot(irc.Bot):
         else:
             return False
 
+    def reset_connection_state(self):
+        irc.Bot.reset_connection_state(self)
+        self.server_capabilities = dict()
+        self._cap_ls = dict()
+        self.enabled_capabilities = set()
+        self.memberships = self._new_memberships()
+        self.privileges = self.memberships.privileges
+        self._legacy_privilege_views()
+
+    def refold_identifiers(self):
+        """Re-key what this bot keeps by nick or channel, once
+        ``tools.set_casemapping`` has changed how Identifiers fold."""
+        self.nick = Identifier(str(self.nick))
+        self.memberships.refold()
+        tools.refold(self.stack)
+        # Shared with the other bots, which refold them too; once it's done,
+        # doing it again changes nothing.
+        tools.refold(self.times)
+        tools.refold(self.memory)
+        for value in list(self.memory.values()):
+            if isinstance(value, dict):
+                tools.refold(value)
+
+    def _new_memberships(self):
+        return Memberships(
+            # Read at call time, since the nick can change while connected
+            own_nick=lambda: self.nick,
+            untracked=self.config.core.get_list('untracked_channels'))
+
+    def _legacy_privilege_views(self):
+        # These used to be maintained separately, as copies of what's in
+        # privileges. They're kept as views for modules which still use them.
+        self.ops = PrivilegeLevelView(self.memberships, module.OP)
+        self.halfplus = PrivilegeLevelView(self.memberships, module.HALFOP)
+        self.voices = PrivilegeLevelView(self.memberships, module.VOICE)
+
+    # The old op list helpers have nothing to maintain any more.
+    def add_op(self, channel, name):
+        pass
+
+    add_halfop = add_voice = del_op = del_halfop = del_voice = add_op
+
+    def flush_ops(self, channel):
+        pass
+
+    def init_ops_list(self, channel):
+        pass
+
     def _shutdown(self):
         stderr(
             'Calling shutdown for %d modules.' % (len(self.shutdown_methods),)
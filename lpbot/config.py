@@ -30,6 +30,17 @@ modules which have a configuration function.
 The configuration function, if used, must be declared with the signature
 ``configure(config)``. To add options, use ``interactive_add``, ``add_list``
 and ``add_option``.
+
+One lpbot process can connect to several networks. List their names in the
+``networks`` option of the ``core`` section, and give each one a section named
+``network:<name>``, with whichever core options (``host``, ``nick``,
+``channels`` and so on) differ for that network. Each network's bot gets a
+``NetworkConfig``, whose ``core`` is that section on top of ``core``.
+
+A network's channels can also be spread over several connections, each with
+its own nick and its own flood control, by setting ``shards`` to the number
+of connections. The first one uses ``nick``; the others add their number to
+it (``nick1``, ``nick2``, ...).
 """
 # Copyright 2012, Edward Powell, embolalia.net
 # Copyright © 2012, Elad Alfassa <elad@fedoraproject.org>
@@ -163,6 +174,8 @@ class Config(object):
         def __init__(self, name, items, parent):
             object.__setattr__(self, '_name', name)
             object.__setattr__(self, '_parent', parent)
+            # Compiled mask lists, see lpbot.hostmask.mask_set
+            object.__setattr__(self, '_mask_sets', {})
             for item in items:
                 value = item[1].strip()
                 if not value.lower() == 'none':
@@ -175,6 +188,7 @@ class Config(object):
 
         def __setattr__(self, name, value):
             object.__setattr__(self, name, value)
+            self._mask_sets.pop(name, None)
             if type(value) is list:
                 value = ','.join(value)
             self._parent.parser.set(self._name, name, value)
@@ -446,6 +460,106 @@ def check_dir(create=True):
             sys.exit(1)
 
 
+class ShardSection(object):
+    """The ``core`` section of one of a sharded network's extra connections.
+
+    The options in ``overrides`` (its nick) are its own. Everything else is
+    looked up in, and changed in, ``section``, the network's own ``core``, so
+    that changes made through any of the connections (``.ignore``, say) apply
+    to all of them.
+
+    """
+
+    def __init__(self, section, overrides):
+        object.__setattr__(self, '_section', section)
+        object.__setattr__(self, '_overrides', overrides)
+
+    def __getattr__(self, name):
+        if name in self._overrides:
+            return self._overrides[name]
+        return getattr(self._section, name)
+
+    def __setattr__(self, name, value):
+        if name in self._overrides:
+            self._overrides[name] = value
+        else:
+            setattr(self._section, name, value)
+
+    def get_list(self, name):
+        if name in self._overrides:
+            return Config.ConfigSection.get_list(self, name)
+        return self._section.get_list(name)
+
+
+def _has_option(section, name):
+    if isinstance(section, ShardSection):
+        return (name in section._overrides or
+                _has_option(section._section, name))
+    return name in vars(section)
+
+
+class NetworkConfig(object):
+    """The configuration for one connection of a multi-network lpbot.
+
+    Everything is looked up in, and written to, the ``Config`` this was made
+    from, except for the ``core`` section, which holds the options from the
+    network's own ``network:<name>`` section in place of those in ``core``.
+    With ``network`` as ``None``, ``core`` is just the main ``core`` section.
+    Any ``overrides`` given take precedence over both; they're used for the
+    nicks of the extra connections of a sharded network. Those connections
+    pass the config of the network's first one as ``shard_of``, and share its
+    ``core`` (see ``ShardSection``).
+
+    """
+
+    def __init__(self, config, network=None, shard_of=None, **overrides):
+        if shard_of is not None:
+            object.__setattr__(self, '_config', config)
+            object.__setattr__(self, 'network', network)
+            object.__setattr__(self, 'core', ShardSection(
+                shard_of.core, dict((name, unicode(value)) for name, value
+                                    in iteritems(overrides))))
+            return
+        if network is None:
+            section = 'core'
+        else:
+            section = 'network:%s' % network
+            if not config.has_section(section):
+                raise ConfigurationError(
+                    'Network %s listed, but no [%s] section' %
+                    (network, section)
+                )
+        items = dict(config.parser.items('core'))
+        items.update(config.parser.items(section))
+        items.update(overrides)
+        # Options set at runtime may not be strings, but ConfigSection wants
+        # them as if they were read from the file.
+        items = dict((name, unicode(value)) for name, value in iteritems(items))
+        object.__setattr__(self, '_config', config)
+        object.__setattr__(self, 'network', network)
+        """The name of the network, as given in ``core.networks``."""
+        object.__setattr__(self, 'core', Config.ConfigSection(
+            section, iteritems(items), config
+        ))
+
+    def __getattr__(self, name):
+        # Core options are attributes of the config as well, for backwards
+        # compatibility, and they have to come from the network's section.
+        if _has_option(self.core, name):
+            return getattr(self.core, name)
+        return getattr(self._config, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._config, name, value)
+
+    def has_option(self, section, name):
+        """Check if option ``name`` exists under section ``section``; for
+        ``core``, in this network's own ``core``."""
+        if section == 'core':
+            return _has_option(self.core, name)
+        return self._config.has_option(section, name)
+
+
 # noinspection PyUnreachableCode
 def create_config(configpath):
     check_dir()
@@ -8,12 +8,11 @@
 
 from __future__ import unicode_literals
 
-import re
 import time
 import base64
 
 import lpbot
-from lpbot.tools import Identifier, iteritems
+from lpbot.tools import Identifier, iteritems, set_casemapping
 from lpbot.logger import get_logger
 from lpbot.module import event, rule, thread, unblockable, event, priority
 
@@ -71,17 +70,19 @@ def startup(bot, trigger):
 
     bot.memory['retry_join'] = dict()
 
+    # With core.shards, each connection only joins its own share of them.
+    channels = [channel for channel in bot.config.core.get_list('channels')
+                if bot.is_assigned(channel)]
     if bot.config.has_option('core', 'throttle_join'):
         throttle_rate = int(bot.config.core.throttle_join)
         channels_joined = 0
-        for channel in bot.config.core.get_list('channels'):
+        for channel in channels:
             channels_joined += 1
             if not channels_joined % throttle_rate:
                 time.sleep(1)
             bot.join(channel)
     else:
-        for channel in bot.config.core.get_list('channels'):
-            bot.join(channel)
+        bot.join_channels(channels)
 
 
 @event('477')
@@ -119,43 +120,22 @@ def retry_join(bot, trigger):
 @unblockable
 def handle_names(bot, trigger):
     """Handle NAMES response, happens when joining to channels."""
-    names = trigger.split()
-
-    channels = re.search('(#\S*)', trigger.raw)
-    if not channels:
+    # <nick> <symbol> <channel> :<names>
+    if len(trigger.args) < 4:
         return
-    channel = Identifier(channels.group(1))
-    if channel not in bot.privileges:
-        bot.privileges[channel] = dict()
-    bot.init_ops_list(channel)
-
-    # This could probably be made flexible in the future, but I don't think
-    # it'd be worth it.
-    mapping = {'+': lpbot.module.VOICE,
-               '%': lpbot.module.HALFOP,
-               '@': lpbot.module.OP,
-               '&': lpbot.module.ADMIN,
-               '~': lpbot.module.OWNER}
-
-    for name in names:
+    channel = Identifier(trigger.args[2])
+    bot.memberships.add_channel(channel)
+
+    # The privilege prefixes are the server's PREFIX; with multi-prefix,
+    # a name can have several of them.
+    symbols = bot.isupport.symbol_privileges
+    for name in trigger.split():
         priv = 0
-        for prefix, value in iteritems(mapping):
-            if prefix in name:
-                priv = priv | value
-        nick = Identifier(name.lstrip(''.join(mapping.keys())))
-        bot.privileges[channel][nick] = priv
-
-        # Old op list maintenance is down here, and should be removed at some
-        # point
-        if '@' in name or '~' in name or '&' in name:
-            bot.add_op(channel, name.lstrip('@&%+~'))
-            bot.add_halfop(channel, name.lstrip('@&%+~'))
-            bot.add_voice(channel, name.lstrip('@&%+~'))
-        elif '%' in name:
-            bot.add_halfop(channel, name.lstrip('@&%+~'))
-            bot.add_voice(channel, name.lstrip('@&%+~'))
-        elif '+' in name:
-            bot.add_voice(channel, name.lstrip('@&%+~'))
+        start = 0
+        while start < len(name) and name[start] in symbols:
+            priv |= symbols[name[start]]
+            start += 1
+        bot.memberships.add(channel, Identifier(name[start:]), priv)
 
 
 @rule('(.*)')
@@ -171,59 +151,34 @@ def track_modes(bot, trigger):
 
     # If the first character of where the mode is being set isn't a #
     # then it's a user mode, not a channel mode, so we'll ignore it.
-    if channel.is_nick():
+    if channel.is_nick() or channel not in bot.privileges:
         return
 
-    def handle_old_modes(nick, mode):
-        #Old mode maintenance. Drop this crap in 5.0.
-        if mode[1] == 'o' or mode[1] == 'q' or mode[1] == 'a':
-            if mode[0] == '+':
-                bot.add_op(channel, nick)
-            else:
-                bot.del_op(channel, nick)
-        elif mode[1] == 'h':  # Halfop
-            if mode[0] == '+':
-                bot.add_halfop(channel, nick)
-            else:
-                bot.del_halfop(channel, nick)
-        elif mode[1] == 'v':
-            if mode[0] == '+':
-                bot.add_voice(channel, nick)
-            else:
-                bot.del_voice(channel, nick)
-
-    mapping = {'v': lpbot.module.VOICE,
-               'h': lpbot.module.HALFOP,
-               'o': lpbot.module.OP,
-               'a': lpbot.module.ADMIN,
-               'q': lpbot.module.OWNER}
-
-    modes = []
-    for arg in line:
-        if len(arg) == 0:
+    # Which modes take a parameter, and which are privileges, is the
+    # server's CHANMODES and PREFIX.
+    privileges = bot.isupport.mode_privileges
+    takes_parameter = bot.isupport.parameter_modes
+    parameters = iter(line[1:])
+    sign = '+'
+    for char in line[0] if line else '':
+        if char in '+-':
+            sign = char
+            continue
+        if char not in takes_parameter[sign]:
+            continue
+        nick = next(parameters, None)
+        value = privileges.get(char)
+        if not value or nick is None:
+            continue
+        nick = Identifier(nick)
+        priv = bot.memberships.get(channel, nick)
+        if priv is None:
             continue
-        if arg[0] in '+-':
-            # There was a comment claiming IRC allows e.g. MODE +aB-c foo, but
-            # I don't see it in any RFCs. Leaving in the extra parsing for now.
-            sign = ''
-            modes = []
-            for char in arg:
-                if char == '+' or char == '-':
-                    sign = char
-                else:
-                    modes.append(sign + char)
+        if sign == '+':
+            priv = priv | value
         else:
-            arg = Identifier(arg)
-            for mode in modes:
-                priv = bot.privileges[channel].get(arg, 0)
-                value = mapping.get(mode[1])
-                if value is not None:
-                    if mode[0] == '+':
-                        priv = priv | value
-                    else:
-                        priv = priv & ~value
-                    bot.privileges[channel][arg] = priv
-                handle_old_modes(arg, mode)
+            priv = priv & ~value
+        bot.memberships.add(channel, nick, priv)
 
 
 @rule('.*')
@@ -256,25 +211,7 @@ def track_nicks(bot, trigger):
         bot.msg(bot.config.core.owner, privmsg)
         return
 
-    for channel in bot.privileges:
-        channel = Identifier(channel)
-        if old in bot.privileges[channel]:
-            value = bot.privileges[channel].pop(old)
-            bot.privileges[channel][new] = value
-
-    # Old privilege maintenance
-    for channel in bot.halfplus:
-        if old in bot.halfplus[channel]:
-            bot.del_halfop(channel, old)
-            bot.add_halfop(channel, new)
-    for channel in bot.ops:
-        if old in bot.ops[channel]:
-            bot.del_op(channel, old)
-            bot.add_op(channel, new)
-    for channel in bot.voices:
-        if old in bot.voices[channel]:
-            bot.del_voice(channel, old)
-            bot.add_voice(channel, new)
+    bot.memberships.rename(old, new)
 
 
 @rule('(.*)')
@@ -285,14 +222,11 @@ def track_nicks(bot, trigger):
 def track_part(bot, trigger):
     if trigger.nick == bot.nick:
         bot.channels.remove(trigger.sender)
-        del bot.privileges[trigger.sender]
+        bot.memberships.remove_channel(trigger.sender)
     else:
         if trigger.nick == bot.config.core.owner:
             bot.memory['owner_auth'] = False
-        try:
-            del bot.privileges[trigger.sender][trigger.nick]
-        except KeyError:
-            pass
+        bot.memberships.remove(trigger.sender, trigger.nick)
 
 
 @rule('.*')
@@ -304,17 +238,11 @@ def track_kick(bot, trigger):
     nick = Identifier(trigger.args[1])
     if nick == bot.nick:
         bot.channels.remove(trigger.sender)
-        del bot.privileges[trigger.sender]
+        bot.memberships.remove_channel(trigger.sender)
     else:
-        # Temporary fix to stop KeyErrors from being sent to channel
-        # The privileges dict may not have all nicks stored at all times
-        # causing KeyErrors
         if trigger.nick == bot.config.core.owner:
             bot.memory['owner_auth'] = False
-        try:
-            del bot.privileges[trigger.sender][nick]
-        except KeyError:
-            pass
+        bot.memberships.remove(trigger.sender, nick)
 
 
 @rule('.*')
@@ -323,10 +251,13 @@ def track_kick(bot, trigger):
 @thread(False)
 @unblockable
 def track_join(bot, trigger):
+    if trigger.nick == bot.nick:
+        # Our own JOIN is the first reliable sight of our full hostmask
+        bot.hostmask = trigger.hostmask
     if trigger.nick == bot.nick and trigger.sender not in bot.channels:
         bot.channels.append(trigger.sender)
-        bot.privileges[trigger.sender] = dict()
-    bot.privileges[trigger.sender][trigger.nick] = 0
+        bot.memberships.remove_channel(trigger.sender)
+    bot.memberships.add(trigger.sender, trigger.nick, 0)
 
 
 @rule('.*')
@@ -335,13 +266,73 @@ def track_join(bot, trigger):
 @thread(False)
 @unblockable
 def track_quit(bot, trigger):
-    for chanprivs in bot.privileges.values():
-        if trigger.nick in chanprivs:
-            del chanprivs[trigger.nick]
+    bot.memberships.quit(trigger.nick)
     if trigger.nick == bot.config.core.owner:
             bot.memory['owner_auth'] = False
 
 
+@rule('.*')
+@event('BATCH')
+@priority('high')
+@thread(False)
+@unblockable
+def track_batch(bot, trigger):
+    """Apply the membership changes of a whole netsplit or netjoin at once."""
+    batch = trigger.batch
+    if batch is None:
+        return
+    if batch.type == 'netsplit':
+        for message in batch.messages:
+            if message.event != 'QUIT':
+                continue
+            for channel in bot.memberships.quit(message.nick):
+                batch.changes.setdefault(channel, []).append(message)
+            if message.nick == bot.config.core.owner:
+                bot.memory['owner_auth'] = False
+    elif batch.type == 'netjoin':
+        for message in batch.messages:
+            if message.event != 'JOIN' or message.sender not in bot.privileges:
+                continue
+            bot.memberships.add(message.sender, message.nick, 0)
+            batch.changes.setdefault(message.sender, []).append(message)
+
+
+@rule('.*')
+@event('005')
+@priority('high')
+@thread(False)
+@unblockable
+def handle_isupport(bot, trigger):
+    """Record the features the server advertises in RPL_ISUPPORT."""
+    # The first argument is our nick, the last is "are supported by..."
+    for token in trigger.args[1:-1]:
+        bot.isupport.update_token(token)
+        if not token.startswith('CASEMAPPING='):
+            continue
+        casemapping = Identifier.casemapping
+        if set_casemapping(bot.isupport.casemapping, bot.network):
+            if Identifier.casemapping != casemapping:
+                # Everything folded before we knew has to be folded again
+                for connection in bot.connections():
+                    connection.refold_identifiers()
+        else:
+            LOGGER.warning('Not using casemapping %s, which is unknown or '
+                           'differs from that of another network.',
+                           bot.isupport.casemapping)
+
+
+@rule('.*')
+@event('396')
+@priority('high')
+@thread(False)
+@unblockable
+def track_displayed_host(bot, trigger):
+    """Keep our hostmask right when the server cloaks or changes our host."""
+    if bot.hostmask and len(trigger.args) > 2:
+        bot.hostmask = '%s@%s' % (bot.hostmask.split('@', 1)[0],
+                                  trigger.args[1])
+
+
 @rule('.*')
 @event('CAP')
 @thread(False)
@@ -362,10 +353,15 @@ def recieve_cap_list(bot, trigger):
                 if req[0] and req[2]:
                     # Call it.
                     req[2](bot, req[0] + trigger)
-    # Server is acknowledinge SASL for us.
-    elif (trigger.args[0] == bot.nick and trigger.args[1] == 'ACK' and
-                  'sasl' in trigger.args[2]):
-        recieve_cap_ack_sasl(bot)
+    elif trigger.args[1] == 'ACK':
+        for cap in trigger.args[2].split():
+            if cap.startswith('-'):
+                bot.enabled_capabilities.discard(cap[1:])
+            else:
+                bot.enabled_capabilities.add(cap.lstrip('~='))
+        # Server is acknowledinge SASL for us.
+        if trigger.args[0] == bot.nick and 'sasl' in trigger.args[2].split():
+            recieve_cap_ack_sasl(bot)
 
 
 def recieve_cap_ls_reply(bot, trigger):
@@ -374,7 +370,15 @@ def recieve_cap_ls_reply(bot, trigger):
         # We're too late to do SASL, and we don't want to send CAP END before
         # the module has done what it needs to, so just return
         return
-    bot.server_capabilities = set(trigger.split(' '))
+    for cap in trigger.split():
+        name, _, value = cap.partition('=')
+        bot._cap_ls[name] = value or None
+    if len(trigger.args) > 3 and trigger.args[2] == '*':
+        # CAP LS 302 splits a long list over several lines; all but the last
+        # have a * before the list.
+        return
+    bot.server_capabilities.update(bot._cap_ls)
+    bot._cap_ls = dict()
 
     # If some other module requests it, we don't need to add another request.
     # If some other module prohibits it, we shouldn't request it.
@@ -382,6 +386,14 @@ def recieve_cap_ls_reply(bot, trigger):
         # Whether or not the server supports multi-prefix doesn't change how we
         # parse it, so we don't need to worry if it fails.
         bot._cap_reqs['multi-prefix'] = (['', 'coretasks', None],)
+    # Netsplits and netjoins are handled a batch at a time, and bot.msg sends
+    # long messages as one batch when it can.
+    wanted = ['batch']
+    if 'draft/multiline' in bot.server_capabilities:
+        wanted.append('draft/multiline')
+    for cap in wanted:
+        if cap in bot.server_capabilities and cap not in bot._cap_reqs:
+            bot._cap_reqs[cap] = (['', 'coretasks', None],)
 
     for cap, reqs in iteritems(bot._cap_reqs):
         # At this point, we know mandatory and prohibited don't co-exist, but
@@ -404,18 +416,28 @@ def recieve_cap_ls_reply(bot, trigger):
 
     # If we want to do SASL, we have to wait before we can send CAP END. So if
     # we are, wait on 903 (SASL successful) to send it.
-    if bot.config.core.sasl_password:
+    if _wants_sasl(bot):
         bot.write(('CAP', 'REQ', 'sasl'))
     else:
         bot.write(('CAP', 'END'))
 
 
+def _wants_sasl(bot):
+    # EXTERNAL authenticates with the TLS client certificate, so it doesn't
+    # need a password.
+    mech = (bot.config.core.sasl_mechanism or 'PLAIN').upper()
+    if mech == 'EXTERNAL':
+        return bool(bot.config.core.use_ssl and
+                    bot.config.core.client_cert_file)
+    return bool(bot.config.core.sasl_password)
+
+
 def recieve_cap_ack_sasl(bot):
     # Presumably we're only here if we said we actually *want* sasl, but still
     # check anyway.
-    if not bot.config.core.sasl_password:
+    if not _wants_sasl(bot):
         return
-    mech = bot.config.core.sasl_mechanism or 'PLAIN'
+    mech = (bot.config.core.sasl_mechanism or 'PLAIN').upper()
     bot.write(('AUTHENTICATE', mech))
 
 
@@ -425,6 +447,10 @@ def auth_proceed(bot, trigger):
     if trigger.args[0] != '+':
         # How did we get here? I am not good with computer.
         return
+    if (bot.config.core.sasl_mechanism or 'PLAIN').upper() == 'EXTERNAL':
+        # The server already knows who we are from the certificate.
+        bot.write(('AUTHENTICATE', '+'))
+        return
     # Is this right?
     if bot.config.core.sasl_username:
         sasl_username = bot.config.core.sasl_username
@@ -433,10 +459,20 @@ def auth_proceed(bot, trigger):
     sasl_token = '\0'.join((sasl_username, sasl_username,
                             bot.config.core.sasl_password))
     # Spec says we do a base 64 encode on the SASL stuff
-    bot.write(('AUTHENTICATE', base64.b64encode(sasl_token)))
+    sasl_token = base64.b64encode(sasl_token.encode('utf-8'))
+    bot.write(('AUTHENTICATE', sasl_token.decode('ascii')))
 
 
 @event('903')
 @rule('.*')
 def sasl_success(bot, trigger):
     bot.write(('CAP', 'END'))
+
+
+@event('904', '905')
+@rule('.*')
+def sasl_fail(bot, trigger):
+    # Carry on registering without it, rather than hang until the server
+    # times us out.
+    LOGGER.warning('SASL authentication failed: %s', trigger)
+    bot.write(('CAP', 'END'))
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""The index ``LpBot.dispatch`` uses to find the callables a line may trigger.
+
+``bot.commands`` maps each priority to the compiled rules of the callables,
+in the order they were bound. Matching a line against every one of them is
+most of what dispatching a line costs, and nearly all of it is wasted: most
+rules are commands, which can only match a line with that command in it, and
+most callables only want ``PRIVMSG``.
+
+``DispatchIndex`` files each rule under the events its callables want, and
+each command (``.command`` or ``$nickname: command``) under its name as well.
+For a line, it then only hands out the rules which could possibly match it:
+the free-form rules for its event, and the commands named in it. They come in
+the same order as in ``bot.commands``, with each rule's callables cut down to
+those which want the event.
+
+Free-form rules are mostly of the ``.*<url>.*`` kind, which can't match a line
+without some literal text in it (``youtu``, ``github``, ...). Those literals
+are pulled out of each rule's parsed pattern, and ``LiteralFilter`` looks for
+all of them at once, so that only the rules whose literals are in the line get
+run. Rules without a usable literal are always run.
+"""
+# Copyright 2014, Nikola Kovacevic, <nikolak@outlook.com>
+# Licensed under the Eiffel Forum License 2.
+
+import operator
+import re
+
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:
+    import sre_constants
+    import sre_parse
+
+# A command which is a plain word, rather than a regular expression
+_plain_command = re.compile(r'[\w-]+$')
+
+_first = operator.itemgetter(0)
+
+_repeats = tuple(getattr(sre_constants, name) for name in
+                 ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT')
+                 if hasattr(sre_constants, name))
+
+# Literals shorter than this are in too many lines to be worth looking for
+MIN_LITERAL = 3
+
+# The non-ASCII letters which re.IGNORECASE matches with an ASCII one, but
+# which str.lower() doesn't turn into just that letter ('\u212a' it does).
+_folds = str.maketrans('\u0130\u0131\u017f', 'iis')
+
+
+def _fold(text):
+    """Lower ``text`` so that it contains a literal if the literal matches it
+    case-insensitively."""
+    return text.translate(_folds).lower()
+
+
+def _selectivity(literals):
+    # A set of alternatives is only as good as its shortest one
+    return min(len(literal) for literal in literals), -len(literals)
+
+
+def _required(subpattern):
+    """Return a set of literals, at least one of which is in anything
+    ``subpattern`` matches, or ``None``."""
+    best = None
+    run = []
+    candidates = []
+    for op, av in subpattern:
+        if op is sre_constants.LITERAL and av < 128:
+            run.append(_fold(chr(av)))
+            continue
+        if run:
+            candidates.append(frozenset([''.join(run)]))
+            run = []
+        if op is sre_constants.SUBPATTERN:
+            candidates.append(_required(av[-1]))
+        elif op in _repeats and av[0] >= 1:
+            candidates.append(_required(av[2]))
+        elif op is sre_constants.BRANCH:
+            alternatives = [_required(branch) for branch in av[1]]
+            if all(alternatives):
+                candidates.append(frozenset().union(*alternatives))
+    if run:
+        candidates.append(frozenset([''.join(run)]))
+    for literals in candidates:
+        if literals and (best is None or
+                         _selectivity(literals) > _selectivity(best)):
+            best = literals
+    return best
+
+
+def required_literals(regexp):
+    """Return a set of lower-case literals, at least one of which is in any
+    line ``regexp`` matches, or ``None`` if there's no such set worth
+    looking for."""
+    try:
+        literals = _required(sre_parse.parse(regexp.pattern, regexp.flags))
+    except Exception:
+        return None
+    if literals is None or _selectivity(literals)[0] < MIN_LITERAL:
+        return None
+    return literals
+
+
+class LiteralFilter(object):
+    """Finds which of a set of literals are in a line.
+
+    Most lines contain none of them, so a single regular expression, which
+    tries all the literals at once, first looks for any of them; only when
+    it finds one is each literal checked for. The line is folded as the
+    literals were first, since rules are case-insensitive.
+
+    """
+
+    def __init__(self, literals):
+        self._literals = frozenset(literals)
+        self._regexp = None
+        if self._literals:
+            self._regexp = re.compile('|'.join(
+                re.escape(literal) for literal in
+                sorted(self._literals, key=len, reverse=True)))
+
+    def search(self, text):
+        """Return the set of the literals which are in ``text``."""
+        if self._regexp is None:
+            return frozenset()
+        text = _fold(text)
+        if self._regexp.search(text) is None:
+            return frozenset()
+        return frozenset(literal for literal in self._literals
+                         if literal in text)
+
+
+class DispatchIndex(object):
+    """Rules from ``bot.commands``, indexed by event and command name.
+
+    ``prefix`` is the command prefix, as in ``get_command_regexp``, and
+    ``nick`` lpbot's nick at the time the rules were compiled. Rules are
+    filed with ``add``, after ``name_command`` or
+    ``name_nickname_commands`` has recorded which of them are commands.
+
+    """
+
+    priorities = ('high', 'medium', 'low')
+
+    def __init__(self, prefix, nick):
+        # The same whitespace escaping as get_command_regexp does
+        prefix = re.sub(r'(\s)', r'\\\1', prefix)
+        self._prefix = re.compile(prefix, re.IGNORECASE | re.VERBOSE)
+        if self._prefix.match(''):
+            # With a prefix which may be left out, where it ends and the
+            # command starts can't be told without the command's own rule.
+            self._prefix = None
+        self._nick_prefix = re.compile(re.escape(nick) + r'[:,]?\s+',
+                                       re.IGNORECASE)
+        self._names = {}
+        self._literals = {}
+        self._filter = None
+        self._tables = dict((priority, {}) for priority in self.priorities)
+        self._count = 0
+        self.regexps_run = 0
+        """How many free-form rules with literals were run on a line."""
+        self.regexps_skipped = 0
+        """How many free-form rules were not run on a line, because none of
+        their literals were in it."""
+
+    def name_command(self, regexp, command):
+        """Record ``regexp`` as the rule of the prefixed ``command``."""
+        if self._prefix is not None and _plain_command.match(command):
+            self._names[regexp] = [('prefix', command.lower())]
+
+    def name_nickname_commands(self, regexp, commands):
+        """Record ``regexp`` as the rule of the nickname ``commands``."""
+        if all(_plain_command.match(command) for command in commands):
+            self._names[regexp] = [('nick', command.lower())
+                                   for command in commands]
+
+    def add(self, priority, regexp, funcs):
+        """File ``regexp``, with the ``funcs`` it triggers."""
+        self._count += 1
+        names = self._names.get(regexp)
+        literals = None
+        if names is None:
+            if regexp not in self._literals:
+                self._literals[regexp] = required_literals(regexp)
+                self._filter = None
+            literals = self._literals[regexp]
+        events = []
+        for func in funcs:
+            for event in func.event:
+                if event not in events:
+                    events.append(event)
+        for event in events:
+            wanted = [func for func in funcs if event in func.event]
+            rules, commands = self._tables[priority].setdefault(
+                event, ([], {}))
+            entry = (self._count, regexp, wanted, literals)
+            if names is None:
+                rules.append(entry)
+            for name in names or ():
+                commands.setdefault(name, []).append(entry)
+
+    def remove(self, func):
+        """Stop handing out ``func``, as ``unregister`` does."""
+        for table in self._tables.values():
+            for rules, commands in table.values():
+                for entry in rules:
+                    if func in entry[2]:
+                        entry[2].remove(func)
+                for entries in commands.values():
+                    for _, _, funcs, _ in entries:
+                        if func in funcs:
+                            funcs.remove(func)
+
+    def scan(self, text):
+        """Work out what ``candidates`` needs to know about ``text``: which
+        command names it could be for, and which literals it contains."""
+        names = []
+        if self._prefix is not None:
+            match = self._prefix.match(text)
+            if match:
+                words = text[match.end():].split(None, 1)
+                if words and not text[match.end()].isspace():
+                    names.append(('prefix', words[0].lower()))
+        match = self._nick_prefix.match(text)
+        if match:
+            words = text[match.end():].split(None, 1)
+            if words:
+                names.append(('nick', words[0].lower()))
+        if self._filter is None:
+            self._filter = LiteralFilter(
+                literal for literals in self._literals.values()
+                if literals for literal in literals)
+        return names, self._filter.search(text)
+
+    def candidates(self, priority, event, line):
+        """Return the rules of ``priority`` which could trigger on ``line``
+        (as returned by ``scan``) with ``event``, in binding order, as
+        ``(order, regexp, funcs)`` tuples."""
+        table = self._tables[priority].get(event)
+        if table is None:
+            return ()
+        rules, commands = table
+        names, present = line
+        found = [entry for name in names for entry in commands.get(name, ())]
+        if found:
+            rules = sorted(rules + found, key=_first)
+        candidates = []
+        for order, regexp, funcs, literals in rules:
+            if literals is not None:
+                if present.isdisjoint(literals):
+                    self.regexps_skipped += 1
+                    continue
+                self.regexps_run += 1
+            candidates.append((order, regexp, funcs))
+        return candidates
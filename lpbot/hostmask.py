@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""Matching nicks and hosts against lists of masks, such as the ``admins``,
+``nick_blocks`` and ``host_blocks`` options of the ``[core]`` section.
+
+Checking a line's sender used to mean going through the whole list, compiling
+each mask as it went. A ``MaskSet`` compiles a list once, and files each mask
+by what it can match:
+
+* masks with no wildcards at all go in a set, and are found with one lookup;
+* the others are filed under the literal text they start (or end) with, so
+  that only those whose text is at the start (or end) of the string are run;
+* whatever is left, which has no literal text at either end, is always run.
+
+Results are cached per string. ``mask_set`` keeps a ``MaskSet`` for each such
+option of a config section, and makes a new one whenever the option is set,
+as ``.set``, ``.ignore`` and ``.unignore`` do.
+"""
+# Copyright 2014, Nikola Kovacevic, <nikolak@outlook.com>
+# Licensed under the Eiffel Forum License 2.
+
+import re
+
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:
+    import sre_constants
+    import sre_parse
+
+from lpbot.tools import Identifier, get_hostmask_regex
+
+cache_size = 4096
+"""How many strings each ``MaskSet`` remembers the result for."""
+
+
+def compile_regex(mask):
+    """Compile a block list ``mask``, which is a regular expression that has
+    to match the whole string. Returns ``None`` if it isn't valid."""
+    try:
+        return re.compile(mask + '$', re.IGNORECASE)
+    except re.error:
+        return None
+
+
+def compile_glob(mask):
+    """Compile an ``admins`` ``mask``, where ``*`` stands for anything."""
+    return get_hostmask_regex(mask)
+
+
+def fold_nick(nick):
+    """Fold ``nick`` the way ``Identifier`` compares nicks."""
+    return Identifier(nick).lower()
+
+
+def _literal_ends(regexp):
+    """Return the ASCII text ``regexp`` matches, if that's all it matches,
+    and otherwise the lower-cased ASCII text which anything it matches starts
+    with and ends with (either of which may be empty)."""
+    try:
+        parsed = list(sre_parse.parse(regexp.pattern, regexp.flags))
+    except Exception:
+        return None, '', ''
+    if not parsed or parsed[-1] != (sre_constants.AT, sre_constants.AT_END):
+        return None, '', ''
+    parsed.pop()
+    if all(op is sre_constants.LITERAL and av < 128 for op, av in parsed):
+        return ''.join(chr(av) for _, av in parsed), '', ''
+
+    def literal_run(ops):
+        run = []
+        for op, av in ops:
+            if op is not sre_constants.LITERAL or av >= 128:
+                break
+            run.append(chr(av).lower())
+        return ''.join(run)
+
+    prefix = literal_run(parsed)
+    suffix = literal_run(reversed(parsed))[::-1]
+    return None, prefix, suffix
+
+
+class MaskSet(object):
+    """A list of masks, compiled once, which ``in`` matches strings against.
+
+    ``compile_mask`` turns each mask into a regular expression which must
+    match the whole string, case-insensitively, or ``None`` for one which
+    can't be used. If ``fold`` is given, a string also matches a mask when
+    ``fold`` makes the two the same, as the block lists have always allowed.
+
+    """
+
+    def __init__(self, masks, compile_mask=compile_regex, fold=None):
+        self._fold = fold
+        self._texts = set()
+        self._literals = set()
+        self._prefixes = {}
+        self._suffixes = {}
+        self._others = []
+        self._regexps = []
+        self._cache = {}
+        for mask in masks:
+            mask = mask.strip()
+            if not mask:
+                continue
+            if fold is not None:
+                self._texts.add(fold(mask))
+            regexp = compile_mask(mask)
+            if regexp is None:
+                continue
+            self._regexps.append(regexp)
+            literal, prefix, suffix = _literal_ends(regexp)
+            if literal is not None:
+                self._literals.add(literal.lower())
+            elif prefix and len(prefix) >= len(suffix):
+                self._prefixes.setdefault(len(prefix), {}).setdefault(
+                    prefix, []).append(regexp)
+            elif suffix:
+                self._suffixes.setdefault(len(suffix), {}).setdefault(
+                    suffix, []).append(regexp)
+            else:
+                self._others.append(regexp)
+
+    def __len__(self):
+        return len(self._regexps)
+
+    def __contains__(self, text):
+        # Identifiers compare case-insensitively, so key by the plain text
+        text = str(text)
+        found = self._cache.get(text)
+        if found is None:
+            found = self._match(text)
+            if len(self._cache) >= cache_size:
+                self._cache.clear()
+            self._cache[text] = found
+        return found
+
+    def _match(self, text):
+        if self._fold is not None and self._fold(text) in self._texts:
+            return True
+        if not text.isascii():
+            # Case-insensitive matching isn't just lower-casing outside of
+            # ASCII, so the index can't be trusted; try them all.
+            return any(regexp.match(text) for regexp in self._regexps)
+        lowered = text.lower()
+        if lowered in self._literals:
+            return True
+        for length, table in self._prefixes.items():
+            for regexp in table.get(lowered[:length], ()):
+                if regexp.match(text):
+                    return True
+        for length, table in self._suffixes.items():
+            for regexp in table.get(lowered[-length:], ()):
+                if regexp.match(text):
+                    return True
+        return any(regexp.match(text) for regexp in self._others)
+
+
+def mask_set(section, option, compile_mask=compile_regex, fold=None):
+    """Return the ``MaskSet`` of the list ``option`` of config ``section``.
+
+    The set is kept until the option is next set, so it's only compiled
+    again once the list changes.
+
+    """
+    sets = getattr(section, '_mask_sets', None)
+    if sets is None:
+        return MaskSet(section.get_list(option), compile_mask, fold)
+    found = sets.get(option)
+    if found is None:
+        # get_list may set the option (to the split list), which would drop
+        # a set made before it.
+        masks = section.get_list(option)
+        found = sets[option] = MaskSet(masks, compile_mask, fold)
+    return found
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""The hand-off between reading lines from the server and dispatching them.
+
+Lines used to be dispatched on the event loop as they were read, so a
+``thread(False)`` callable which took its time (``startup`` sleeping between
+joins, ``.reload`` importing a module) held up reading, and with it the answer
+to the server's ``PING``; a long enough wait and the server dropped lpbot for
+a ping timeout. Now the event loop only frames lines, logs them and answers
+``PING``, and puts the lines on an ``InboundQueue``. The queue's own thread
+dispatches them, one at a time and in the order they came in.
+
+The queue never drops a line. Once it is full, the event loop stops reading
+from the server until half of it has been dispatched, and the server's lines
+wait in the socket's buffers in the meantime. (The rest of what was read with
+the line which filled it is still queued, so it may go a little over.)
+Nothing is read while it waits, not even ``PING``, so a queue which is too
+small to ride out a slow callable brings the ping timeout back.
+
+Each line is tagged with the connection it was read from. On a reconnect, the
+lines still waiting from the old connection are dropped, and the new one's
+state isn't set up until the line being dispatched, if any, is done with.
+
+The following ``[core]`` option tunes it:
+
+``inbound_queue``
+    How many lines may be waiting to be dispatched before lpbot stops reading
+    from the server. Defaults to 1000.
+"""
+# Copyright 2014, Nikola Kovacevic, <nikolak@outlook.com>
+# Licensed under the Eiffel Forum License 2.
+
+import threading
+import time
+from collections import deque
+
+from lpbot.logger import get_logger
+
+LOGGER = get_logger(__name__)
+
+
+class InboundQueue(object):
+    """Lines read from the server, which ``handle`` is called with, in order,
+    on a thread of the queue's own.
+
+    ``put`` is called from the thread which reads from the server, and so are
+    ``pause`` and ``resume``, which stop and restart the reading;
+    ``call_soon`` has to run a callback on that thread, from any other.
+
+    """
+
+    def __init__(self, handle, size=1000, pause=None, resume=None,
+                 call_soon=None):
+        self.handle = handle
+        self.size = size
+        self._pause = pause
+        self._resume = resume
+        self._call_soon = call_soon
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._idle = threading.Condition(self._lock)
+        self._items = deque()
+        self._thread = None
+        self._paused = False
+        self._resuming = False
+        self._handling = None
+        self.generation = 0
+        """The connection the lines being queued now are from."""
+        self.received = 0
+        """How many lines have been queued."""
+        self.handled = 0
+        """How many lines have been dispatched."""
+        self.pauses = 0
+        """How many times reading was stopped because the queue was full."""
+        self.max_depth = 0
+        """The most lines which have been waiting at once."""
+        self.wait_total = 0.0
+        """How long, in seconds, lines have waited to be dispatched in all."""
+        self.wait_max = 0.0
+        """The longest any line has waited to be dispatched, in seconds."""
+
+    def put(self, item):
+        """Queue ``item`` to be handled, and stop reading if that fills the
+        queue."""
+        with self._lock:
+            self._items.append((item, time.monotonic(), self.generation))
+            self.received += 1
+            self.max_depth = max(self.max_depth, len(self._items))
+            pause = not self._paused and len(self._items) >= self.size
+            if pause:
+                self._paused = True
+                self.pauses += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='inbound')
+                self._thread.daemon = True
+                self._thread.start()
+            self._ready.notify()
+        if pause:
+            if self.pauses % 100 == 1:
+                LOGGER.warning('Inbound queue is full; stopped reading from '
+                               'the server %d times so far', self.pauses)
+            if self._pause is not None:
+                self._pause()
+
+    def clear(self):
+        """Forget the lines still waiting, as for a new connection, which
+        starts out reading.
+
+        Waits for the line being handled, if there is one, so that nothing
+        from the old connection is handled once this returns.
+
+        """
+        with self._lock:
+            self._items.clear()
+            self._paused = False
+            self._resuming = False
+            self.generation += 1
+            if self._thread is threading.current_thread():
+                return
+            warned = False
+            while (self._handling is not None and
+                   self._handling < self.generation):
+                if not self._idle.wait(5) and not warned:
+                    LOGGER.warning('Still handling a line from the previous '
+                                   'connection')
+                    warned = True
+
+    def metrics(self):
+        """Return a dictionary of the queue's counters, with its current
+        depth, whether reading is stopped and the mean wait of a line."""
+        with self._lock:
+            started = self.received - len(self._items)
+            return {
+                'depth': len(self._items),
+                'paused': self._paused,
+                'received': self.received,
+                'handled': self.handled,
+                'pauses': self.pauses,
+                'max_depth': self.max_depth,
+                'wait_mean': self.wait_total / started if started else 0.0,
+                'wait_max': self.wait_max,
+            }
+
+    def _drained(self):
+        """Start reading again, if the queue is still no more than half
+        full. Runs on the thread which reads."""
+        with self._lock:
+            self._resuming = False
+            if not self._paused or len(self._items) > self.size // 2:
+                return
+            self._paused = False
+        if self._resume is not None:
+            self._resume()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._items:
+                    self._ready.wait()
+                item, queued, generation = self._items.popleft()
+                if generation != self.generation:
+                    # From a connection which has since been replaced
+                    continue
+                self._handling = generation
+                waited = time.monotonic() - queued
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+                resume = (self._paused and not self._resuming and
+                          len(self._items) <= self.size // 2)
+                if resume:
+                    self._resuming = True
+            if resume and self._call_soon is not None:
+                self._call_soon(self._drained)
+            try:
+                self.handle(item)
+            except Exception:
+                # The handler catches its own errors; this would be lpbot's
+                LOGGER.exception('Error in inbound queue')
+            finally:
+                with self._lock:
+                    self.handled += 1
+                    self._handling = None
+                    self._idle.notify_all()
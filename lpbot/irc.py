@@ -11,20 +11,207 @@
 import sys
 import time
 import socket
-import asyncore
-import asynchat
+import asyncio
 import os
 import traceback
-import select
 import ssl
-import errno
 import threading
+import itertools
+from collections import OrderedDict
 from datetime import datetime
 
+from lpbot.inbound import InboundQueue
+from lpbot.isupport import ISupport
+from lpbot.outbound import OutboundScheduler, split_text
+from lpbot.rawlog import RawLogWriter
+from lpbot.tls import create_context, TLSConnection
 from lpbot.tools import stderr, Identifier
-from lpbot.trigger import PreTrigger
+from lpbot.trigger import PreTrigger, Batch
+
+
+class IrcProtocol(asyncio.Protocol):
+    """The asyncio side of a server connection.
+
+    The protocol holds no IRC state; everything it is told by the event loop
+    is handed straight to the ``Bot`` that owns the connection. It is also
+    what the bot writes to, since it's where TLS, if any, happens: with a
+    ``TLSConnection`` given as ``tls``, the bot only hears about the
+    connection once the handshake is done, and only ever sees plaintext.
+
+    """
+
+    def __init__(self, bot, tls=None):
+        self.bot = bot
+        self.tls = tls
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.tls is None:
+            self.bot.handle_connect(self)
+        else:
+            transport.write(self.tls.start())
+
+    def data_received(self, data):
+        if self.tls is None:
+            self.bot.handle_read(data)
+            return
+        try:
+            plaintext, finished = self.tls.feed(data)
+        except ssl.SSLError as e:
+            self.bot.handle_tls_error(e)
+            self.transport.close()
+            return
+        outgoing = self.tls.outgoing()
+        if outgoing:
+            self.transport.write(outgoing)
+        if finished:
+            self.bot.handle_tls_established(self.tls)
+            self.bot.handle_connect(self)
+        if plaintext:
+            self.bot.handle_read(plaintext)
+
+    def connection_lost(self, exc):
+        self.bot.handle_connection_lost(exc)
+
+    def pause_writing(self):
+        self.bot.pause_writing()
+
+    def resume_writing(self):
+        self.bot.resume_writing()
+
+    # What the bot sees of the connection
+
+    def pause_reading(self):
+        self.transport.pause_reading()
+
+    def resume_reading(self):
+        self.transport.resume_reading()
+
+    def write(self, data):
+        if self.tls is not None:
+            data = self.tls.encrypt(data)
+        self.transport.write(data)
+
+    def close(self):
+        if self.tls is not None and self.tls.established:
+            self.transport.write(self.tls.close())
+        self.transport.close()
+
+    def is_closing(self):
+        return self.transport.is_closing()
+
+
+class LineFramer(object):
+    """Split the raw byte stream from the server into decoded lines.
+
+    Incoming data is accumulated in a single ``bytearray``; complete lines
+    are cut out of it through a ``memoryview``, so nothing is copied until a
+    line is decoded, and every line is decoded exactly once. We can't trust
+    clients to send valid UTF-8, so a line which isn't is decoded with the
+    first of ``fallback_encodings`` that works. Whichever one that was is
+    remembered for the sender of the line, and tried first the next time
+    that sender says something that isn't UTF-8.
+
+    """
+
+    fallback_encodings = ('cp1252', 'iso8859-1')
+    max_remembered = 4096
+    """How many senders' fallback encodings are remembered at most."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._encodings = OrderedDict()
+
+    def feed(self, data):
+        """Add ``data`` to the buffer and return the lines it completed.
+
+        The returned lines have their trailing CR-LF removed. Lines which
+        can't be decoded at all are dropped.
+
+        """
+        buf = self._buffer
+        buf += data
+        lines = []
+        start = 0
+        view = memoryview(buf)
+        try:
+            while True:
+                end = buf.find(b'\n', start)
+                if end == -1:
+                    break
+                stop = end
+                if stop > start and buf[stop - 1] == 13:  # '\r'
+                    stop -= 1
+                line = self.decode(view[start:stop])
+                if line is not None:
+                    lines.append(line)
+                start = end + 1
+        finally:
+            # The bytearray can't be resized while a view of it exists.
+            view.release()
+        if start:
+            del buf[:start]
+        return lines
+
+    def clear(self):
+        """Throw away any partial line left over from the last connection."""
+        del self._buffer[:]
+
+    def decode(self, raw):
+        """Decode a single line, given as a bytes-like object."""
+        try:
+            return str(raw, 'utf-8')
+        except UnicodeDecodeError:
+            pass
+
+        sender = self._sender(raw)
+        remembered = self._encodings.get(sender)
+        encodings = self.fallback_encodings
+        if remembered is not None:
+            encodings = (remembered,) + tuple(
+                enc for enc in encodings if enc != remembered)
+        for encoding in encodings:
+            try:
+                line = str(raw, encoding)
+            except UnicodeDecodeError:
+                continue
+            if encoding != remembered:
+                self._encodings[sender] = encoding
+                if len(self._encodings) > self.max_remembered:
+                    self._encodings.popitem(last=False)
+            return line
+        # Discard line if encoding is unknown
+        return None
+
+    @staticmethod
+    def _sender(raw):
+        """Return the nick (as bytes) from the prefix of a raw line."""
+        raw = bytes(raw[:64])
+        if raw.startswith(b'@'):
+            # Skip IRCv3 message tags, if they're short enough to be in view.
+            space = raw.find(b' ')
+            raw = raw[space + 1:] if space != -1 else b''
+        if not raw.startswith(b':'):
+            return None
+        end = len(raw)
+        for sep in (b'!', b' '):
+            index = raw.find(sep)
+            if index != -1:
+                end = min(end, index)
+        return raw[1:end]
+
+
+class Bot(object):
+    priority_commands = frozenset(('PONG', 'PING', 'CAP', 'AUTHENTICATE',
+                                   'PASS', 'NICK', 'USER', 'QUIT'))
+    """Commands which are never held back by flood control."""
+    collected_batches = frozenset(('netsplit', 'netjoin', 'chathistory',
+                                   'znc.in/playback'))
+    """Types of IRCv3 batch which are collected and dispatched as a whole."""
+    privilege_levels = {}
+    """The privilege level of each privilege mode, for ``ISupport``."""
 
-class Bot(asynchat.async_chat):
     def __init__(self, config):
         ca_certs = '/etc/pki/tls/cert.pem'
         if config.ca_certs is not None:
@@ -38,9 +225,27 @@ class Bot(asynchat.async_chat):
         if config.log_raw is None:
             # Default is to log raw data, can be disabled in config
             config.log_raw = True
-        asynchat.async_chat.__init__(self)
-        self.set_terminator(b'\n')
-        self.buffer = ''
+        self.framer = LineFramer()
+        self.inbound = InboundQueue(
+            self._dispatch_line, size=int(config.inbound_queue or 1000),
+            pause=self._pause_reading, resume=self._resume_reading,
+            call_soon=self._call_soon)
+        """The ``InboundQueue`` lines from the server wait in to be
+        dispatched."""
+
+        self.loop = None
+        """The asyncio event loop which owns the server connection. It is
+        created by ``run``, and only exists while lpbot is connected."""
+        self.transport = None
+        self._outbuf = []
+        self._outbuf_lock = threading.Lock()
+        self._flush_scheduled = False
+        self._writing_paused = False
+        self._loop_thread = None
+        self._tasks = set()
+        self._closed = None
+        self._timers = {}
+        self.connected = False
 
         self.nick = Identifier(config.nick)
         """lpbot's current ``Identifier``. Changing this while lpbot is running is
@@ -53,13 +258,35 @@ class Bot(asynchat.async_chat):
         self.channels = []
         """The list of channels lpbot is currently in."""
 
+        self.hostmask = None
+        """lpbot's own ``nick!user@host``, as the server sees it, or ``None``
+        until the server has told us."""
+        self.isupport = ISupport(self.privilege_levels)
+        """The ``ISupport`` features the server advertised in RPL_ISUPPORT
+        (005)."""
+        self._batch_ids = itertools.count()
+        self._batches = {}
+        """The IRCv3 batches being collected, by reference tag."""
+
         self.stack = {}
         self.ca_certs = ca_certs
+        self.ssl_context = None
+        """The ``ssl.SSLContext`` used for every connection, once created."""
+        self.tls_session = None
+        """The ``ssl.SSLSession`` from the last TLS connection, if any."""
+        self.tls_handshake_time = None
+        """How long the last TLS handshake took, in seconds."""
         self.hasquit = False
 
         self.sending = threading.RLock()
-        self.writing_lock = threading.Lock()
+        self.outbound = OutboundScheduler(
+            self._send_line,
+            burst=float(config.flood_burst or 10),
+            refill=float(config.flood_refill or 1))
+        """The ``OutboundScheduler`` all lines to the server go through."""
         self.raw = None
+        self.raw_log = None
+        """The ``RawLogWriter`` for raw.log, or ``None`` if it is disabled."""
 
         # Right now, only accounting for two op levels.
         # This might be expanded later.
@@ -89,7 +316,14 @@ class Bot(asynchat.async_chat):
 
     def log_raw(self, line, prefix):
         """Log raw line to the raw log."""
-        if not self.config.core.log_raw:
+        if self.raw_log is None:
+            return
+        self.raw_log.write(prefix + str(time.time()) + "\t" +
+                           line.replace('\n', '') + '\n')
+
+    def start_raw_log(self):
+        """Start the raw log writer, if raw logging is enabled."""
+        if not self.config.core.log_raw or self.raw_log is not None:
             return
         if not self.config.core.logdir:
             self.config.core.logdir = os.path.join(self.config.dotdir,
@@ -103,13 +337,18 @@ class Bot(asynchat.async_chat):
                 stderr('Please fix this and then run lpbot again.')
                 os._exit(1)
         #TODO: make path not hardcoded
-        with open(os.path.join(self.config.core.logdir, 'raw.log'),
-                 'a', 
-                 encoding='utf-8') as rawlog:
-            rawlog.write(prefix + str(time.time()) + "\t")
-            rawlog.write(line.replace('\n', ''))
-            rawlog.write('\n')
-
+        parts = ['raw']
+        if self.network is not None:
+            parts.append(self.network)
+        if self.shard:
+            parts.append(str(self.shard))
+        filename = '.'.join(parts + ['log'])
+        self.raw_log = RawLogWriter(
+            os.path.join(self.config.core.logdir, filename),
+            max_size=int(self.config.core.log_raw_max_size or 0),
+            daily=bool(self.config.core.log_raw_daily),
+            compress=bool(self.config.core.log_raw_compress))
+        self.raw_log.start()
 
     def safe(self, string):
         """Remove newlines from a string."""
@@ -134,61 +373,228 @@ class Bot(asynchat.async_chat):
 
         Newlines and carriage returns ('\\n' and '\\r') are removed before
         sending. Additionally, if the message (after joining) is longer than
-        than 510 characters, any remaining characters will not be sent.
+        than the server's ``LINELEN`` (510 bytes, unless it says otherwise),
+        any remaining characters will not be sent. Use
+        ``msg`` to send text which may need splitting.
+
+        This never blocks, and is safe to call from any thread. The line is
+        queued in ``outbound`` and put on the wire by the event loop once
+        flood control allows it; commands in ``priority_commands`` skip the
+        queue.
 
         """
-		#TODO handle the case of too long lines gracefully by adding ellipses
+        line = self.format_line(args, text)
+        command = args[0].split(' ', 1)[0].upper() if args else ''
+        if command in self.priority_commands:
+            self.outbound.put(line, priority=True)
+        else:
+            target = None
+            if command in ('PRIVMSG', 'NOTICE') and len(args) > 1:
+                target = Identifier(args[1])
+            self.outbound.put(line, target)
+
+    def format_line(self, args, text=None, tags=None):
+        """Return the line ``write`` would send for ``args`` and ``text``.
+
+        ``tags``, if given, is a dict of IRCv3 message tags to prepend to the
+        line. Tags don't count towards the length limit.
+
+        """
+        #TODO handle the case of too long lines gracefully by adding ellipses
         args = [self.safe(arg) for arg in args]
         if text is not None:
             text = self.safe(text)
+
+        # From RFC2812 Internet Relay Chat: Client Protocol
+        # Section 2.3
+        #
+        # https://tools.ietf.org/html/rfc2812.html
+        #
+        # IRC messages are always lines of characters terminated with a
+        # CR-LF (Carriage Return - Line Feed) pair, and these messages SHALL
+        # NOT exceed 512 characters in length, counting all characters
+        # including the trailing CR-LF. Thus, there are 510 characters
+        # maximum allowed for the command and its parameters.  There is no
+        # provision for continuation of message lines.
+        #
+        # "Characters" there means bytes, so the limit is applied to the
+        # encoded line, without cutting a multibyte character in half.
+        # Servers which allow longer lines say so with LINELEN.
+        limit = self.isupport.linelen - 2
+
+        if text is not None:
+            temp = ' '.join(args) + ' :' + text
+        else:
+            temp = ' '.join(args)
+        encoded = temp.encode('utf-8')
+        if len(encoded) > limit:
+            temp = encoded[:limit].decode('utf-8', 'ignore')
+        if tags:
+            temp = '@%s %s' % (';'.join(
+                key if value is None else '%s=%s' % (key, value)
+                for key, value in tags.items()), temp)
+        return temp + '\r\n'
+
+    def _send_line(self, line):
+        """Put a line released by the outbound scheduler on the wire."""
+        self.log_raw(line, '>>')
+        self.send(line.encode('utf-8'))
+
+    def send(self, data):
+        """Queue raw ``data`` to be written to the server.
+
+        Everything sent is appended to one outbound buffer, which the event
+        loop flushes with a single write once it gets round to it, so a burst
+        of lines goes out in as few syscalls (and TLS records) as possible.
+        This may be called from any thread.
+
+        """
+        with self._outbuf_lock:
+            self._outbuf.append(data)
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        self._call_soon(self._flush)
+
+    def _call_soon(self, callback):
+        """Run ``callback`` on the event loop, from whichever thread. Returns
+        ``False`` if there's no loop to run it on."""
+        if self.loop is None or self.loop.is_closed():
+            return False
+        if threading.get_ident() == self._loop_thread:
+            self.loop.call_soon(callback)
+        else:
+            try:
+                self.loop.call_soon_threadsafe(callback)
+            except RuntimeError:
+                # The loop was closed under us; the connection is gone anyway.
+                return False
+        return True
+
+    def run_coroutine(self, coroutine):
+        """Run ``coroutine`` as a task on the event loop, from whichever
+        thread, reporting any error it raises with ``error``. Returns
+        ``False`` if there is no loop to run it on (lpbot isn't connected),
+        in which case it is closed without being run."""
+        if not self._call_soon(lambda: self._start_task(coroutine)):
+            coroutine.close()
+            return False
+        return True
+
+    def _start_task(self, coroutine):
+        task = self.loop.create_task(coroutine)
+        # The loop only keeps weak references to its tasks
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        if task.cancelled():
+            return
         try:
-            self.writing_lock.acquire()  
-			# Blocking lock, can't send two things
-            # at a time
-
-            # From RFC2812 Internet Relay Chat: Client Protocol
-            # Section 2.3
-            #
-            # https://tools.ietf.org/html/rfc2812.html
-            #
-            # IRC messages are always lines of characters terminated with a
-            # CR-LF (Carriage Return - Line Feed) pair, and these messages SHALL
-            # NOT exceed 512 characters in length, counting all characters
-            # including the trailing CR-LF. Thus, there are 510 characters
-            # maximum allowed for the command and its parameters.  There is no
-            # provision for continuation of message lines.
-
-            if text is not None:
-                temp = (' '.join(args) + ' :' + text)[:510] + '\r\n'
-            else:
-                temp = ' '.join(args)[:510] + '\r\n'
-            self.log_raw(temp, '>>')
-            self.send(temp.encode('utf-8'))
-        finally:
-            self.writing_lock.release()
+            task.result()
+        except Exception:
+            self.error()
+
+    def _flush(self):
+        """Write out the outbound buffer. Runs on the event loop."""
+        with self._outbuf_lock:
+            self._flush_scheduled = False
+            if (self._writing_paused or self.transport is None or
+                    self.transport.is_closing() or not self._outbuf):
+                return
+            data = b''.join(self._outbuf)
+            self._outbuf = []
+        # The transport deals with partial writes (and, for TLS, with
+        # renegotiation wanting to write), keeping whatever the socket
+        # didn't take and writing it when the socket becomes writable.
+        self.transport.write(data)
+
+    def pause_writing(self):
+        """Stop flushing; the transport's own buffer is full."""
+        self._writing_paused = True
+        self.outbound.pause()
+
+    def resume_writing(self):
+        """The transport's buffer has drained; carry on flushing."""
+        self._writing_paused = False
+        self.outbound.resume()
+        self._flush()
+
+    def _pause_reading(self):
+        """Stop reading from the server; the inbound queue is full."""
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.pause_reading()
+
+    def _resume_reading(self):
+        """The inbound queue has drained; carry on reading."""
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.resume_reading()
 
     def run(self, host, port=6667):
+        """Connect to ``host`` and run the event loop until disconnected."""
+        self.start_raw_log()
+        self.loop = asyncio.new_event_loop()
+        self._loop_thread = threading.get_ident()
         try:
-            self.initiate_connect(host, port)
-        except socket.error as e:
+            try:
+                self.loop.run_until_complete(self.initiate_connect(host, port))
+            except KeyboardInterrupt:
+                print('KeyboardInterrupt')
+                self.quit('KeyboardInterrupt')
+                self.close_when_done()
+                if self._closed is not None:
+                    self.loop.run_until_complete(self._closed)
+        except (socket.error, ssl.CertificateError) as e:
             stderr('Connection error: %s' % e)
             self.hasquit = True
-
-    def initiate_connect(self, host, port):
+            if isinstance(e, ssl.CertificateError):
+                stderr("Invalid certficate, hostname mismatch!")
+                os.unlink(self.config.pid_file_path)
+                os._exit(1)
+        finally:
+            self._cancel_tasks()
+            self.loop.close()
+
+    def _cancel_tasks(self):
+        """Cancel the tasks still running on the loop, and let them finish."""
+        # Start whatever was handed to the loop just before it stopped
+        self.loop.run_until_complete(asyncio.sleep(0))
+        tasks = [task for task in self._tasks if not task.done()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            self.loop.run_until_complete(
+                asyncio.gather(*tasks, return_exceptions=True))
+
+    async def initiate_connect(self, host, port):
         stderr('Connecting to %s:%s...' % (host, port))
         source_address = ((self.config.core.bind_host, 0)
                           if self.config.core.bind_host else None)
-        self.set_socket(socket.create_connection((host, port),
-                                                 source_address=source_address))
+        tls = None
         if self.config.core.use_ssl:
-            self.send = self._ssl_send
-            self.recv = self._ssl_recv
-        self.connect((host, port))
-        try:
-            asyncore.loop()
-        except KeyboardInterrupt:
-            print('KeyboardInterrupt')
-            self.quit('KeyboardInterrupt')
+            if self.ssl_context is None:
+                self.ssl_context = create_context(
+                    verify=bool(self.config.core.verify_ssl),
+                    ca_certs=self.ca_certs,
+                    certfile=self.config.core.client_cert_file,
+                    keyfile=self.config.core.client_key_file)
+            tls = TLSConnection(self.ssl_context, host, self.tls_session)
+        self._closed = self.loop.create_future()
+        await self.loop.create_connection(
+            lambda: IrcProtocol(self, tls), host, port,
+            local_addr=source_address)
+        await self._closed
+
+    def handle_tls_established(self, tls):
+        """Remember the TLS session, so the next connection can resume it."""
+        self.tls_handshake_time = tls.handshake_time
+        self.tls_session = tls.session
+
+    def handle_tls_error(self, error):
+        """The TLS handshake failed; make ``run`` raise ``error``."""
+        if self._closed is not None and not self._closed.done():
+            self._closed.set_exception(error)
 
     def quit(self, message):
         """Disconnect from IRC and close the bot."""
@@ -202,16 +608,44 @@ class Bot(asynchat.async_chat):
         # release the main thread, which is problematic because whomever called
         # quit might still want to do something before main thread quits.
 
+    def close_when_done(self):
+        """Close the connection once everything already written is sent."""
+        self._call_soon(self._close_transport)
+
+    def _close_transport(self):
+        self._flush()
+        if self.transport is not None:
+            # Transports flush their write buffer before actually closing.
+            self.transport.close()
+        elif self._closed is not None and not self._closed.done():
+            self._closed.set_result(None)
+
     def handle_close(self):
+        if not self.connected:
+            return
+        self.connected = False
         self.connection_registered = False
+        self._cancel_timers()
 
-        self._shutdown()
         stderr('Closed!')
 
-        # This will eventually call asyncore dispatchers close method, which
-        # will release the main thread. This should be called last to avoid
-        # race conditions.
-        self.close()
+        # This will eventually resolve the future ``run`` waits on, which will
+        # release the main thread. This should be called last to avoid race
+        # conditions.
+        self.close_when_done()
+
+    def handle_connection_lost(self, exc):
+        if exc is not None:
+            stderr('Connection lost: %s' % exc)
+        tls = getattr(self.transport, 'tls', None)
+        if tls is not None and tls.established and tls.session is not None:
+            # TLS 1.3 servers send their session tickets after the
+            # handshake, so this may well be newer than the one we had.
+            self.tls_session = tls.session
+        self.handle_close()
+        self.transport = None
+        if self._closed is not None and not self._closed.done():
+            self._closed.set_result(None)
 
     def part(self, channel, msg=None):
         """Part a channel."""
@@ -230,25 +664,75 @@ class Bot(asynchat.async_chat):
         else:
             self.write(['JOIN', channel, password])
 
-    def handle_connect(self):
-        if self.config.core.use_ssl:
-            if not self.config.core.verify_ssl:
-                self.ssl = ssl.wrap_socket(self.socket,
-                                           do_handshake_on_connect=True,
-                                           suppress_ragged_eofs=True)
-            else:
-                self.ssl = ssl.wrap_socket(self.socket,
-                                           do_handshake_on_connect=True,
-                                           suppress_ragged_eofs=True,
-                                           cert_reqs=ssl.CERT_REQUIRED,
-                                           ca_certs=self.ca_certs)
-                try:
-                    ssl.match_hostname(self.ssl.getpeercert(), self.config.host)
-                except ssl.CertificateError:
-                    stderr("Invalid certficate, hostname mismatch!")
-                    os.unlink(self.config.pid_file_path)
-                    os._exit(1)
-            self.set_socket(self.ssl)
+    def join_channels(self, channels):
+        """Join several channels, with as few JOIN lines as the server allows.
+
+        Each item of ``channels`` is a channel, optionally followed by a space
+        and its key, as in the ``channels`` option. How many channels go in
+        one JOIN is limited by the server's ``TARGMAX`` and ``LINELEN``.
+
+        """
+        # Keys go with the first channels of the list, so keyed ones first
+        channels = sorted((channel.split(' ', 1) for channel in channels),
+                          key=len, reverse=True)
+        per_line = self.isupport.targets('JOIN')
+        budget = self.isupport.linelen - len('JOIN  \r\n')
+        lines = [([], [], 0)]
+        for channel in channels:
+            names, keys, used = lines[-1]
+            size = sum(len(part.encode('utf-8')) + 1 for part in channel)
+            if names and (len(names) == per_line or used + size > budget):
+                names, keys, used = [], [], 0
+                lines.append((names, keys, used))
+            names.append(channel[0])
+            keys.extend(channel[1:])
+            lines[-1] = (names, keys, used + size)
+        for names, keys, used in lines:
+            if names:
+                self.write(['JOIN', ','.join(names)] +
+                           ([','.join(keys)] if keys else []))
+
+    def set_modes(self, channel, changes):
+        """Make several mode ``changes`` to ``channel`` in as few MODE lines
+        as the server allows.
+
+        ``changes`` is an iterable of ``(mode, parameter)`` pairs, such as
+        ``('+o', nick)`` or ``('-m', None)``. How many go in one line is
+        limited by the server's ``MODES`` and ``LINELEN``.
+
+        """
+        per_line = self.isupport.modes
+        budget = self.isupport.linelen - len(
+            ('MODE %s  \r\n' % channel).encode('utf-8'))
+        modes, parameters, sign, used = '', [], None, 0
+        for mode, parameter in changes:
+            size = len(mode) + (len(parameter.encode('utf-8')) + 1
+                                if parameter else 0)
+            if modes and (used + size > budget or (
+                    parameter and len(parameters) == per_line)):
+                self.write(['MODE', channel, modes] + parameters)
+                modes, parameters, sign, used = '', [], None, 0
+            if mode[0] != sign:
+                sign = mode[0]
+                modes += sign
+            modes += mode[1:]
+            if parameter:
+                parameters.append(parameter)
+            used += size
+        if modes:
+            self.write(['MODE', channel, modes] + parameters)
+
+    def handle_connect(self, transport):
+        self.transport = transport
+        self.connected = True
+        self.framer.clear()
+        self.inbound.clear()
+        with self._outbuf_lock:
+            self._outbuf = []
+            self._flush_scheduled = False
+            self._writing_paused = False
+        self.outbound.attach(self.loop)
+        self.reset_connection_state()
 
         if self.config.core.server_password is not None:
             self.write(('PASS', self.config.core.server_password))
@@ -257,144 +741,170 @@ class Bot(asynchat.async_chat):
 
         stderr('Connected.')
         self.last_ping_time = datetime.now()
-        timeout_check_thread = threading.Thread(target=self._timeout_check)
-        timeout_check_thread.start()
-        ping_thread = threading.Thread(target=self._send_ping)
-        ping_thread.start()
+        timeout = int(self.config.timeout)
+        self._timers = {
+            'timeout': self.loop.call_later(timeout, self._timeout_check),
+            'ping': self.loop.call_later(timeout / 2, self._send_ping),
+        }
 
         # Request list of server capabilities. IRCv3 servers will respond with
         # CAP * LS (which we handle in coretasks). v2 servers will respond with
         # 421 Unknown command, which we'll ignore
         # This needs to come after Authentication as it can cause connection
         # Issues
-        self.write(('CAP', 'LS'))
+        # Version 302 is needed for the values of capabilities, such as
+        # draft/multiline's limits.
+        self.write(('CAP', 'LS', '302'))
+
+    def reset_connection_state(self):
+        """Forget everything learned from the server on a previous connection.
+
+        This is called as each new connection is made, so that a reconnect
+        starts from a clean slate without having to create a new bot.
+
+        """
+        self.nick = Identifier(self.config.core.nick)
+        self.channels = []
+        self.hostmask = None
+        self.isupport = ISupport(self.privilege_levels)
+        self.stack = {}
+        self.ops = dict()
+        self.halfplus = dict()
+        self.voices = dict()
+        self.error_count = 0
+        self._batches = {}
+
+    def _cancel_timers(self):
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers = {}
 
     def _timeout_check(self):
-        while self.connected or self.connecting:
-            if (datetime.now() - self.last_ping_time).seconds > int(self.config.timeout):
-                stderr('Ping timeout reached after %s seconds, closing connection' % self.config.timeout)
-                self.handle_close()
-                break
-            else:
-                time.sleep(int(self.config.timeout))
+        if not self.connected:
+            return
+        timeout = int(self.config.timeout)
+        if (datetime.now() - self.last_ping_time).seconds > timeout:
+            stderr('Ping timeout reached after %s seconds, closing connection' % self.config.timeout)
+            self.handle_close()
+        else:
+            self._timers['timeout'] = self.loop.call_later(
+                timeout, self._timeout_check)
 
     def _send_ping(self):
-        while self.connected or self.connecting:
-            if self.connected and (datetime.now() - self.last_ping_time).seconds > int(self.config.timeout) / 2:
-                try:
-                    self.write(('PING', self.config.host))
-                except socket.error:
-                    pass
-            time.sleep(int(self.config.timeout) / 2)
-
-    def _ssl_send(self, data):
-        """Replacement for self.send() during SSL connections."""
-        try:
-            result = self.socket.send(data)
-            return result
-        except ssl.SSLError as why:
-            if why[0] in (asyncore.EWOULDBLOCK, errno.ESRCH):
-                return 0
-            else:
-                raise why
-            return 0
+        if not self.connected:
+            return
+        timeout = int(self.config.timeout)
+        if (datetime.now() - self.last_ping_time).seconds > timeout / 2:
+            self.write(('PING', self.config.host))
+        self._timers['ping'] = self.loop.call_later(
+            timeout / 2, self._send_ping)
+
+    def handle_read(self, data):
+        """Frame the raw byte stream from the server into lines, and queue
+        them to be dispatched."""
+        for line in self.framer.feed(data):
+            try:
+                self.log_raw(line, '<<')
+                self.handle_line(line)
+            except Exception:
+                self.handle_error()
 
-    def _ssl_recv(self, buffer_size):
-        """Replacement for self.recv() during SSL connections.
+    def handle_line(self, line):
+        """Handle a single, already decoded, line from the server as it's
+        read, on the event loop.
 
-        From: http://evanfosmark.com/2010/09/ssl-support-in-asynchatasync_chat
+        ``PING`` is answered straight away, however far behind dispatching
+        is; every line is then queued on ``inbound`` to be dispatched.
 
         """
-        try:
-            data = self.socket.read(buffer_size)
-            if not data:
-                self.handle_close()
-                return ''
-            return data
-        except ssl.SSLError as why:
-            if why[0] in (asyncore.ECONNRESET, asyncore.ENOTCONN,
-                          asyncore.ESHUTDOWN):
-                self.handle_close()
-                return ''
-            elif why[0] == errno.ENOENT:
-                # Required in order to keep it non-blocking
-                return ''
-            else:
-                raise
-
-    def collect_incoming_data(self, data):
-        # We can't trust clients to pass valid str.
-        try:
-            data = str(data, encoding='utf-8')
-        except strDecodeError:
-            # not str, let's try cp1252
-            try:
-                data = str(data, encoding='cp1252')
-            except strDecodeError:
-                # Okay, let's try ISO8859-1
-                try:
-                    data = str(data, encoding='iso8859-1')
-                except:
-                    # Discard line if encoding is unknown
-                    return
-
-        if data:
-            self.log_raw(data, '<<')
-        self.buffer += data
-
-    def found_terminator(self):
-        line = self.buffer
-        if line.endswith('\r'):
-            line = line[:-1]
-        self.buffer = ''
         self.last_ping_time = datetime.now()
-        pretrigger = PreTrigger(self.nick, line)
+        if 'PING' in line:
+            pretrigger = PreTrigger(self.nick, line)
+            if pretrigger.event == 'PING':
+                self.write(('PONG', pretrigger.args[-1]))
+        self.inbound.put(line)
+
+    def _dispatch_line(self, line):
+        """Dispatch a line ``handle_line`` queued, on the inbound queue's
+        thread."""
+        try:
+            self.raw = line
+            # Parsed here rather than as it's read, since the lines before it
+            # may have changed our nick.
+            pretrigger = PreTrigger(self.nick, line)
+            if self._collect_batch(pretrigger):
+                return
+
+            if pretrigger.event == 'ERROR':
+                self.debug(__file__, pretrigger.args[-1], 'always')
+                if self.hasquit:
+                    self.close_when_done()
+            elif pretrigger.event == '433':
+                stderr('Nickname already in use!')
+                self._call_soon(self.handle_close)
+
+            self.dispatch(pretrigger)
+        except Exception:
+            self.handle_error()
+
+    def _collect_batch(self, pretrigger):
+        """Add ``pretrigger`` to a batch being collected, if it is part of one.
+
+        Returns ``True`` if the line was taken, in which case it mustn't be
+        dispatched. The line which ends a batch gets the batch as its
+        ``batch``, and is left for ``_dispatch_line`` to dispatch.
 
-        if pretrigger.args[0] == 'PING':
-            self.write(('PONG', pretrigger.args[-1]))
-        elif pretrigger.args[0] == 'ERROR':
-            self.debug(__file__, pretrigger.args[-1], 'always')
-            if self.hasquit:
-                self.close_when_done()
-        elif pretrigger.args[0] == '433':
-            stderr('Nickname already in use!')
-            self.handle_close()
-		
-        self.dispatch(pretrigger)
+        """
+        if not self._batches and pretrigger.event != 'BATCH':
+            # Nothing to collect into, so don't make it parse its tags
+            return False
+        outer = pretrigger.tags.get('batch')
+        if pretrigger.event == 'BATCH' and pretrigger.args:
+            reference = pretrigger.args[0]
+            if reference.startswith('+') and len(pretrigger.args) > 1:
+                # Batches nested in one we collect are collected as well,
+                # whatever their type.
+                if (pretrigger.args[1] in self.collected_batches or
+                        outer in self._batches):
+                    self._batches[reference[1:]] = Batch(
+                        reference[1:], pretrigger.args[1],
+                        pretrigger.args[2:])
+                    if outer in self._batches:
+                        self._batches[outer].messages.append(pretrigger)
+                    return True
+            elif reference.startswith('-') and reference[1:] in self._batches:
+                pretrigger.batch = self._batches.pop(reference[1:])
+                if outer in self._batches:
+                    self._batches[outer].messages.append(pretrigger)
+                    return True
+                return False
+        if outer is not None and outer in self._batches:
+            self._batches[outer].messages.append(pretrigger)
+            return True
+        return False
 
     def dispatch(self, pretrigger):
         pass
-		
+
     def msg(self, recipient, text, max_messages=1):
-        #TODO: it is not obvious how self.stack works, 
-        #add explanation or make code more self-documenting
-
-        # We're arbitrarily saying that the max is 400 bytes of text when
-        # messages will be split. Otherwise, we'd have to acocunt for the bot's
-        # hostmask, which is hard.
-        max_text_length = 400
-        # Encode to bytes, for proper length calculation
-        if isinstance(text, str):
-            encoded_text = text.encode('utf-8')
-        else:
-            encoded_text = text
-        excess = ''
-        if max_messages > 1 and len(encoded_text) > max_text_length:
-            last_space = encoded_text.rfind(' '.encode('utf-8'), 0, max_text_length)
-            if last_space == -1:
-                excess = encoded_text[max_text_length:]
-                encoded_text = encoded_text[:max_text_length]
-            else:
-                excess = encoded_text[last_space + 1:]
-                encoded_text = encoded_text[:last_space]
-        # We'll then send the excess at the end
-        # Back to str again, so we don't screw things up later.
-        text = encoded_text.decode('utf-8')
+        """Send ``text`` to ``recipient`` as a PRIVMSG.
+
+        ``text`` which doesn't fit in one line is split, between words where
+        possible, into at most ``max_messages`` lines; anything beyond that is
+        dropped. How much fits is worked out from lpbot's own hostmask and the
+        server's ``LINELEN``, since the server has to fit both into the line
+        it relays. If the server supports ``draft/multiline``, the pieces are
+        sent as a single multiline batch.
+
+        """
+        if isinstance(text, bytes):
+            text = text.decode('utf-8')
+        text = self.safe(text)
         try:
             self.sending.acquire()
 
-            # No messages within the last 3 seconds? Go ahead!
-            # Otherwise, wait so it's been at least 0.8 seconds + penalty
+            # Pacing is left to self.outbound; self.stack only keeps the last
+            # few messages to each recipient, for loop detection.
 
             recipient_id = Identifier(recipient)
 
@@ -402,11 +912,6 @@ class Bot(asynchat.async_chat):
                 self.stack[recipient_id] = []
             elif self.stack[recipient_id]:
                 elapsed = time.time() - self.stack[recipient_id][-1][0]
-                if elapsed < 3:
-                    penalty = float(max(0, len(text) - 50)) / 70
-                    wait = 0.7 + penalty
-                    if elapsed < wait:
-                        time.sleep(wait - elapsed)
 
                 # Loop detection
                 messages = [m[1] for m in self.stack[recipient_id][-8:]]
@@ -419,15 +924,71 @@ class Bot(asynchat.async_chat):
                         # If we said '...' 3 times, discard message
                         return
 
-            self.write(('PRIVMSG', recipient), text)
-            self.stack[recipient_id].append((time.time(), self.safe(text)))
+            self.stack[recipient_id].append((time.time(), text))
             self.stack[recipient_id] = self.stack[recipient_id][-10:]
         finally:
             self.sending.release()
-        # Now that we've sent the first part, we need to send the rest. Doing
-        # this recursively seems easier to me than iteratively
-        if excess:
-            self.msg(recipient, excess, max_messages - 1)
+
+        budget = self.message_budget('PRIVMSG', recipient)
+        multiline = self._multiline_limits()
+        if multiline is not None and max_messages > 1:
+            pieces = split_text(text, budget, keep_space=True)[:max_messages]
+            max_bytes, max_lines = multiline
+            if (1 < len(pieces) and
+                    (max_lines is None or len(pieces) <= max_lines) and
+                    len(''.join(pieces).encode('utf-8')) <= max_bytes):
+                self._send_multiline(recipient, pieces)
+                return
+        for piece in split_text(text, budget)[:max_messages]:
+            self.write(('PRIVMSG', recipient), piece)
+
+    def message_budget(self, command, recipient):
+        """Return how many bytes of text fit in one ``command`` message.
+
+        The server relays our messages as ``:<hostmask> <command> <recipient>
+        :<text>``, so that all has to fit within its ``LINELEN``. Until the
+        server tells us our hostmask, we assume the longest one it could be.
+
+        """
+        linelen = self.isupport.linelen
+        hostmask = self.hostmask
+        if not hostmask:
+            hostmask = '%s!~%s@%s' % (self.nick, self.user, 'x' * 63)
+        overhead = len((':%s %s %s :\r\n' % (
+            hostmask, command, recipient)).encode('utf-8'))
+        return max(linelen - overhead, 1)
+
+    def _multiline_limits(self):
+        """Return ``(max_bytes, max_lines)`` if multiline batches are usable.
+        ``max_lines`` is ``None`` if the server doesn't limit them."""
+        if 'draft/multiline' not in self.enabled_capabilities:
+            return None
+        limits = {}
+        value = self.server_capabilities.get('draft/multiline') or ''
+        for item in value.split(','):
+            key, _, number = item.partition('=')
+            if number.isdigit():
+                limits[key] = int(number)
+        if 'max-bytes' not in limits:
+            # It's mandatory; without it, a batch could be too big for the
+            # server, and the whole message would be lost.
+            return None
+        return limits['max-bytes'], limits.get('max-lines')
+
+    def _send_multiline(self, recipient, pieces):
+        """Send ``pieces`` of one message as a ``draft/multiline`` batch."""
+        ref = 'ml%d' % next(self._batch_ids)
+        lines = [self.format_line(('BATCH', '+' + ref, 'draft/multiline',
+                                   recipient))]
+        for index, piece in enumerate(pieces):
+            tags = OrderedDict([('batch', ref)])
+            if index:
+                # Join each piece to the previous one without a line break
+                tags['draft/multiline-concat'] = None
+            lines.append(self.format_line(('PRIVMSG', recipient), piece,
+                                          tags))
+        lines.append(self.format_line(('BATCH', '-' + ref)))
+        self.outbound.extend(lines, Identifier(recipient))
 
     def notice(self, dest, text):
         """Send an IRC NOTICE to a user or a channel.
@@ -477,9 +1038,7 @@ class Bot(asynchat.async_chat):
                 self.debug(__file__, "(From: " + trigger.sender + ") " + str(e), 'always')
 
     def handle_error(self):
-        """Handle any uncaptured error in the core.
-
-           Overrides asyncore's handle_error."""
+        """Handle any uncaptured error in the core."""
         trace = traceback.format_exc()
         stderr(trace)
         self.debug(
@@ -493,15 +1052,13 @@ class Bot(asynchat.async_chat):
                        encoding='utf-8'
         )
         logfile.write('Fatal error in core, handle_error() was called\n')
-        logfile.write('last raw line was %s' % self.raw)
+        logfile.write('last raw line was %s\n' % self.raw)
         logfile.write(trace)
-        logfile.write('Buffer:\n')
-        logfile.write(self.buffer)
         logfile.write('----------------------------------------\n\n')
         logfile.close()
         if self.error_count > 10:
             if (datetime.now() - self.last_error_timestamp).seconds < 5:
-                print >> sys.stderr, "Too many errors, can't continue"
+                stderr("Too many errors, can't continue")
                 os._exit(1)
         self.last_error_timestamp = datetime.now()
         self.error_count = self.error_count + 1
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""The features a server advertises in RPL_ISUPPORT (005).
+
+``ISupport`` is a ``dict`` of the raw tokens, as ``bot.isupport`` always was,
+which also keeps the ones lpbot itself relies on parsed into attributes. Each
+token is parsed once, as the server sends it (normally while registering), so
+nothing has to pick strings apart afterwards. Until the server says otherwise,
+the attributes hold the defaults from RFC 1459 and the ISUPPORT draft.
+"""
+# Copyright 2014, Nikola Kovacevic, <nikolak@outlook.com>
+# Licensed under the Eiffel Forum License 2.
+
+import re
+
+
+# Privilege symbols lpbot knows, for PREFIX modes with unfamiliar letters.
+_symbol_modes = {'~': 'q', '&': 'a', '@': 'o', '%': 'h', '+': 'v'}
+
+_escape_regex = re.compile(r'\\x([0-9A-Fa-f]{2})')
+
+
+def _unescape(value):
+    return _escape_regex.sub(lambda match: chr(int(match.group(1), 16)),
+                             value)
+
+
+def _number(value, default=None):
+    """Parse the count ``value``, or return ``default`` if it isn't one.
+
+    Servers do send tokens like ``NICKLEN=`` or ``LINELEN=abc``; one of those
+    mustn't stop the rest of the line from being applied.
+
+    """
+    if value and value.isascii() and value.isdecimal():
+        return int(value)
+    return default
+
+
+def _limits(value):
+    """Parse ``a:1,b:,c:3`` into ``{'a': 1, 'b': None, 'c': 3}``."""
+    limits = {}
+    for item in value.split(','):
+        key, _, number = item.partition(':')
+        if key:
+            limits[key] = _number(number)
+    return limits
+
+
+class ISupport(dict):
+    """The server's RPL_ISUPPORT tokens, mapped to their values (``None`` for
+    tokens without one).
+
+    ``levels`` maps the privilege modes lpbot knows (``v``, ``h``, ``o``,
+    ``a`` and ``q``) to its privilege levels, ``VOICE`` to ``OWNER`` from
+    ``lpbot.module``; modes without a level get 0.
+
+    """
+
+    def __init__(self, levels=None):
+        dict.__init__(self)
+        self._levels = levels or {}
+        self.prefix = []
+        """The channel privilege modes and their NAMES prefixes, as a list of
+        ``(mode, symbol)`` pairs, highest privilege first."""
+        self.mode_privileges = {}
+        """Maps each privilege mode letter to lpbot's privilege level (0 for
+        modes lpbot doesn't have a level for)."""
+        self.symbol_privileges = {}
+        """Maps each NAMES prefix symbol to lpbot's privilege level."""
+        self.chanmodes = ()
+        """The four groups of channel modes: lists, modes which always take a
+        parameter, modes which take one only when set, and modes which never
+        do."""
+        self.parameter_modes = {}
+        """Maps ``'+'`` and ``'-'`` to the set of channel modes (privilege
+        modes included) which take a parameter when set or unset."""
+        self.modes = 3
+        """How many modes with parameters one MODE command may change, or
+        ``None`` if there is no limit."""
+        self.targmax = {}
+        """Maps commands to how many targets they may have at once (``None``
+        for no limit). Commands not in it take a single target."""
+        self.linelen = 512
+        """The longest line the server accepts, in bytes, including the
+        trailing CR-LF."""
+        self.chanlimit = {}
+        """Maps channel type prefixes to how many such channels lpbot may be
+        in (``None`` for no limit)."""
+        self.casemapping = 'rfc1459'
+        """The server's casemapping for nicks and channels."""
+        self.nicklen = None
+        """The longest nick the server allows, or ``None`` if it hasn't
+        said."""
+        self._parsers = {
+            'PREFIX': self._parse_prefix,
+            'CHANMODES': self._parse_chanmodes,
+            'MODES': self._parse_modes,
+            'TARGMAX': self._parse_targmax,
+            'MAXTARGETS': self._parse_maxtargets,
+            'LINELEN': self._parse_linelen,
+            'CHANLIMIT': self._parse_chanlimit,
+            'CASEMAPPING': self._parse_casemapping,
+            'NICKLEN': self._parse_nicklen,
+        }
+        self._parse_prefix(None)
+        self._parse_chanmodes(None)
+
+    def update_token(self, token):
+        """Apply a single ``token`` from a 005 line, e.g. ``MODES=4`` or
+        ``-EXCEPTS``."""
+        name, _, value = token.partition('=')
+        if name.startswith('-'):
+            name = name[1:]
+            self.pop(name, None)
+            value = None
+        else:
+            value = _unescape(value) if value else None
+            self[name] = value
+        if name in self._parsers:
+            self._parsers[name](value)
+
+    def targets(self, command):
+        """Return how many targets ``command`` may have at once, or ``None``
+        for no limit."""
+        return self.targmax.get(command.upper(), 1)
+
+    def _parse_prefix(self, value):
+        levels = self._levels
+        modes, _, symbols = (value or '(ov)@+')[1:].partition(')')
+        self.prefix = list(zip(modes, symbols))
+        self.mode_privileges = {}
+        self.symbol_privileges = {}
+        for mode, symbol in self.prefix:
+            level = levels.get(mode) or levels.get(_symbol_modes.get(symbol), 0)
+            self.mode_privileges[mode] = level
+            self.symbol_privileges[symbol] = level
+        self._update_parameter_modes()
+
+    def _parse_chanmodes(self, value):
+        groups = (value or 'beI,k,l,imnpst').split(',')
+        groups += [''] * (4 - len(groups))
+        self.chanmodes = tuple(groups[:4])
+        self._update_parameter_modes()
+
+    def _update_parameter_modes(self):
+        if not self.chanmodes:
+            return
+        lists, always, when_set, never = self.chanmodes
+        privileges = frozenset(self.mode_privileges)
+        self.parameter_modes = {
+            '+': privileges.union(lists + always + when_set),
+            '-': privileges.union(lists + always),
+        }
+
+    def _parse_modes(self, value):
+        # Present without a value means there's no limit at all
+        self.modes = _number(value, 3) if value else None
+        if 'MODES' not in self:
+            self.modes = 3
+
+    def _parse_targmax(self, value):
+        self.targmax = dict((command.upper(), limit) for command, limit in
+                            _limits(value or '').items())
+
+    def _parse_maxtargets(self, value):
+        # The older form of TARGMAX, for PRIVMSG and NOTICE only
+        limit = _number(value)
+        if limit is not None and 'TARGMAX' not in self:
+            self.targmax.update(PRIVMSG=limit, NOTICE=limit)
+
+    def _parse_linelen(self, value):
+        self.linelen = _number(value, 512)
+
+    def _parse_chanlimit(self, value):
+        self.chanlimit = _limits(value or '')
+
+    def _parse_casemapping(self, value):
+        self.casemapping = value or 'rfc1459'
+
+    def _parse_nicklen(self, value):
+        self.nicklen = _number(value)
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""Tracking of who is in which of lpbot's channels, and with what privileges.
+
+``Memberships`` keeps both directions of the relation: the members of each
+channel, and the channels each nick shares with lpbot. A QUIT then only has to
+touch the channels that nick is actually in, and a NICK touches none at all.
+
+Every nick and channel is interned once, as a small integer ID which is reused
+once nobody refers to it any more. A channel's members are a set of user IDs,
+and a user's channels are a set of channel IDs, so joining and leaving are
+constant-time; privileges are only stored for members who have any.
+``bot.privileges`` and the old ``bot.ops``, ``bot.halfplus`` and
+``bot.voices`` are read-only views of the same data.
+
+Channels listed in the ``untracked_channels`` option of the ``[core]`` section
+are not tracked: the only member lpbot records in them is itself, so that its
+own privileges there are still known.
+
+The store is only changed from coretasks, on the inbound queue's thread, which
+dispatches the lines read from the server (see ``lpbot.inbound``); modules may
+read it from any thread.
+"""
+# Copyright 2014, Nikola Kovacevic, <nikolak@outlook.com>
+# Licensed under the Eiffel Forum License 2.
+
+from collections.abc import Mapping
+
+from lpbot.tools import Identifier
+
+
+def _key(name):
+    if not isinstance(name, Identifier):
+        name = Identifier(name)
+    return name.lower()
+
+
+class _Interned(object):
+    """A two-way mapping of names to small, reusable integer IDs."""
+
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+        self.members = []
+        self._free = []
+
+    def refold(self):
+        ids = {}
+        for index, name in enumerate(self.names):
+            if name is not None:
+                name = self.names[index] = Identifier(str(name))
+                ids[_key(name)] = index
+        self.ids = ids
+
+    def get(self, name):
+        return self.ids.get(_key(name))
+
+    def add(self, name):
+        key = _key(name)
+        index = self.ids.get(key)
+        if index is None:
+            if self._free:
+                index = self._free.pop()
+                self.names[index] = name
+            else:
+                index = len(self.names)
+                self.names.append(name)
+                self.members.append(set())
+            self.ids[key] = index
+        return index
+
+    def release(self, index):
+        del self.ids[_key(self.names[index])]
+        self.names[index] = None
+        self.members[index] = set()
+        self._free.append(index)
+
+
+class Memberships(object):
+    """The members of lpbot's channels, indexed by channel and by nick."""
+
+    def __init__(self, own_nick=None, untracked=()):
+        self.own_nick = own_nick
+        """A function returning lpbot's current nick, which is tracked even in
+        untracked channels."""
+        self._untracked = list(untracked)
+        self.untracked = set(_key(channel) for channel in untracked)
+        """The lower-cased names of the channels whose members aren't
+        tracked."""
+        self._users = _Interned()
+        self._channels = _Interned()
+        self._modes = []
+        self.privileges = _PrivilegesView(self)
+        """A read-only dictionary of channels to their users and privilege
+        levels, as exposed by ``bot.privileges``."""
+
+    def refold(self):
+        """Re-key the store after ``tools.set_casemapping`` has changed how
+        nicks and channels fold."""
+        self._users.refold()
+        self._channels.refold()
+        self.untracked = set(_key(Identifier(str(channel)))
+                             for channel in self._untracked)
+
+    def channels_of(self, nick):
+        """Return the set of channels ``nick`` shares with lpbot."""
+        user = self._users.get(nick)
+        if user is None:
+            return frozenset()
+        names = self._channels.names
+        # Copying the set is atomic, so the server thread can't change it
+        # under us; skip anything it has released in the meantime
+        return frozenset(names[channel] for channel in
+                         list(self._users.members[user])
+                         if names[channel] is not None)
+
+    def get(self, channel, nick, default=None):
+        """Return ``nick``'s privileges in ``channel``, or ``default``."""
+        channel = self._channels.get(channel)
+        user = self._users.get(nick)
+        if (channel is None or user is None or
+                user not in self._channels.members[channel]):
+            return default
+        return self._modes[channel].get(user, 0)
+
+    def with_privileges(self, channel, minimum):
+        """Return the set of members of ``channel`` with at least
+        ``minimum`` privileges."""
+        channel = self._channels.get(channel)
+        if channel is None:
+            return frozenset()
+        names = self._users.names
+        return frozenset(names[user] for user, privileges in
+                         list(self._modes[channel].items())
+                         if privileges >= minimum and names[user] is not None)
+
+    def add_channel(self, channel):
+        """Start tracking ``channel``, if it isn't tracked already."""
+        index = self._channels.add(channel)
+        if index == len(self._modes):
+            self._modes.append({})
+
+    def remove_channel(self, channel):
+        """Forget ``channel`` and everyone in it (when lpbot leaves it)."""
+        index = self._channels.get(channel)
+        if index is None:
+            return
+        members = self._users.members
+        for user in self._channels.members[index]:
+            members[user].discard(index)
+            if not members[user]:
+                self._users.release(user)
+        self._modes[index] = {}
+        self._channels.release(index)
+
+    def add(self, channel, nick, privileges=0):
+        """Record ``nick`` as being in ``channel`` with ``privileges``.
+
+        This is also how privileges are changed for someone who is already in
+        the channel.
+
+        """
+        if (_key(channel) in self.untracked and
+                (self.own_nick is None or nick != self.own_nick())):
+            return
+        self.add_channel(channel)
+        index = self._channels.get(channel)
+        user = self._users.add(nick)
+        self._channels.members[index].add(user)
+        self._users.members[user].add(index)
+        if privileges:
+            self._modes[index][user] = privileges
+        else:
+            self._modes[index].pop(user, None)
+
+    def remove(self, channel, nick):
+        """Record ``nick`` as having left ``channel``."""
+        index = self._channels.get(channel)
+        user = self._users.get(nick)
+        if index is None or user is None:
+            return
+        self._channels.members[index].discard(user)
+        self._modes[index].pop(user, None)
+        self._users.members[user].discard(index)
+        if not self._users.members[user]:
+            self._users.release(user)
+
+    def quit(self, nick):
+        """Remove ``nick`` from every channel, returning those it was in."""
+        user = self._users.get(nick)
+        if user is None:
+            return frozenset()
+        channels = []
+        for index in self._users.members[user]:
+            self._channels.members[index].discard(user)
+            self._modes[index].pop(user, None)
+            channels.append(self._channels.names[index])
+        self._users.release(user)
+        return frozenset(channels)
+
+    def rename(self, old, new):
+        """Move ``old``'s memberships to ``new``, returning the channels."""
+        user = self._users.get(old)
+        if user is None:
+            return frozenset()
+        if self._users.get(new) not in (None, user):
+            # Someone we thought was already using the nick; they can't be.
+            self.quit(new)
+        del self._users.ids[_key(old)]
+        self._users.ids[_key(new)] = user
+        self._users.names[user] = new
+        return self.channels_of(new)
+
+
+class _ChannelView(Mapping):
+    """The members of one channel, mapped to their privileges."""
+
+    def __init__(self, store, channel):
+        self._store = store
+        self._channel = channel
+
+    def __getitem__(self, nick):
+        privileges = self._store.get(self._channel, nick)
+        if privileges is None:
+            raise KeyError(nick)
+        return privileges
+
+    def __contains__(self, nick):
+        return self._store.get(self._channel, nick) is not None
+
+    def __iter__(self):
+        index = self._store._channels.get(self._channel)
+        if index is None:
+            return iter(())
+        names = self._store._users.names
+        return iter([names[user] for user in
+                     list(self._store._channels.members[index])
+                     if names[user] is not None])
+
+    def __len__(self):
+        index = self._store._channels.get(self._channel)
+        if index is None:
+            return 0
+        return len(self._store._channels.members[index])
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class _PrivilegesView(Mapping):
+    """Channels, mapped to ``_ChannelView``\\ s of their members."""
+
+    def __init__(self, store):
+        self._store = store
+
+    def __getitem__(self, channel):
+        if self._store._channels.get(channel) is None:
+            raise KeyError(channel)
+        return _ChannelView(self._store, channel)
+
+    def __contains__(self, channel):
+        return self._store._channels.get(channel) is not None
+
+    def __iter__(self):
+        return iter([name for name in self._store._channels.names
+                     if name is not None])
+
+    def __len__(self):
+        return len(self._store._channels.ids)
+
+    def __repr__(self):
+        return repr(dict((channel, dict(members))
+                         for channel, members in self.items()))
+
+
+class PrivilegeLevelView(Mapping):
+    """Channels, mapped to the set of their members with at least ``minimum``
+    privileges. This is what the old ``ops``, ``halfplus`` and ``voices``
+    dictionaries of ``irc.Bot`` are now."""
+
+    def __init__(self, store, minimum):
+        self._store = store
+        self._minimum = minimum
+
+    def __getitem__(self, channel):
+        if channel not in self._store.privileges:
+            raise KeyError(channel)
+        return self._store.with_privileges(channel, self._minimum)
+
+    def __iter__(self):
+        return iter(self._store.privileges)
+
+    def __len__(self):
+        return len(self._store.privileges)
@@ -4,12 +4,21 @@
 It defines the following decorators for defining lpbot callables:
 lpbot.module.rule
 lpbot.module.thread
+lpbot.module.concurrency
 lpbot.module.commands
 lpbot.module.nickname_commands
 lpbot.module.priority
 lpbot.module.event
+lpbot.module.observe
 lpbot.module.rate
 lpbot.module.example
+
+Callables may also be coroutine functions (``async def``). These don't take up
+a thread: they run as tasks on the event loop of the bot that got the line,
+so they mustn't block, and should await their network requests. ``bot.say``,
+``bot.reply``, ``bot.msg`` and the like never block, so they can be called
+from them as they are. Rate limits and error reports work as for any other
+callable.
 """
 # Copyright 2013, Ari Koivula, <ari@koivu.la>
 # Copyright © 2013, Elad Alfassa <elad@fedoraproject.org>
@@ -137,6 +146,23 @@ def thread(value):
     return add_attribute
 
 
+def concurrency(value):
+    """Decorator. Equivalent to func.concurrency = value.
+
+    Args:
+        value: How many calls of the function may run at once, on the bot's
+            worker threads. Calls beyond that wait for one to finish. By
+            default, only the limit on the whole module applies.
+
+    """
+
+    def add_attribute(function):
+        function.concurrency = value
+        return function
+
+    return add_attribute
+
+
 def commands(*command_list):
     """Decorator. Sets a command list for a callable.
 
@@ -218,6 +244,10 @@ def nickname_commands(*command_list):
         $              # EoL, so there are no partial matches.
         """.format(command='|'.join(command_list))
         function.rule.append(rule)
+        # So that the bot can index the rule by its commands
+        if not hasattr(function, '_nickname_commands'):
+            function._nickname_commands = {}
+        function._nickname_commands[rule] = command_list
         return function
 
     return add_attribute
@@ -262,6 +292,37 @@ def event(*event_list):
     return add_attribute
 
 
+def observe(*event_list):
+    """Decorator. Makes the function an observer of the given events.
+
+    An observer sees every line with one of the events (``PRIVMSG``, if none
+    are given), without any rule having to match it first. It is called with
+    the bot and the line's ``lpbot.trigger.PreTrigger``, rather than a
+    ``Trigger``; there is no match, and ``bot.say`` and ``bot.reply`` don't
+    know where to send to, so use ``bot.msg`` instead.
+
+    Observers which are also marked ``thread(False)`` are called straight
+    away, before any rules are tried, so they have to be quick. All the
+    others are called once the rules have been tried, one after the other in
+    the order the lines arrived, by the bot's worker pool. They wait in its
+    queue like threaded callables do, and are dropped the same way when it
+    overflows (see ``lpbot.workers``).
+
+    Args:
+        event_list: The events to observe, such as 'PRIVMSG' or 'JOIN'.
+
+    """
+
+    def add_attribute(function):
+        if not hasattr(function, "observe"):
+            function.observe = []
+        function.observe.extend(event.upper() for event in
+                                event_list or ('PRIVMSG',))
+        return function
+
+    return add_attribute
+
+
 def rate(value):
     """Decorator. Equivalent to func.rate = value.
 
@@ -8,7 +8,8 @@
 # Licensed under the Eiffel Forum License 2.
 
 
-from lpbot.module import commands, priority, example, event, rule
+from lpbot.module import commands, priority, example, observe
+from lpbot.trigger import is_admin
 from lpbot.tools import owner_only
 
 
@@ -123,22 +124,18 @@ def me(bot, trigger):
     bot.msg(channel, msg)
 
 
-@event('INVITE')
-@rule('.*')
-@priority('low')
-def invite_join(bot, trigger):
+@observe('INVITE')
+def invite_join(bot, message):
     """
     Join a channel lpbot is invited to, if the inviter is an admin.
     """
-    if not trigger.admin:
+    if not is_admin(bot.config, message.nick, message.host):
         return
-    bot.join(trigger.args[1])
+    bot.join(message.args[1])
 
 
-@event('KICK')
-@rule(r'.*')
-@priority('low')
-def hold_ground(bot, trigger):
+@observe('KICK')
+def hold_ground(bot, message):
     """
     This function monitors all kicks across all channels lpbot is in. If it
     detects that it is the one kicked it'll automatically join that channel.
@@ -147,8 +144,8 @@ def hold_ground(bot, trigger):
     annoying. Please use this with caution.
     """
     if bot.config.has_section('admin') and bot.config.admin.hold_ground:
-        channel = trigger.sender
-        if trigger.args[1] == bot.nick:
+        channel = message.sender
+        if message.args[1] == bot.nick:
             bot.join(channel)
 
 @owner_only
@@ -89,7 +89,7 @@ def setup(bot):
         bot.memory['chanlog_locks'] = lpbot.tools.lpbotMemoryWithDefault(threading.Lock)
 
 
-@lpbot.module.rule('.*')
+@lpbot.module.observe('PRIVMSG')
 @lpbot.module.unblockable
 def log_message(bot, message):
     "Log every message in a channel"
@@ -97,23 +97,21 @@ def log_message(bot, message):
     if message.sender.is_nick() and not bot.config.chanlogs.privmsg:
         return
 
-    # determine which template we want, message or action
-    if message.startswith("\001ACTION ") and message.endswith("\001"):
+    # determine which template we want, message or action; the CTCP
+    # has already been taken apart
+    if message.tags.get('intent') == 'ACTION':
         tpl = bot.config.chanlogs.action_template or ACTION_TPL
-        # strip off start and end
-        message = message[8:-1]
     else:
         tpl = bot.config.chanlogs.message_template or MESSAGE_TPL
 
-    logline = _format_template(tpl, bot, message, message=message)
+    logline = _format_template(tpl, bot, message, message=message.args[-1])
     fpath = get_fpath(bot, message)
     with bot.memory['chanlog_locks'][fpath]:
         with open(fpath, "a") as f:
             f.write(logline)
 
 
-@lpbot.module.rule('.*')
-@lpbot.module.event("JOIN")
+@lpbot.module.observe("JOIN")
 @lpbot.module.unblockable
 def log_join(bot, trigger):
     tpl = bot.config.chanlogs.join_template or JOIN_TPL
@@ -124,8 +122,7 @@ def log_join(bot, trigger):
             f.write(logline)
 
 
-@lpbot.module.rule('.*')
-@lpbot.module.event("PART")
+@lpbot.module.observe("PART")
 @lpbot.module.unblockable
 def log_part(bot, trigger):
     tpl = bot.config.chanlogs.part_template or PART_TPL
@@ -136,39 +133,53 @@ def log_part(bot, trigger):
             f.write(logline)
 
 
-@lpbot.module.rule('.*')
-@lpbot.module.event("QUIT")
+@lpbot.module.observe("QUIT")
 @lpbot.module.unblockable
 @lpbot.module.thread(False)
-@lpbot.module.priority('high')
 def log_quit(bot, trigger):
     tpl = bot.config.chanlogs.quit_template or QUIT_TPL
     logline = _format_template(tpl, bot, trigger)
-    # make a copy of bot.privileges that we can safely iterate over
-    privcopy = list(bot.privileges.items())
     # write logline to *all* channels that the user was present in
-    for channel, privileges in privcopy:
-        if trigger.nick in privileges:
-            fpath = get_fpath(bot, trigger, channel)
-            with bot.memory['chanlog_locks'][fpath]:
-                with open(fpath, "a") as f:
-                    f.write(logline)
+    for channel in bot.channels_of(trigger.nick):
+        fpath = get_fpath(bot, trigger, channel)
+        with bot.memory['chanlog_locks'][fpath]:
+            with open(fpath, "a") as f:
+                f.write(logline)
 
 
-@lpbot.module.rule('.*')
-@lpbot.module.event("NICK")
+@lpbot.module.observe("BATCH")
+@lpbot.module.unblockable
+def log_batch(bot, trigger):
+    """Log a whole netsplit or netjoin, opening each channel's log once."""
+    batch = trigger.batch
+    if batch is None:
+        return
+    if batch.type == 'netsplit':
+        tpl = bot.config.chanlogs.quit_template or QUIT_TPL
+    elif batch.type == 'netjoin':
+        tpl = bot.config.chanlogs.join_template or JOIN_TPL
+    else:
+        return
+    for channel, messages in batch.changes.items():
+        loglines = ''.join(_format_template(tpl, bot, message)
+                           for message in messages)
+        fpath = get_fpath(bot, trigger, channel)
+        with bot.memory['chanlog_locks'][fpath]:
+            with open(fpath, "a") as f:
+                f.write(loglines)
+
+
+@lpbot.module.observe("NICK")
 @lpbot.module.unblockable
 def log_nick_change(bot, trigger):
     tpl = bot.config.chanlogs.nick_template or NICK_TPL
     logline = _format_template(tpl, bot, trigger)
     old_nick = trigger.nick
     new_nick = trigger.sender
-    # make a copy of bot.privileges that we can safely iterate over
-    privcopy = list(bot.privileges.items())
     # write logline to *all* channels that the user is present in
-    for channel, privileges in privcopy:
-        if old_nick in privileges or new_nick in privileges:
-            fpath = get_fpath(bot, trigger, channel)
-            with bot.memory['chanlog_locks'][fpath]:
-                with open(fpath, "a") as f:
-                    f.write(logline)
+    channels = bot.channels_of(old_nick) | bot.channels_of(new_nick)
+    for channel in channels:
+        fpath = get_fpath(bot, trigger, channel)
+        with bot.memory['chanlog_locks'][fpath]:
+            with open(fpath, "a") as f:
+                f.write(logline)
@@ -9,7 +9,7 @@
 import re
 
 from lpbot.tools import Identifier, lpbotMemory
-from lpbot.module import rule, priority
+from lpbot.module import rule, priority, observe
 from lpbot.formatting import bold
 
 
@@ -17,24 +17,23 @@ def setup(bot):
     bot.memory['find_lines'] = lpbotMemory()
 
 
-@rule('.*')
-@priority('low')
-def collectlines(bot, trigger):
+@observe('PRIVMSG')
+def collectlines(bot, message):
     """Create a temporary log of what people say"""
 
     # Don't log things in PM
-    if trigger.is_privmsg:
+    if message.sender.is_nick():
         return
 
     # Add a log for the channel and nick, if there isn't already one
-    if trigger.sender not in bot.memory['find_lines']:
-        bot.memory['find_lines'][trigger.sender] = lpbotMemory()
-    if Identifier(trigger.nick) not in bot.memory['find_lines'][trigger.sender]:
-        bot.memory['find_lines'][trigger.sender][Identifier(trigger.nick)] = list()
+    if message.sender not in bot.memory['find_lines']:
+        bot.memory['find_lines'][message.sender] = lpbotMemory()
+    if Identifier(message.nick) not in bot.memory['find_lines'][message.sender]:
+        bot.memory['find_lines'][message.sender][Identifier(message.nick)] = list()
 
     # Create a temporary list of the user's lines in a channel
-    templist = bot.memory['find_lines'][trigger.sender][Identifier(trigger.nick)]
-    line = trigger.group()
+    templist = bot.memory['find_lines'][message.sender][Identifier(message.nick)]
+    line = message.args[-1]
     if line.startswith("s/"):  # Don't remember substitutions
         return
     elif line.startswith("\x01ACTION"):  # For /me messages
@@ -45,7 +44,7 @@ def collectlines(bot, trigger):
 
     del templist[:-10]  # Keep the log to 10 lines per person
 
-    bot.memory['find_lines'][trigger.sender][Identifier(trigger.nick)] = templist
+    bot.memory['find_lines'][message.sender][Identifier(message.nick)] = templist
 
 
 # Match nick, s/find/replace/flags. Flags and nick are optional, nick can be
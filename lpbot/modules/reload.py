@@ -73,7 +73,8 @@ def f_reload(bot, trigger):
     modified = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(mtime))
 
     bot.register(vars(module))
-    bot.bind_commands()
+    for connection in bot.connections():
+        connection.bind_commands()
 
     bot.reply('%r (version: %s)' % (module, modified))
 
@@ -137,7 +138,8 @@ def f_load(bot, trigger):
     if hasattr(module, 'setup'):
         module.setup(bot)
     bot.register(vars(module))
-    bot.bind_commands()
+    for connection in bot.connections():
+        connection.bind_commands()
 
     bot.reply('%r (version: %s)' % (module, modified))
 
@@ -9,7 +9,7 @@ import time
 import datetime
 
 from lpbot.tools import Ddict, Identifier, get_timezone, format_time
-from lpbot.module import commands, rule, priority
+from lpbot.module import commands, observe
 
 
 seen_dict = Ddict(dict)
@@ -39,11 +39,10 @@ def seen(bot, trigger):
         bot.say("Sorry, I haven't seen %s around." % nick)
 
 
-@rule('(.*)')
-@priority('low')
-def note(bot, trigger):
-    if not trigger.is_privmsg:
-        nick = Identifier(trigger.nick)
+@observe('PRIVMSG')
+def note(bot, message):
+    if not message.sender.is_nick():
+        nick = Identifier(message.nick)
         seen_dict[nick]['timestamp'] = time.time()
-        seen_dict[nick]['channel'] = trigger.sender
-        seen_dict[nick]['message'] = trigger
+        seen_dict[nick]['channel'] = message.sender
+        seen_dict[nick]['message'] = message.args[-1]
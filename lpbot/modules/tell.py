@@ -10,7 +10,7 @@ import threading
 import sys
 
 from lpbot.tools import Identifier, get_timezone, format_time
-from lpbot.module import commands, nickname_commands, rule, priority, example
+from lpbot.module import commands, nickname_commands, example, observe
 
 
 MAXIMUM = 4
@@ -134,8 +134,7 @@ def getReminders(bot, channel, key, tellee):
     return lines
 
 
-@rule('(.*)')
-@priority('low')
+@observe('PRIVMSG')
 def message(bot, trigger):
     tellee = trigger.nick
     channel = trigger.sender
@@ -154,10 +153,10 @@ def message(bot, trigger):
             reminders.extend(getReminders(bot, channel, remkey, tellee))
 
     for line in reminders[:MAXIMUM]:
-        bot.say(line)
+        bot.msg(channel, line)
 
     if reminders[MAXIMUM:]:
-        bot.say('Further messages sent privately')
+        bot.msg(channel, 'Further messages sent privately')
         for line in reminders[MAXIMUM:]:
             bot.msg(tellee, line)
 
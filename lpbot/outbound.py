@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""Outbound flood control.
+
+Nearly every ircd keeps a penalty timer per client: each line the client sends
+pushes the timer forward, the timer catches up with real time at one second
+per second, and a client which gets too far ahead is throttled, or in the worst
+case disconnected for flooding. ``OutboundScheduler`` keeps lpbot under that
+limit without any thread having to sleep, and shares the available budget
+fairly between everyone lpbot is talking to.
+
+The following ``[core]`` options tune it:
+
+``flood_burst``
+    How many penalty seconds lpbot may get ahead of the server's clock before
+    it starts holding lines back. Defaults to 10.
+``flood_refill``
+    How many penalty seconds the server forgives per second. Defaults to 1.
+"""
+# Copyright 2014, Nikola Kovacevic, <nikolak@outlook.com>
+# Licensed under the Eiffel Forum License 2.
+
+import threading
+import time
+from collections import deque, OrderedDict
+
+
+class TokenBucket(object):
+    """A penalty timer in the style of ircd flood control.
+
+    ``penalty`` is how far ahead of the clock the client is. Sending a line
+    adds its cost to it; time passing takes ``refill`` off per second. Lines
+    may be sent while ``penalty`` is at most ``burst``.
+
+    """
+
+    def __init__(self, burst=10.0, refill=1.0):
+        self.burst = burst
+        self.refill = refill
+        self.penalty = 0.0
+        self._last = time.monotonic()
+
+    @staticmethod
+    def cost(line):
+        """Return the penalty, in seconds, for sending ``line``."""
+        # One second per line, plus up to one more for long ones.
+        return 1.0 + len(line) / 512.0
+
+    def _update(self, now):
+        self.penalty = max(0.0, self.penalty -
+                           (now - self._last) * self.refill)
+        self._last = now
+
+    def delay(self, now=None):
+        """Return how many seconds to wait before another line can be sent."""
+        if now is None:
+            now = time.monotonic()
+        self._update(now)
+        if self.penalty <= self.burst:
+            return 0.0
+        return (self.penalty - self.burst) / self.refill
+
+    def consume(self, line, now=None):
+        """Account for ``line`` having been sent."""
+        if now is None:
+            now = time.monotonic()
+        self._update(now)
+        self.penalty += self.cost(line)
+
+    def reset(self):
+        self.penalty = 0.0
+        self._last = time.monotonic()
+
+
+class OutboundScheduler(object):
+    """Fair, non-blocking scheduler for lines going to the server.
+
+    Lines are queued per target (the channel or nick they are addressed to, or
+    ``None`` for lines which aren't addressed to anyone). Queues are drained
+    round-robin, one line (or one ``extend``) at a time, as the
+    ``TokenBucket`` allows, so a chatty channel can't starve the others. Lines queued with ``priority``
+    skip all of that and go out as soon as the event loop gets to them; they
+    still count against the bucket.
+
+    ``put`` may be called from any thread. Draining happens on ``loop``,
+    which has to be set (by ``attach``) before anything is sent; ``send`` is
+    then called on the loop's thread with each line as it's released.
+
+    """
+
+    def __init__(self, send, burst=10.0, refill=1.0):
+        self._send = send
+        self.bucket = TokenBucket(burst, refill)
+        self.loop = None
+        self._lock = threading.Lock()
+        self._priority = deque()
+        self._queues = OrderedDict()
+        self._scheduled = False
+        self._paused = False
+        self._timer = None
+
+    def attach(self, loop):
+        """Start sending on ``loop``, dropping anything left from before."""
+        with self._lock:
+            self.loop = loop
+            self._priority.clear()
+            self._queues.clear()
+            self._scheduled = False
+            self._paused = False
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        self.bucket.reset()
+
+    def put(self, line, target=None, priority=False):
+        """Queue ``line`` to be sent to the server."""
+        self.extend((line,), target, priority)
+
+    def extend(self, lines, target=None, priority=False):
+        """Queue several ``lines`` at once, with nothing in between them.
+
+        They are sent together, as soon as the bucket allows the first of
+        them, and all count against it.
+
+        """
+        with self._lock:
+            loop = self.loop
+            if loop is None or loop.is_closed():
+                return
+            if priority:
+                self._priority.extend(lines)
+            else:
+                self._queues.setdefault(target, deque()).append(tuple(lines))
+            if self._scheduled and not priority:
+                return
+            self._scheduled = True
+        try:
+            loop.call_soon_threadsafe(self.drain)
+        except RuntimeError:
+            # The loop was closed under us; the connection is gone anyway.
+            pass
+
+    def pause(self):
+        """Hold everything back until ``resume`` is called."""
+        self._paused = True
+
+    def resume(self):
+        """Carry on sending after ``pause``. Runs on the loop."""
+        self._paused = False
+        self.drain()
+
+    def pending(self, target=None):
+        """Return how many lines are waiting to be sent to ``target``."""
+        with self._lock:
+            return sum(len(lines) for lines in self._queues.get(target, ()))
+
+    def drain(self):
+        """Send everything the bucket allows right now. Runs on the loop."""
+        while True:
+            with self._lock:
+                if self._paused:
+                    # resume() will call us again
+                    self._scheduled = False
+                    return
+                if self._priority:
+                    lines = (self._priority.popleft(),)
+                elif not self._queues:
+                    self._scheduled = False
+                    return
+                else:
+                    delay = self.bucket.delay()
+                    if delay > 0:
+                        if self._timer is None:
+                            self._timer = self.loop.call_later(delay,
+                                                               self._wake)
+                        return
+                    target, queue = next(iter(self._queues.items()))
+                    lines = queue.popleft()
+                    if queue:
+                        # Go to the back of the line
+                        self._queues.move_to_end(target)
+                    else:
+                        del self._queues[target]
+            for line in lines:
+                self.bucket.consume(line)
+                self._send(line)
+
+    def _wake(self):
+        self._timer = None
+        self.drain()
+
+
+def split_text(text, budget, keep_space=False):
+    """Split ``text`` into pieces of at most ``budget`` bytes of UTF-8.
+
+    Pieces are broken at the last space that fits, and the space is dropped,
+    unless ``keep_space`` is given, in which case it stays at the end of the
+    piece before the break (so joining the pieces gives back ``text``). A
+    word which doesn't fit on its own is broken between characters; a
+    multibyte character is never split.
+
+    """
+    encoded = text.encode('utf-8')
+    pieces = []
+    while len(encoded) > budget:
+        if keep_space:
+            space = encoded.rfind(b' ', 0, budget)
+            end, start = space + 1, space + 1
+        else:
+            space = encoded.rfind(b' ', 1, budget + 1)
+            end, start = space, space + 1
+        if space == -1:
+            end = budget
+            # Back up to the first byte of the character we'd cut in half.
+            while end > 0 and (encoded[end] & 0xC0) == 0x80:
+                end -= 1
+            if end == 0:
+                # Not even one character fits; send it anyway, rather than
+                # never getting anywhere.
+                end = 1
+                while (end < len(encoded) and
+                       (encoded[end] & 0xC0) == 0x80):
+                    end += 1
+            start = end
+        pieces.append(encoded[:end].decode('utf-8'))
+        encoded = encoded[start:]
+    if encoded or not pieces:
+        pieces.append(encoded.decode('utf-8'))
+    return pieces
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""Background writer for the raw protocol log.
+
+Every line lpbot sends or receives goes to ``raw.log`` when ``core.log_raw``
+is enabled, so the writing is kept off the I/O thread: callers only put the
+formatted line on a queue, and a single thread keeps one buffered file handle
+open and writes whatever has piled up in one go.
+
+The following ``[core]`` options control rotation of the log:
+
+``log_raw_max_size``
+    Rotate ``raw.log`` once it grows past this many bytes. ``0`` (the default)
+    disables size based rotation.
+``log_raw_daily``
+    Rotate ``raw.log`` when the (UTC) day changes.
+``log_raw_compress``
+    gzip rotated files.
+"""
+# Copyright 2014, Nikola Kovacevic, <nikolak@outlook.com>
+# Licensed under the Eiffel Forum License 2.
+
+import gzip
+import os
+import queue
+import shutil
+import threading
+import time
+from datetime import datetime
+
+from lpbot.tools import stderr
+
+
+class RawLogWriter(threading.Thread):
+    """Write lines to a log file from a background thread.
+
+    ``write`` can be called from any thread and never touches the file
+    itself. Up to ``batch_size`` queued lines are written together and the
+    file is flushed once per batch. At most ``queue_size`` lines wait to be
+    written; any more are dropped, as are lines which come while the file
+    can't be opened. After a failure, opening or rotating the file is only
+    tried again after ``retry_delay`` seconds, doubling up to
+    ``max_retry_delay``.
+
+    """
+
+    batch_size = 512
+    retry_delay = 1.0
+    max_retry_delay = 60.0
+    report_interval = 60.0
+
+    def __init__(self, path, max_size=0, daily=False, compress=False,
+                 queue_size=10000):
+        threading.Thread.__init__(self, name='RawLogWriter')
+        self.daemon = True
+        self.path = path
+        self.max_size = max_size
+        self.daily = daily
+        self.compress = compress
+        self._queue = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._file = None
+        self._size = 0
+        self._day = None
+        self._delay = 0
+        self._retry_at = 0
+        self._reported = 0
+        self._reported_at = 0
+        self.dropped = 0
+        """How many lines were never written."""
+
+    def write(self, line):
+        """Queue ``line`` to be written. It should end with a newline."""
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            self._drop(1)
+
+    def stop(self):
+        """Write out everything queued so far, then stop the thread."""
+        self._queue.put(None)
+        self.join()
+
+    def run(self):
+        self._reopen()
+        running = True
+        while running:
+            lines = [self._queue.get()]
+            while len(lines) < self.batch_size:
+                try:
+                    lines.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in lines:
+                running = False
+                lines = [line for line in lines if line is not None]
+            try:
+                self._write(lines)
+            except Exception as e:
+                self._drop(len(lines))
+                stderr('Could not write to the raw log: %s' % e)
+            self._report_drops()
+        if self._file is not None:
+            self._file.close()
+
+    def _drop(self, count):
+        with self._lock:
+            self.dropped += count
+
+    def _report_drops(self):
+        now = time.monotonic()
+        if (self.dropped > self._reported and
+                now - self._reported_at >= self.report_interval):
+            stderr('The raw log has dropped %d lines so far' % self.dropped)
+            self._reported = self.dropped
+            self._reported_at = now
+
+    def _open(self):
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self._size = self._file.tell()
+        self._day = datetime.utcnow().date()
+
+    def _reopen(self):
+        """Open the log file, unless the last try failed too recently.
+        Returns whether it's open."""
+        if time.monotonic() < self._retry_at:
+            return False
+        try:
+            self._open()
+        except OSError as e:
+            self._failed('open', e)
+            return False
+        self._delay = 0
+        return True
+
+    def _failed(self, action, error):
+        """Put off trying to ``action`` the log again, for longer each time
+        it fails in a row."""
+        self._delay = min(self._delay * 2 or self.retry_delay,
+                          self.max_retry_delay)
+        self._retry_at = time.monotonic() + self._delay
+        stderr('Could not %s the raw log: %s; trying again in %ds' % (
+            action, error, self._delay))
+
+    def _write(self, lines):
+        if self._file is None and not self._reopen():
+            self._drop(len(lines))
+            return
+        if self._should_rotate():
+            self._rotate()
+            if self._file is None:
+                self._drop(len(lines))
+                return
+        data = ''.join(lines)
+        self._file.write(data)
+        self._file.flush()
+        # Close enough; the exact byte count only matters for rotation.
+        self._size += len(data)
+
+    def _should_rotate(self):
+        if time.monotonic() < self._retry_at:
+            return False
+        if self.max_size and self._size >= self.max_size:
+            return True
+        return self.daily and datetime.utcnow().date() != self._day
+
+    def _rotate(self):
+        """Move the log aside and start a new one. If it can't be moved, the
+        same file is opened again, and kept on with until the next try."""
+        self._file.close()
+        self._file = None
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime())
+        rotated = '%s.%s' % (self.path, stamp)
+        count = 0
+        while os.path.exists(rotated) or os.path.exists(rotated + '.gz'):
+            count += 1
+            rotated = '%s.%s.%d' % (self.path, stamp, count)
+        try:
+            os.rename(self.path, rotated)
+        except OSError as e:
+            self._failed('rotate', e)
+        else:
+            self._delay = 0
+            if self.compress:
+                self._compress(rotated)
+        try:
+            self._open()
+        except OSError as e:
+            self._failed('open', e)
+
+    def _compress(self, rotated):
+        try:
+            with open(rotated, 'rb') as source:
+                with gzip.open(rotated + '.gz', 'wb') as target:
+                    shutil.copyfileobj(source, target)
+        except OSError as e:
+            # The rotated file is still there, just not compressed
+            stderr('Could not compress %s: %s' % (rotated, e))
+            if os.path.exists(rotated + '.gz'):
+                os.remove(rotated + '.gz')
+            return
+        os.remove(rotated)
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""TLS for the server connection.
+
+asyncio's own TLS support can't resume a session, so lpbot runs TLS itself,
+over a plain TCP transport, with an ``ssl.SSLObject`` and a pair of memory
+BIOs. The ``ssl.SSLContext`` is built once per bot and the ``ssl.SSLSession``
+from the last connection is offered again on the next one, which turns the
+full handshake after a reconnect into an abbreviated one.
+
+The following ``[core]`` options are used, besides ``use_ssl``, ``verify_ssl``
+and ``ca_certs``:
+
+``client_cert_file``
+    A PEM file with a client certificate to present to the server, for
+    CertFP or SASL EXTERNAL. It may also contain the private key.
+``client_key_file``
+    The private key for ``client_cert_file``, if it's not in that file.
+"""
+# Copyright 2014, Nikola Kovacevic, <nikolak@outlook.com>
+# Licensed under the Eiffel Forum License 2.
+
+import os
+import ssl
+import time
+
+from lpbot.tools import stderr
+
+
+def create_context(verify=True, ca_certs=None, certfile=None, keyfile=None):
+    """Return a client ``ssl.SSLContext`` set up per lpbot's configuration."""
+    if verify:
+        context = ssl.create_default_context()
+        if ca_certs and os.path.isfile(ca_certs):
+            context.load_verify_locations(ca_certs)
+    else:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    if certfile:
+        context.load_cert_chain(certfile, keyfile)
+    return context
+
+
+class TLSConnection(object):
+    """The TLS state of a single connection, independent of any socket.
+
+    Ciphertext from the server goes into ``feed``, which returns whatever
+    plaintext it decrypted; plaintext for the server goes into ``encrypt``.
+    Both also produce ciphertext which has to be written to the server (the
+    return value of ``encrypt``, and ``outgoing`` after ``feed``).
+
+    """
+
+    read_size = 65536
+
+    def __init__(self, context, server_hostname, session=None):
+        self._incoming = ssl.MemoryBIO()
+        self._outgoing = ssl.MemoryBIO()
+        self.sslobj = context.wrap_bio(self._incoming, self._outgoing,
+                                       server_hostname=server_hostname,
+                                       session=session)
+        self.established = False
+        self._unwritten = b''
+        self.handshake_time = None
+        """How long the handshake took, in seconds, once it's done."""
+        self._started = None
+
+    @property
+    def session(self):
+        """The ``ssl.SSLSession`` to offer on the next connection."""
+        return self.sslobj.session
+
+    @property
+    def session_reused(self):
+        """Whether the server accepted the session we offered."""
+        return self.sslobj.session_reused
+
+    def start(self):
+        """Begin the handshake, returning the ClientHello to send."""
+        self._started = time.monotonic()
+        self._handshake()
+        return self.outgoing()
+
+    def outgoing(self):
+        """Return (and forget) the ciphertext waiting to go to the server."""
+        return self._outgoing.read()
+
+    def feed(self, data):
+        """Process ``data`` from the server.
+
+        Returns a tuple of the decrypted plaintext (possibly empty) and
+        whether this completed the handshake. Handshake failures, including
+        certificate verification, raise ``ssl.SSLError``.
+
+        """
+        self._incoming.write(data)
+        finished = False
+        if not self.established:
+            finished = self._handshake()
+            if not finished:
+                return b'', False
+        chunks = []
+        while True:
+            try:
+                chunk = self.sslobj.read(self.read_size)
+            except (ssl.SSLWantReadError, ssl.SSLZeroReturnError):
+                break
+            if not chunk:
+                break
+            chunks.append(chunk)
+        # Whatever couldn't be written before may go now that the server has
+        # answered; the caller sends it along with ``outgoing``.
+        self._write_unwritten()
+        return b''.join(chunks), finished
+
+    def encrypt(self, data):
+        """Return ``data`` encrypted for the server.
+
+        In the middle of a renegotiation, or before the server has answered a
+        post-handshake message, nothing can be written. ``data`` is then
+        kept, and written after the next ``feed``.
+
+        """
+        self._unwritten += data
+        self._write_unwritten()
+        return self.outgoing()
+
+    def _write_unwritten(self):
+        while self._unwritten:
+            try:
+                written = self.sslobj.write(self._unwritten)
+            except ssl.SSLWantReadError:
+                return
+            self._unwritten = self._unwritten[written:]
+
+    def close(self):
+        """Return a close_notify alert to send before closing the socket."""
+        try:
+            self.sslobj.unwrap()
+        except ssl.SSLError:
+            pass
+        return self.outgoing()
+
+    def _handshake(self):
+        try:
+            self.sslobj.do_handshake()
+        except ssl.SSLWantReadError:
+            return False
+        self.established = True
+        self.handshake_time = time.monotonic() - self._started
+        stderr('TLS handshake took %.3f seconds (%s, session %s)' % (
+            self.handshake_time, self.sslobj.version(),
+            'resumed' if self.session_reused else 'new'))
+        return True
@@ -154,40 +154,116 @@ class Ddict(dict):
         return dict.__getitem__(self, key)
 
 
+# Case folding tables for the CASEMAPPING values of RPL_ISUPPORT, applied after
+# str.lower(). Identifiers are folded with lower() and to the "[]\\~" side of
+# the RFC 1459 pairs, as they always have been, so that keys already in the
+# database (including those of non-ASCII nicks) stay the same.
+_casemappings = {
+    'ascii': {},
+}
+_casemappings['strict-rfc1459'] = dict(_casemappings['ascii'])
+_casemappings['strict-rfc1459'].update(str.maketrans('{}|', '[]\\'))
+_casemappings['rfc1459'] = dict(_casemappings['strict-rfc1459'])
+_casemappings['rfc1459'].update(str.maketrans('^', '~'))
+
+_interned = {}
+_network_casemappings = {}
+_casemapping_lock = threading.Lock()
+
+
+def set_casemapping(name, network=None):
+    """Make ``Identifier`` compare per the server's ``CASEMAPPING``.
+
+    ``name`` is one of ``ascii``, ``rfc1459`` or ``strict-rfc1459``, as
+    advertised by ``network``. Identifiers have a single casemapping for every
+    network lpbot is connected to, so if another network has already
+    advertised a different one, this leaves the current casemapping alone and
+    returns False. So does an unknown ``name``.
+
+    Identifiers made before a switch keep folding the old way, so dictionaries
+    keyed by them have to be re-keyed with ``refold``.
+
+    """
+    table = _casemappings.get(name)
+    if table is None:
+        return False
+    with _casemapping_lock:
+        others = set(mapping for other, mapping in
+                     _network_casemappings.items() if other != network)
+        if others and others != set([name]):
+            return False
+        _network_casemappings[network] = name
+        if table is not Identifier._table:
+            Identifier._table = table
+            Identifier.casemapping = name
+            # Everything interned so far was folded with the old table
+            _interned.clear()
+    return True
+
+
+def refold(mapping):
+    """Re-key the ``Identifier`` keys of ``mapping``, in place, after
+    ``set_casemapping`` has changed how they fold. If several keys now fold
+    the same, the last of them is kept."""
+    for key in list(mapping):
+        if isinstance(key, Identifier):
+            value = mapping.pop(key)
+            mapping[Identifier(str(key))] = value
+
+
 class Identifier(str):
     """A `str` subclass which acts appropriately for IRC identifiers.
 
     When used as normal `unicode` objects, case will be preserved.
     However, when comparing two Identifier objects, or comparing a Identifier
     object with a `unicode` object, the comparison will be case insensitive.
-    This case insensitivity includes the case convention conventions regarding
-    ``[]``, ``{}``, ``|``, ``\\``, ``^`` and ``~`` described in RFC 2812.
-	TODO: inheritance changed from unicode to str during removal of Py2 support and
+    This case insensitivity follows the server's ``CASEMAPPING`` (see
+    ``set_casemapping``), which defaults to the conventions regarding ``[]``,
+    ``{}``, ``|``, ``\\``, ``^`` and ``~`` described in RFC 2812.
+
+    Up to ``intern_size`` Identifiers are kept around, and creating one from
+    a string seen recently returns the same object again, already lowered.
+    TODO: inheritance changed from unicode to str during removal of Py2 support and
 	is as yet untested.
     """
 
+    _table = _casemappings['rfc1459']
+    casemapping = 'rfc1459'
+    """The name of the casemapping Identifiers are made with now."""
+    intern_size = 4096
+
     def __new__(cls, identifier):
         # According to RFC2812, identifiers have to be in the ASCII range.
         # However, I think it's best to let the IRCd determine that, and we'll
         # just assume unicode. It won't hurt anything, and is more internally
         # consistent. And who knows, maybe there's another use case for this
         # weird case convention.
+        if cls is Identifier:
+            if type(identifier) is Identifier:
+                return identifier
+            if type(identifier) is str:
+                s = _interned.get(identifier)
+                if s is not None:
+                    return s
+                if len(_interned) >= Identifier.intern_size:
+                    _interned.clear()
+                s = str.__new__(cls, identifier)
+                s._lowered = identifier.lower().translate(Identifier._table)
+                _interned[identifier] = s
+                return s
         s = str.__new__(cls, identifier)
         s._lowered = Identifier._lower(identifier)
         return s
 
     def lower(self):
-        """Return the identifier converted to lower-case per RFC 2812."""
+        """Return the identifier converted to lower-case per the server's
+        casemapping."""
         return self._lowered
 
     @staticmethod
     def _lower(identifier):
-        """Returns `identifier` in lower case per RFC 2812."""
-        # The tilde replacement isn't needed for identifiers, but is for
-        # channels, which may be useful at some point in the future.
-        low = identifier.lower().replace('{', '[').replace('}', ']')
-        low = low.replace('|', '\\').replace('^', '~')
-        return low
+        """Returns `identifier` in lower case per the server's casemapping."""
+        return str(identifier).lower().translate(Identifier._table)
 
     def __repr__(self):
         return "%s(%r)" % (
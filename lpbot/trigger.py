@@ -3,12 +3,40 @@
 import re
 import sys
 
+import lpbot.hostmask
 import lpbot.tools
 
 
-class PreTrigger:
+_tag_escapes = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+_tag_escape_regex = re.compile(r'\\(.?)', re.DOTALL)
+
+
+def _unescape_tag(value):
+    """Undo the IRCv3 escaping of a message tag's value."""
+    if '\\' not in value:
+        return value
+    # An unknown escape stands for the character itself, and a lone
+    # backslash at the end for nothing.
+    return _tag_escape_regex.sub(
+        lambda match: _tag_escapes.get(match.group(1), match.group(1)), value)
+
+
+_unset = object()
+
+
+class PreTrigger(object):
     """A parsed message from the server, which has not been matched against
-    any rules."""
+    any rules.
+
+    Most lines the server sends never match a rule, so only ``event`` and
+    ``args`` are worked out up front. ``tags``, the parts of the hostmask
+    and ``sender`` are worked out the first time they're used.
+
+    """
+    __slots__ = ('line', 'hostmask', 'event', 'args', 'batch', '_own_nick',
+                 '_tagstring', '_tags', '_intent', '_nick', '_user', '_host',
+                 '_sender')
+
     component_regex = re.compile(r'([^!]*)!?([^@]*)@?(.*)')
     intent_regex = re.compile('\x01(\\S+) (.*)\x01')
 
@@ -17,55 +45,175 @@ class PreTrigger:
         line is the full line from the server."""
         line = line.strip('\r')
         self.line = line
+        self._own_nick = own_nick
+        self._tags = None
+        self._intent = None
+        self._nick = None
+        self._sender = _unset
+        # Set on the line which ends a batch lpbot has collected
+        self.batch = None
 
-        # Break off IRCv3 message tags, if present
-        self.tags = {}
+        # IRCv3 message tags, then the source, then the command and its
+        # parameters, the last of which may contain spaces if it's preceded
+        # by a colon.
+        start = 0
+        self._tagstring = None
         if line.startswith('@'):
-            tagstring, line = line.split(' ', 1)
-            for tag in tagstring[1:].split(';'):
-                tag = tag.split('=', 1)
-                if len(tag) > 1:
-                    self.tags[tag[0]] = tag[1]
-                else:
-                    self.tags[tag[0]] = None
-
-        # TODO note what this is doing and why
-        if line.startswith(':'):
-            self.hostmask, line = line[1:].split(' ', 1)
+            start = line.index(' ') + 1
+            self._tagstring = line[1:start - 1]
+        self.hostmask = None
+        if line.startswith(':', start):
+            end = line.index(' ', start)
+            self.hostmask = line[start + 1:end]
+            start = end + 1
+        text = line.find(' :', start)
+        if text == -1:
+            args = line[start:].split(' ')
         else:
-            self.hostmask = None
+            args = line[start:text].split(' ')
+            args.append(line[text + 2:])
 
-        # TODO note what this is doing and why
-        if ' :' in line:
-            argstr, text = line.split(' :', 1)
-            self.args = argstr.split(' ')
-            self.args.append(text)
-        else:
-            self.args = line.split(' ')
-            self.text = self.args[-1]
+        # The first "argument" is really the command, which is what we call
+        # the event; the rest are the arguments to it.
+        self.event = args.pop(0)
+        self.args = args
 
-        self.event = self.args[0]
-        components = PreTrigger.component_regex.match(self.hostmask or '').groups()
-        self.nick, self.user, self.host = components
-        self.nick = lpbot.tools.Identifier(self.nick)
+        # Parse CTCP into a form consistent with IRCv3 intents
+        if (args and (self.event == 'PRIVMSG' or self.event == 'NOTICE') and
+                args[-1].startswith('\x01')):
+            intent_match = PreTrigger.intent_regex.match(args[-1])
+            if intent_match:
+                self._intent, args[-1] = intent_match.groups()
 
-        # If we have more than one argument, the second one is the sender
-        if len(self.args) > 1:
-            target = lpbot.tools.Identifier(self.args[1])
-        else:
-            target = None
+    @property
+    def text(self):
+        """The last argument, which is usually the message text."""
+        return self.args[-1] if self.args else None
 
-        # Unless we're messaging the bot directly, in which case that second
-        # arg will be our bot's name.
-        if target and target.lower() == own_nick.lower():
-            target = self.nick
-        self.sender = target
+    @property
+    def tags(self):
+        """A map of the IRCv3 message tags on the message."""
+        if self._tags is None:
+            tags = {}
+            if self._tagstring:
+                for tag in self._tagstring.split(';'):
+                    key, equals, value = tag.partition('=')
+                    tags[key] = _unescape_tag(value) if equals else None
+            if self._intent is not None:
+                tags['intent'] = self._intent
+            self._tags = tags
+        return self._tags
 
-        # Parse CTCP into a form consistent with IRCv3 intents
-        if self.event == 'PRIVMSG' or self.event == 'NOTICE':
-            intent_match = PreTrigger.intent_regex.match(self.args[-1])
-            if intent_match:
-                self.tags['intent'], self.args[-1] = intent_match.groups()
+    def _split_hostmask(self):
+        # Same as component_regex, without the regex
+        nick, _, userhost = (self.hostmask or '').partition('!')
+        self._user, _, self._host = userhost.partition('@')
+        self._nick = lpbot.tools.Identifier(nick)
+
+    @property
+    def nick(self):
+        if self._nick is None:
+            self._split_hostmask()
+        return self._nick
+
+    @property
+    def user(self):
+        if self._nick is None:
+            self._split_hostmask()
+        return self._user
+
+    @property
+    def host(self):
+        if self._nick is None:
+            self._split_hostmask()
+        return self._host
+
+    @property
+    def sender(self):
+        """The channel the message was sent to, or the nick which sent it if
+        it was sent to lpbot directly."""
+        if self._sender is _unset:
+            # If we have any arguments, the first one is the sender
+            if self.args:
+                target = lpbot.tools.Identifier(self.args[0])
+            else:
+                target = None
+
+            # Unless we're messaging the bot directly, in which case that
+            # second arg will be our bot's name.
+            if target and target.lower() == self._own_nick.lower():
+                target = self.nick
+            self._sender = target
+        return self._sender
+
+
+class Batch(object):
+    """An IRCv3 batch of messages, collected to be handled all at once.
+
+    The messages in a batch are not dispatched one by one. Instead, once the
+    batch ends, the ``BATCH`` line which ended it is dispatched with the whole
+    batch as its trigger's ``batch``.
+
+    """
+
+    def __init__(self, reference, type, params):
+        self.reference = reference
+        """The batch's reference tag, without the leading ``+``."""
+        self.type = type
+        """The type of the batch, e.g. ``netsplit`` or ``chathistory``."""
+        self.params = params
+        """The list of parameters the batch was started with."""
+        self.messages = []
+        """The messages in the batch, as ``PreTrigger`` objects, in order."""
+        self.changes = {}
+        """For ``netsplit`` and ``netjoin`` batches, maps each channel to the
+        messages of the people who left or joined it. Filled in by coretasks
+        once it has updated ``privileges``."""
+
+
+def is_admin(config, nick, host):
+    """Whether ``nick`` (at ``host``) is one of the bot's admins."""
+    admins = lpbot.hostmask.mask_set(config.core, 'admins',
+                                     lpbot.hostmask.compile_glob)
+    return nick in admins or '@'.join((nick, host)) in admins
+
+
+class TriggerLine(object):
+    """What every ``Trigger`` made from one line has in common.
+
+    ``LpBot.dispatch`` makes one of these per line, however many rules match
+    it; each ``Trigger`` only adds its own match. Whether the sender is an
+    admin is only worked out if something asks, and then only once.
+
+    """
+
+    __slots__ = ('message', 'network', 'text', '_config', '_admin')
+
+    def __init__(self, config, message, network=None):
+        self.message = message
+        """The ``PreTrigger`` of the line."""
+        self.network = network
+        """The name of the network the line came from, or ``None``."""
+        self.text = message.args[-1] if message.args else ''
+        """The text the rules are matched against."""
+        self._config = config
+        self._admin = None
+
+    @property
+    def sender(self):
+        return self.message.sender
+
+    @property
+    def nick(self):
+        return self.message.nick
+
+    @property
+    def admin(self):
+        """Whether the sender is one of the bot's admins."""
+        if self._admin is None:
+            message = self.message
+            self._admin = is_admin(self._config, message.nick, message.host)
+        return self._admin
 
 
 class Trigger(str):
@@ -74,71 +222,113 @@ class Trigger(str):
     Note that CTCP messages (`PRIVMSG`es and `NOTICE`es which start and end
     with `'\\x01'`) will have the `'\\x01'` bytes stripped, and the command
     (e.g. `ACTION`) placed mapped to the `'intent'` key in `Trigger.tags`.
+
+    Everything but the match comes from the line's ``TriggerLine``, which is
+    made here if it isn't given.
     """
 
-    def __new__(cls, config, message, match):
-        self = str.__new__(cls, message.args[-1])
-        self.sender = message.sender
-        # TODO docstring for sender
-        self.raw = message.line
+    def __new__(cls, config, message, match, network=None, line=None):
+        if line is None:
+            line = TriggerLine(config, message, network)
+        self = str.__new__(cls, line.text)
+        self._line = line
+        self.match = match
+        """
+        The regular expression ``MatchObject_`` for the triggering line.
+        .. _MatchObject: http://docs.python.org/library/re.html#match-objects
+        """
+        return self
+
+    @property
+    def network(self):
+        """The name of the network the message came from, when lpbot is
+        connected to several, or ``None``."""
+        return self._line.network
+
+    @property
+    def sender(self):
+        """The channel the message was sent to, or the nick of whoever sent
+        it, if it was sent to lpbot directly."""
+        return self._line.message.sender
+
+    @property
+    def raw(self):
         """The entire message, as sent from the server. This includes the CTCP
         \\x01 bytes and command, if they were included."""
+        return self._line.message.line
 
-        self.is_privmsg = message.sender.is_nick()
+    @property
+    def is_privmsg(self):
         """True if the trigger is from a user, False if it's from a channel."""
+        return self._line.message.sender.is_nick()
 
-        self.hostmask = message.hostmask
+    @property
+    def hostmask(self):
         """
         Hostmask of the person who sent the message in the form
         <nick>!<user>@<host>
         """
-        self.user = message.user
+        return self._line.message.hostmask
+
+    @property
+    def user(self):
         """Local username of the person who sent the message"""
-        self.nick = message.nick
+        return self._line.message.user
+
+    @property
+    def nick(self):
         """The ``Identifier`` of the person who sent the message."""
-        self.host = message.host
+        return self._line.message.nick
+
+    @property
+    def host(self):
         """The hostname of the person who sent the message"""
-        self.event = message.event
+        return self._line.message.host
+
+    @property
+    def event(self):
         """
         The IRC event (e.g. ``PRIVMSG`` or ``MODE``) which triggered the
         message."""
-        self.match = match
-        """
-        The regular expression ``MatchObject_`` for the triggering line.
-        .. _MatchObject: http://docs.python.org/library/re.html#match-objects
-        """
-        self.group = match.group
+        return self._line.message.event
+
+    @property
+    def group(self):
         """The ``group`` function of the ``match`` attribute.
 
         See Python ``re_`` documentation for details."""
-        self.groups = match.groups
+        return self.match.group
+
+    @property
+    def groups(self):
         """The ``groups`` function of the ``match`` attribute.
 
         See Python ``re_`` documentation for details."""
-        self.args = message.args
+        return self.match.groups
+
+    @property
+    def args(self):
         """
         A tuple containing each of the arguments to an event. These are the
         strings passed between the event name and the colon. For example,
         setting ``mode -m`` on the channel ``#example``, args would be
         ``('#example', '-m')``
         """
-        self.tags = message.tags
+        return self._line.message.args
+
+    @property
+    def tags(self):
         """A map of the IRCv3 message tags on the message."""
+        return self._line.message.tags
 
-        def match_host_or_nick(pattern):
-            pattern = lpbot.tools.get_hostmask_regex(pattern)
-            return bool(
-                pattern.match(self.nick) or
-                pattern.match('@'.join((self.nick, self.host)))
-            )
+    @property
+    def batch(self):
+        """The ``Batch`` this ``BATCH`` line ended, or ``None``."""
+        return self._line.message.batch
 
-        self.admin = any(match_host_or_nick(item)
-                         for item in config.core.get_list('admins'))
+    @property
+    def admin(self):
         """
         True if the nick which triggered the command is one of the bot's admins.
         """
-        #self.owner = match_host_or_nick(config.core.owner) and lpbot.tools.lpbotMemory().get('owner_auth', False)
-        """True if the nick which triggered the command is the bot's owner."""
-        self.admin = self.admin #or self.owner
-
-        return self
+        return self._line.admin
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""A bounded pool of threads for lpbot's threaded callables.
+
+Callables run on a thread of their own unless they are marked
+``thread(False)``, and so do interval jobs. They used to get a brand new
+thread for every call, so a burst of lines could start hundreds of threads at
+once. ``WorkerPool`` runs them on a bounded number of threads instead. Calls
+wait in a queue until a thread is free and their module (and the callable
+itself) is under its limit.
+
+Calls may also be given a key, such as the channel a line came from. Calls
+with the same key run one at a time, in the order they were submitted, while
+calls with different keys run in parallel.
+
+The following ``[core]`` options tune it:
+
+``workers``
+    How many threads the pool may have. Defaults to 16.
+``module_workers``
+    How many calls of one module's callables may run at once. Defaults to 8.
+``worker_queue``
+    How many calls may be waiting for a thread. Defaults to 500.
+``ordered_channels``
+    If true, the threaded callables triggered in one channel (or by one
+    nick, in private) run one at a time, in the order of the lines which
+    triggered them. Different channels still run in parallel. Defaults to
+    false.
+``worker_overflow``
+    What to do with a call when the queue is full: ``drop`` it (the default),
+    ``coalesce`` it with a waiting call of the same callable, or ``block``
+    until there is room. A coalesced call takes the place of the first
+    waiting one in the queue, if they have the same key; otherwise that one is
+    dropped and the new call goes to the end. Without a waiting call to
+    coalesce with, it is dropped. Blocking holds up whoever submitted the
+    call, usually the thread which reads from the server.
+
+A callable's own limit is set with ``lpbot.module.concurrency``.
+"""
+# Copyright 2014, Nikola Kovacevic, <nikolak@outlook.com>
+# Licensed under the Eiffel Forum License 2.
+
+import threading
+import time
+from collections import deque
+
+from lpbot.logger import get_logger
+
+LOGGER = get_logger(__name__)
+
+
+class _Call(object):
+    __slots__ = ('func', 'module', 'target', 'args', 'key', 'queued')
+
+    def __init__(self, func, target, args, key):
+        self.func = func
+        self.module = getattr(func, '__module__', None)
+        self.target = target
+        self.args = args
+        self.key = key
+        self.queued = time.monotonic()
+
+
+class WorkerPool(object):
+    """Runs calls on at most ``workers`` threads, which are started as they
+    are needed and then kept.
+
+    """
+
+    policies = ('drop', 'coalesce', 'block')
+
+    def __init__(self, workers=16, module_workers=8, queue_size=500,
+                 overflow='drop'):
+        if overflow not in self.policies:
+            raise ValueError('worker_overflow must be one of %s, not %r' % (
+                ', '.join(self.policies), overflow))
+        self.workers = workers
+        self.module_workers = module_workers
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self._lock = threading.Lock()
+        self._work = threading.Condition(self._lock)
+        self._room = threading.Condition(self._lock)
+        self._pending = deque()
+        self._waiting = {}
+        self._running = {}
+        self._keys = {}
+        self._busy = set()
+        self._threads = []
+        self._idle = 0
+        self.submitted = 0
+        """How many calls have been queued."""
+        self.completed = 0
+        """How many calls have finished."""
+        self.dropped = 0
+        """How many calls were dropped because the queue was full."""
+        self.coalesced = 0
+        """How many calls were merged into one already waiting."""
+        self.max_depth = 0
+        """The most calls which have been waiting at once."""
+        self.wait_total = 0.0
+        """How long, in seconds, calls have waited for a thread in all."""
+        self.wait_max = 0.0
+        """The longest any call has waited for a thread, in seconds."""
+
+    def submit(self, func, target, args=(), key=None, coalesce=False,
+               force=False):
+        """Have a worker call ``target(*args)`` for the callable ``func``.
+
+        If ``key`` isn't ``None``, the call only starts once every call
+        submitted before it with the same ``key`` has finished. With
+        ``coalesce``, the call is left out if ``func`` already has one
+        waiting, as for interval jobs. With ``force``, it is queued even if
+        the queue is full. Returns whether the call was queued.
+
+        """
+        call = _Call(func, target, args, key)
+        with self._lock:
+            if coalesce and self._waiting.get(func):
+                self.coalesced += 1
+                return False
+            while len(self._pending) >= self.queue_size and not force:
+                if self.overflow == 'block':
+                    self._room.wait()
+                    continue
+                if self.overflow == 'coalesce' and self._waiting.get(func):
+                    for index, older in enumerate(self._pending):
+                        if older.func is func:
+                            break
+                    if older.key == key:
+                        # Its turn among the calls with the key is the
+                        # older call's, so it runs where that one would have
+                        self._pending[index] = call
+                        self.coalesced += 1
+                        return True
+                    del self._pending[index]
+                    self._waiting[func] -= 1
+                    self._release_key(older.key)
+                    self.coalesced += 1
+                    break
+                self.dropped += 1
+                if self.dropped % 100 == 1:
+                    LOGGER.warning(
+                        'Worker queue is full; dropped %d calls so far, '
+                        'the last of %s.%s', self.dropped, call.module,
+                        getattr(func, '__name__', func))
+                return False
+            self._pending.append(call)
+            self._waiting[func] = self._waiting.get(func, 0) + 1
+            first = True
+            if key is not None:
+                # Counts the calls with the key which are waiting or running
+                first = not self._keys.get(key)
+                self._keys[key] = self._keys.get(key, 0) + 1
+            self.submitted += 1
+            self.max_depth = max(self.max_depth, len(self._pending))
+            if first and self._allowed(call):
+                if self._idle:
+                    self._idle -= 1
+                    self._work.notify()
+                elif len(self._threads) < self.workers:
+                    self._start_worker()
+        return True
+
+    def metrics(self):
+        """Return a dictionary of the pool's counters, with the current queue
+        depth, thread count and mean wait for a thread."""
+        with self._lock:
+            started = self.submitted - len(self._pending)
+            return {
+                'depth': len(self._pending),
+                'threads': len(self._threads),
+                'busy': len(self._threads) - self._idle,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'dropped': self.dropped,
+                'coalesced': self.coalesced,
+                'max_depth': self.max_depth,
+                'wait_mean': self.wait_total / started if started else 0.0,
+                'wait_max': self.wait_max,
+            }
+
+    def _allowed(self, call):
+        if self._running.get(call.module, 0) >= self.module_workers:
+            return False
+        limit = getattr(call.func, 'concurrency', None)
+        return limit is None or self._running.get(call.func, 0) < limit
+
+    def _next(self):
+        """Take the first waiting call which may run now, or ``None``."""
+        # Keys with a call running or held back; later calls with them wait
+        held = self._busy
+        for index, call in enumerate(self._pending):
+            if call.key is not None and call.key in held:
+                continue
+            if self._allowed(call):
+                del self._pending[index]
+                return call
+            if call.key is not None:
+                if held is self._busy:
+                    held = set(held)
+                held.add(call.key)
+        return None
+
+    def _release_key(self, key):
+        if key is not None:
+            self._keys[key] -= 1
+            if not self._keys[key]:
+                del self._keys[key]
+
+    def _start_worker(self):
+        thread = threading.Thread(target=self._run,
+                                  name='worker-%d' % len(self._threads))
+        thread.daemon = True
+        self._threads.append(thread)
+        thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                call = self._next()
+                while call is None:
+                    self._idle += 1
+                    self._work.wait()
+                    call = self._next()
+                self._waiting[call.func] -= 1
+                if not self._waiting[call.func]:
+                    del self._waiting[call.func]
+                for key in (call.module, call.func):
+                    self._running[key] = self._running.get(key, 0) + 1
+                if call.key is not None:
+                    self._busy.add(call.key)
+                waited = time.monotonic() - call.queued
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+                self._room.notify()
+            try:
+                call.target(*call.args)
+            except Exception:
+                # Callables catch their own errors; this would be lpbot's
+                LOGGER.exception('Error in worker')
+            finally:
+                with self._lock:
+                    for key in (call.module, call.func):
+                        self._running[key] -= 1
+                        if not self._running[key]:
+                            del self._running[key]
+                    if call.key is not None:
+                        self._busy.discard(call.key)
+                        self._release_key(call.key)
+                        if self._keys.get(call.key) and self._idle:
+                            # The next call with the key may start now; this
+                            # thread takes one itself, so wake another.
+                            self._idle -= 1
+                            self._work.notify()
+                    self.completed += 1
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""Compare the speed of lpbot's PreTrigger with the eager parser it replaced.
+
+Usage: python test/bench_pretrigger.py [raw.log ...]
+
+The corpus is the lines lpbot received (the ``<<`` lines) in the given raw
+logs, or a small sample of typical traffic if none are given. Each parser is
+timed twice: once touching only what dispatch needs for a line which matches
+no rule, and once touching everything a Trigger would.
+"""
+from __future__ import print_function, unicode_literals
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import lpbot.tools
+from lpbot.trigger import PreTrigger
+
+SAMPLE = [
+    ':irc.example.net 001 lpbot :Welcome to the Example IRC Network',
+    ':irc.example.net 005 lpbot CHANTYPES=# PREFIX=(ov)@+ NETWORK=Example '
+    ':are supported by this server',
+    ':irc.example.net 353 lpbot = #lpbot :lpbot @alice +bob carol dave',
+    'PING :irc.example.net',
+    ':alice!~alice@example.com PRIVMSG #lpbot :hello everyone',
+    ':bob!bob@gateway/web/cgi-irc PRIVMSG #lpbot :.weather London',
+    ':carol!~c@203.0.113.7 PRIVMSG lpbot :\x01VERSION\x01',
+    ':dave!dave@example.org PRIVMSG #lpbot :\x01ACTION waves\x01',
+    ':erin!erin@example.org JOIN #lpbot',
+    ':frank!f@example.org PART #lpbot :Leaving',
+    ':grace!g@example.org QUIT :Ping timeout: 240 seconds',
+    ':heidi!h@example.org NICK heidi_away',
+    ':alice!~alice@example.com MODE #lpbot +v erin',
+    '@time=2014-09-01T12:00:00.000Z;account=ivan :ivan!i@example.org '
+    'PRIVMSG #lpbot :tagged message with a time',
+    '@msgid=abc\\:def;+draft/reply=xyz :judy!j@example.org NOTICE #lpbot '
+    ':a reply\\sto something',
+] * 20
+
+
+class EagerPreTrigger:
+    """The PreTrigger parser as it was, which did everything up front."""
+    component_regex = re.compile(r'([^!]*)!?([^@]*)@?(.*)')
+    intent_regex = re.compile('\x01(\\S+) (.*)\x01')
+
+    def __init__(self, own_nick, line):
+        line = line.strip('\r')
+        self.line = line
+
+        self.tags = {}
+        if line.startswith('@'):
+            tagstring, line = line.split(' ', 1)
+            for tag in tagstring[1:].split(';'):
+                tag = tag.split('=', 1)
+                if len(tag) > 1:
+                    self.tags[tag[0]] = tag[1]
+                else:
+                    self.tags[tag[0]] = None
+
+        if line.startswith(':'):
+            self.hostmask, line = line[1:].split(' ', 1)
+        else:
+            self.hostmask = None
+
+        if ' :' in line:
+            argstr, text = line.split(' :', 1)
+            self.args = argstr.split(' ')
+            self.args.append(text)
+        else:
+            self.args = line.split(' ')
+            self.text = self.args[-1]
+
+        self.event = self.args.pop(0)
+        components = EagerPreTrigger.component_regex.match(
+            self.hostmask or '').groups()
+        self.nick, self.user, self.host = components
+        self.nick = lpbot.tools.Identifier(self.nick)
+
+        if self.args:
+            target = lpbot.tools.Identifier(self.args[0])
+        else:
+            target = None
+        if target and target.lower() == own_nick.lower():
+            target = self.nick
+        self.sender = target
+
+        if self.args and (self.event == 'PRIVMSG' or self.event == 'NOTICE'):
+            intent_match = EagerPreTrigger.intent_regex.match(self.args[-1])
+            if intent_match:
+                self.tags['intent'], self.args[-1] = intent_match.groups()
+        self.batch = None
+
+
+def read_corpus(paths):
+    lines = []
+    for path in paths:
+        with open(path, encoding='utf-8', errors='replace') as log:
+            for line in log:
+                if line.startswith('<<'):
+                    lines.append(line.split('\t', 1)[1].rstrip('\n'))
+    return lines
+
+
+def dispatch_only(parser, nick, corpus):
+    for line in corpus:
+        message = parser(nick, line)
+        message.event, message.args[-1:]
+
+
+def everything(parser, nick, corpus):
+    for line in corpus:
+        message = parser(nick, line)
+        (message.event, message.args, message.tags, message.nick,
+         message.user, message.host, message.sender)
+
+
+def main(paths):
+    corpus = read_corpus(paths) if paths else SAMPLE
+    nick = lpbot.tools.Identifier('lpbot')
+    number = max(1, 200000 // len(corpus))
+    print('%d lines, %d rounds' % (len(corpus), number))
+    for name, access in (('dispatch only', dispatch_only),
+                         ('every attribute', everything)):
+        # Take turns, so that both see the same noise from the machine
+        best = [float('inf'), float('inf')]
+        for _ in range(5):
+            for index, parser in enumerate((EagerPreTrigger, PreTrigger)):
+                seconds = timeit.timeit(
+                    lambda: access(parser, nick, corpus), number=number)
+                best[index] = min(best[index], seconds)
+        results = [seconds / (number * len(corpus)) * 1e6 for seconds in best]
+        print('%-16s eager %.2f us/line, lazy %.2f us/line (%.1fx)' % (
+            name, results[0], results[1], results[0] / results[1]))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""Tests for lpbot.bot"""
+from __future__ import unicode_literals
+
+import asyncio
+import inspect
+import sys
+import threading
+from collections import OrderedDict
+
+# lpbot.module can't be the first of them to be imported
+from lpbot.bot import LpBot, shard_index
+from lpbot import module
+from lpbot.membership import Memberships
+from lpbot.tools import Identifier
+from lpbot.trigger import PreTrigger
+from lpbot.workers import WorkerPool
+
+
+def test_shard_index_is_stable():
+    channels = ['#channel%d' % number for number in range(200)]
+    three = [shard_index(channel, 3) for channel in channels]
+    assert three == [shard_index(channel, 3) for channel in channels]
+    assert set(three) == set([0, 1, 2])
+    # Case doesn't matter, as for any channel name
+    assert shard_index('#Channel7', 3) == shard_index('#channel7', 3)
+    # A fourth shard only takes channels; nothing moves between the others
+    four = [shard_index(channel, 4) for channel in channels]
+    for before, after in zip(three, four):
+        assert after in (before, 3)
+
+
+class MockShard(object):
+    broadcast_window = LpBot.broadcast_window
+    _is_broadcast_duplicate = LpBot._is_broadcast_duplicate
+
+    def __init__(self, shard, broadcasts, lock):
+        self.shard = shard
+        self._broadcasts = broadcasts
+        self._broadcasts_lock = lock
+
+
+def test_broadcasts_are_seen_once_per_event():
+    broadcasts, lock = OrderedDict(), threading.Lock()
+    first, second = (MockShard(0, broadcasts, lock),
+                     MockShard(1, broadcasts, lock))
+    quit = PreTrigger('lpbot', ':nick!u@h QUIT :Quit: bye')
+    assert not first._is_broadcast_duplicate(quit)
+    assert second._is_broadcast_duplicate(quit)
+    # The same shard seeing it again means the nick quit again
+    assert not first._is_broadcast_duplicate(quit)
+    assert second._is_broadcast_duplicate(quit)
+    # Tags don't make it a different line
+    tagged = PreTrigger('lpbot', '@time=x :other!u@h NICK :new')
+    assert not second._is_broadcast_duplicate(tagged)
+    assert first._is_broadcast_duplicate(
+        PreTrigger('lpbot', '@time=y :other!u@h NICK :new'))
+    # Old lines are forgotten, oldest first
+    first.broadcast_window = second.broadcast_window = -1
+    assert not second._is_broadcast_duplicate(quit)
+    assert list(broadcasts) == [(quit.hostmask, 'QUIT', tuple(quit.args))]
+
+
+class MockCore(object):
+    def get_list(self, name):
+        return ['boss'] if name == 'admins' else []
+
+
+class MockConfig(object):
+    core = MockCore()
+
+
+class MockMember(object):
+    channels_of = LpBot.channels_of
+
+    def __init__(self, shards):
+        self.shards = shards
+        self.shards.append(self)
+        self.memberships = Memberships()
+
+
+def test_channels_of_covers_every_shard():
+    shards = []
+    first, second = MockMember(shards), MockMember(shards)
+    first.memberships.add(Identifier('#a'), Identifier('alice'))
+    second.memberships.add(Identifier('#b'), Identifier('alice'))
+    second.memberships.add(Identifier('#c'), Identifier('bob'))
+    # Whichever shard passes the QUIT on, it applies to all of them
+    assert first.channels_of(Identifier('Alice')) == {'#a', '#b'}
+    assert second.channels_of(Identifier('bob')) == {'#c'}
+    assert first.memberships.channels_of(Identifier('bob')) == set()
+
+
+class MockObserving(object):
+    _notify_observers = LpBot._notify_observers
+    _queue_observers = LpBot._queue_observers
+    _observe = LpBot._observe
+    network = None
+    shard = 0
+
+    def __init__(self, observers, **workers):
+        self.config = MockConfig()
+        self.observers = observers
+        self.workers = WorkerPool(**workers)
+        self.errors = 0
+
+    def limit(self, trigger, func):
+        return False
+
+    def error(self, trigger=None):
+        self.errors += 1
+
+
+def observer(seen, name, *events, **attributes):
+    def func(bot, pretrigger):
+        seen.append((name, pretrigger.args[-1]))
+        if name == 'broken':
+            raise ValueError(name)
+    func.__module__ = attributes.pop('module', 'test')
+    func.thread = attributes.pop('thread', True)
+    func.unblockable = attributes.pop('unblockable', False)
+    func.priority = 'medium'
+    return module.observe(*events)(func)
+
+
+def test_observe_defaults_to_privmsg():
+    func = module.observe()(lambda bot, pretrigger: None)
+    assert func.observe == ['PRIVMSG']
+    module.observe('join', 'Part')(func)
+    assert func.observe == ['PRIVMSG', 'JOIN', 'PART']
+
+
+def test_observers_see_lines_without_rules():
+    seen = []
+    quick = observer(seen, 'quick', thread=False)
+    broken = observer(seen, 'broken')
+    slow = observer(seen, 'slow')
+    bot = MockObserving({'PRIVMSG': [broken, quick, slow]})
+    line = PreTrigger('lpbot', ':nick!u@h PRIVMSG #a :hello')
+    # Quick observers are called straight away, the rest are handed back
+    assert bot._notify_observers(line, False, False) == [broken, slow]
+    assert seen == [('quick', 'hello')]
+    bot._queue_observers([broken, slow], line)
+    bot._queue_observers([slow], PreTrigger(
+        'lpbot', ':nick!u@h PRIVMSG #a :again'))
+    while len(seen) < 4:
+        threading.Event().wait(0.01)
+    # In order, on the workers, and an error doesn't stop the others
+    assert seen[1:] == [('broken', 'hello'), ('slow', 'hello'),
+                        ('slow', 'again')]
+    assert bot.errors == 1
+
+
+def test_slow_observers_overflow_the_worker_queue():
+    release = threading.Event()
+    seen = []
+
+    def slow(bot, pretrigger):
+        release.wait()
+        seen.append(pretrigger.args[-1])
+    slow.__module__ = 'test'
+    bot = MockObserving({}, queue_size=2)
+    for number in range(5):
+        bot._queue_observers([slow], PreTrigger(
+            'lpbot', ':nick!u@h PRIVMSG #a :%d' % number))
+        while not number and bot.workers.metrics()['depth']:
+            threading.Event().wait(0.01)
+    # One is running and two wait; the rest don't pile up behind them
+    assert bot.workers.metrics()['dropped'] == 2
+    release.set()
+    while bot.workers.metrics()['completed'] < 3:
+        threading.Event().wait(0.01)
+    assert seen == ['0', '1', '2']
+
+
+def test_observers_respect_blocks_and_broadcasts():
+    seen = []
+    plain = observer(seen, 'plain', 'QUIT', thread=False)
+    unblockable = observer(seen, 'unblockable', 'QUIT', thread=False,
+                           unblockable=True)
+    core = observer(seen, 'core', 'QUIT', thread=False, unblockable=True,
+                    module='coretasks')
+    bot = MockObserving({'QUIT': [plain, unblockable, core]})
+    line = PreTrigger('lpbot', ':nick!u@h QUIT :bye')
+    assert bot._notify_observers(line, True, False) == []
+    assert seen == [('unblockable', 'bye'), ('core', 'bye')]
+    # Blocks don't apply to admins
+    del seen[:]
+    bot._notify_observers(PreTrigger('lpbot', ':boss!u@h QUIT :bye'),
+                          True, False)
+    assert [name for name, _ in seen] == ['plain', 'unblockable', 'core']
+    # Only coretasks hears about a line another shard has already had
+    del seen[:]
+    bot._notify_observers(line, False, True)
+    assert seen == [('core', 'bye')]
+
+
+class MockTrigger(object):
+    nick = 'nick'
+    sender = '#a'
+    admin = False
+
+
+class MockCaller(object):
+    call = LpBot.call
+    call_async = LpBot.call_async
+    _await_call = LpBot._await_call
+    _rate_limited = LpBot._rate_limited
+    _record_call = LpBot._record_call
+
+    def __init__(self):
+        self.times = {}
+        self.errors = []
+        self.coroutines = []
+
+    def error(self, trigger=None):
+        self.errors.append(trigger)
+
+    def run_coroutine(self, coroutine):
+        # Not connected, so there's no loop to run it on
+        self.coroutines.append(coroutine)
+        coroutine.close()
+        return False
+
+
+def async_callable(result=None, rate=0):
+    calls = []
+
+    async def func(bot, trigger):
+        calls.append(trigger)
+        await asyncio.sleep(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+    func.rate = rate
+    func.unblockable = False
+    func.calls = calls
+    return func
+
+
+def test_async_callables_are_rate_limited_like_others():
+    bot, trigger = MockCaller(), MockTrigger()
+    func = async_callable(rate=60)
+    asyncio.run(bot.call_async(func, bot, trigger))
+    asyncio.run(bot.call_async(func, bot, trigger))
+    assert func.calls == [trigger]
+    assert func in bot.times['nick']
+    # NOLIMIT leaves the rate alone, as for a plain callable
+    nolimit = async_callable(module.NOLIMIT, rate=60)
+    asyncio.run(bot.call_async(nolimit, bot, trigger))
+    asyncio.run(bot.call_async(nolimit, bot, trigger))
+    assert len(nolimit.calls) == 2 and nolimit not in bot.times['nick']
+
+
+def test_async_callable_errors_are_reported():
+    bot, trigger = MockCaller(), MockTrigger()
+    asyncio.run(bot.call_async(async_callable(ValueError('x')), bot,
+                               trigger))
+    assert bot.errors == [trigger]
+    # A coroutine function under a plain decorator, with nowhere to run it
+    func = async_callable()
+    bot.call(func, bot, trigger)
+    assert len(bot.coroutines) == 1 and not func.calls
+    assert (inspect.getcoroutinestate(bot.coroutines[0]) ==
+            inspect.CORO_CLOSED)
+
+
+MODULE = '''
+from lpbot import module
+
+
+@module.commands('hello')
+def hello(bot, trigger):
+    return %r
+'''
+
+
+class MockIndex(object):
+    def __init__(self):
+        self.removed = []
+
+    def remove(self, func):
+        self.removed.append(func)
+
+
+class MockConnection(object):
+    connections = LpBot.connections
+    register = LpBot.register
+    unregister = LpBot.unregister
+    is_callable = staticmethod(LpBot.is_callable)
+    is_shutdown = staticmethod(LpBot.is_shutdown)
+
+    def __init__(self, network=None, share_with=None, shard_of=None):
+        self.config = MockConfig()
+        self.config.owner = self.config.core.owner = 'owner'
+        self.memory = {'owner_auth': True}
+        self.replies = []
+        if share_with is None:
+            self.callables, self.shutdown_methods = set(), set()
+            self.networks = {network: self}
+        else:
+            self.callables = share_with.callables
+            self.shutdown_methods = share_with.shutdown_methods
+            self.networks = share_with.networks
+            if shard_of is None:
+                self.networks[network] = self
+        if shard_of is None:
+            self.shards = [self]
+        else:
+            self.shards = shard_of.shards
+            self.shards.append(self)
+        self.bind_commands()
+
+    def bind_commands(self):
+        self.commands = {'medium': {}}
+        for func in self.callables:
+            self.commands['medium'].setdefault(func.commands[0], []).append(
+                func)
+        self.observers = {}
+        self.dispatch_index = MockIndex()
+
+    def reply(self, text):
+        self.replies.append(text)
+
+
+class MockReloadTrigger(object):
+    nick = 'owner'
+    admin = True
+
+    def __init__(self, name):
+        self.name = name
+
+    def group(self, number):
+        return self.name
+
+
+def test_reload_through_a_shard(tmpdir, monkeypatch):
+    from lpbot.modules import reload
+    path = tmpdir.join('greeting.py')
+    path.write(MODULE % 'old')
+    lead = MockConnection('example')
+    other = MockConnection('other', lead)
+    shard = MockConnection('example', lead, shard_of=lead)
+    assert lead.connections() == [lead, shard, other]
+    monkeypatch.delitem(sys.modules, 'greeting', raising=False)
+    module = sys.modules['greeting'] = reload.imp.load_source(
+        'greeting', str(path))
+    lead.register(vars(module))
+    for connection in lead.connections():
+        connection.bind_commands()
+
+    # Unregistering through one connection unbinds it from all of them
+    old = module.hello
+    shard.unregister({'hello': old})
+    for connection in (lead, shard, other):
+        assert connection.commands['medium']['hello'] == []
+        assert connection.dispatch_index.removed == [old]
+    lead.register(vars(module))
+
+    path.write(MODULE % 'new')
+    reload.f_reload(shard, MockReloadTrigger('greeting'))
+    assert shard.replies and old not in lead.callables
+    for connection in (lead, shard, other):
+        funcs = connection.commands['medium']['hello']
+        assert [func(None, None) for func in funcs] == ['new']
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""Tests for lpbot.config"""
+from __future__ import unicode_literals
+
+import pytest
+
+from lpbot.config import Config, ConfigurationError, NetworkConfig
+
+CONFIG = '''[core]
+nick = lpbot
+owner = someone
+host = irc.example.net
+port = 6697
+channels = #lpbot
+networks = example,other
+
+[network:example]
+host = irc.example.org
+nick = lpbot_
+
+[network:other]
+channels = #other
+'''
+
+
+@pytest.fixture
+def config(tmpdir):
+    path = tmpdir.join('default.cfg')
+    path.write(CONFIG)
+    return Config(str(path))
+
+
+def test_network_config_precedence(config):
+    example = NetworkConfig(config, 'example')
+    # The network's section comes first, then core
+    assert example.core.host == 'irc.example.org'
+    assert example.core.nick == 'lpbot_'
+    assert example.core.port == '6697'
+    assert example.core.get_list('channels') == ['#lpbot']
+    # Core options are attributes of the config itself, too
+    assert example.host == 'irc.example.org'
+    assert example.network == 'example'
+    other = NetworkConfig(config, 'other')
+    assert other.core.host == 'irc.example.net'
+    assert other.core.get_list('channels') == ['#other']
+    # Overrides beat both
+    shard = NetworkConfig(config, 'example', nick='lpbot1')
+    assert shard.core.nick == 'lpbot1' and shard.core.host == 'irc.example.org'
+    # Without a network, it's just core
+    assert NetworkConfig(config).core.host == 'irc.example.net'
+
+
+def test_network_config_writes_to_its_section(config):
+    example = NetworkConfig(config, 'example')
+    example.core.nick_blocks = ['spammer']
+    assert config.parser.get('network:example', 'nick_blocks') == 'spammer'
+    assert not config.parser.has_option('core', 'nick_blocks')
+
+
+def test_network_config_needs_a_section(config):
+    with pytest.raises(ConfigurationError):
+        NetworkConfig(config, 'missing')
+
+
+def test_shards_share_their_network_config(config):
+    example = NetworkConfig(config, 'example')
+    shard = NetworkConfig(config, 'example', shard_of=example, nick='lpbot1')
+    assert shard.core.nick == 'lpbot1' and example.core.nick == 'lpbot_'
+    assert shard.nick == 'lpbot1' and shard.core.host == 'irc.example.org'
+    # A change made through either is seen by both
+    shard.core.nick_blocks = ['spammer']
+    assert example.core.get_list('nick_blocks') == ['spammer']
+    example.core.host_blocks = ['bad.host']
+    assert shard.core.get_list('host_blocks') == ['bad.host']
+    assert config.parser.get('network:example', 'nick_blocks') == 'spammer'
+
+
+def test_network_config_has_option(config):
+    config.parser.set('network:example', 'throttle_join', '2')
+    example = NetworkConfig(config, 'example')
+    assert example.has_option('core', 'throttle_join')
+    assert example.has_option('core', 'port')
+    assert not example.has_option('core', 'modes')
+    assert not NetworkConfig(config, 'other').has_option('core',
+                                                         'throttle_join')
+    shard = NetworkConfig(config, 'example', shard_of=example, nick='lpbot1')
+    assert shard.has_option('core', 'throttle_join')
+    assert not shard.has_option('network:example', 'port')
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""Tests for lpbot.coretasks"""
+from __future__ import unicode_literals
+
+import lpbot.bot  # lpbot.module can't be the first of them to be imported
+from lpbot import coretasks
+from lpbot.trigger import PreTrigger
+
+
+class MockCore(object):
+    def __getattr__(self, name):
+        return None
+
+
+class MockConfig(object):
+    core = MockCore()
+
+
+class MockBot(object):
+    def __init__(self):
+        self.config = MockConfig()
+        self.server_capabilities = {}
+        self._cap_ls = {}
+        self._cap_reqs = {}
+        self.enabled_capabilities = set()
+        self.written = []
+
+    def write(self, args, text=None):
+        self.written.append(' '.join(args))
+
+
+class MockTrigger(str):
+    """Just the text and ``args`` of a line, which is all these need."""
+
+    def __new__(cls, line):
+        message = PreTrigger('TestBot', line)
+        self = str.__new__(cls, message.args[-1])
+        self.args = message.args
+        return self
+
+
+def test_cap_ls_302_continuation():
+    bot = MockBot()
+    coretasks.recieve_cap_list(bot, MockTrigger(
+        ':srv CAP TestBot LS * :multi-prefix batch'))
+    # Nothing is requested until the last line of the list
+    assert bot.written == [] and bot.server_capabilities == {}
+    coretasks.recieve_cap_list(bot, MockTrigger(
+        ':srv CAP TestBot LS :draft/multiline=max-bytes=4096,max-lines=10'))
+    assert bot.server_capabilities == {
+        'multi-prefix': None, 'batch': None,
+        'draft/multiline': 'max-bytes=4096,max-lines=10'}
+    assert sorted(bot.written[:-1]) == ['CAP REQ batch',
+                                        'CAP REQ draft/multiline',
+                                        'CAP REQ multi-prefix']
+    assert bot.written[-1] == 'CAP END'
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Tests for lpbot.dispatch"""
+from __future__ import unicode_literals
+
+import re
+
+from lpbot.dispatch import DispatchIndex, LiteralFilter, required_literals
+from lpbot.tools import get_command_regexp
+
+
+def callable_for(*events):
+    def func():
+        pass
+    func.event = list(events)
+    return func
+
+
+def test_dispatch_index_candidates():
+    index = DispatchIndex(r'\.', 'lpbot')
+    everything = re.compile('.*')
+    on_join = callable_for('JOIN')
+    on_privmsg = callable_for('PRIVMSG')
+    weather = get_command_regexp(r'\.', 'weather')
+    index.name_command(weather, 'weather')
+    free = get_command_regexp(r'\.', 'w(?:eather)?')
+    index.name_command(free, 'w(?:eather)?')
+    help_rule = re.compile(r'lpbot[:,]?\s+(help|commands)', re.I)
+    index.name_nickname_commands(help_rule, ('help', 'commands'))
+
+    index.add('high', everything, [on_join, on_privmsg])
+    index.add('medium', weather, [callable_for('PRIVMSG')])
+    index.add('medium', free, [callable_for('PRIVMSG')])
+    index.add('medium', help_rule, [callable_for('PRIVMSG')])
+
+    def regexps(priority, event, text):
+        return [entry[1] for entry in
+                index.candidates(priority, event, index.scan(text))]
+
+    assert index.candidates('high', 'JOIN', index.scan(''))[0][2] == [on_join]
+    assert regexps('medium', 'JOIN', '.weather') == []
+    # Binding order is kept, between indexed and free-form rules alike
+    assert regexps('medium', 'PRIVMSG', '.Weather London') == [weather, free]
+    assert regexps('medium', 'PRIVMSG', '.wea') == [free]
+    assert regexps('medium', 'PRIVMSG', 'LPBot: commands') == [free,
+                                                                help_rule]
+
+
+def test_dispatch_index_optional_prefix():
+    # Where the prefix ends can't be told, so commands aren't indexed
+    index = DispatchIndex(r'\.?', 'lpbot')
+    weather = get_command_regexp(r'\.?', 'weather')
+    index.name_command(weather, 'weather')
+    index.add('medium', weather, [callable_for('PRIVMSG')])
+    assert index.candidates('medium', 'PRIVMSG', index.scan('weather x'))
+    # It's a free-form rule now, but still needs the literal to be there
+    assert not index.candidates('medium', 'PRIVMSG', index.scan('hi'))
+
+
+def test_required_literals():
+    def literals(pattern):
+        return required_literals(re.compile(pattern, re.I))
+    assert literals(r'.*https?://(\w+).wikipedia.org/wiki/(\S+).*') == {
+        'wikipedia'}
+    assert literals(r'.*(youtube.com/watch\S*v=|youtu.be/)([\w-]+).*') == {
+        'youtu'}
+    assert literals(r'(?:foo|barbaz)\d') == {'foo', 'barbaz'}
+    assert literals(r'(?:foo)?x+') is None
+    assert literals('(.*)') is None
+
+
+def test_prefilter_skips_rules():
+    index = DispatchIndex(r'\.', 'lpbot')
+    wiki = re.compile(r'.*https?://(\w+).wikipedia.org/wiki/(\S+).*', re.I)
+    anything = re.compile('(.*)')
+    index.add('medium', wiki, [callable_for('PRIVMSG')])
+    index.add('medium', anything, [callable_for('PRIVMSG')])
+
+    def regexps(text):
+        return [entry[1] for entry in
+                index.candidates('medium', 'PRIVMSG', index.scan(text))]
+
+    assert regexps('hello there') == [anything]
+    assert regexps('see https://en.WIKIPEDIA.org/wiki/IRC') == [wiki,
+                                                                anything]
+    assert (index.regexps_skipped, index.regexps_run) == (1, 1)
+    # Overlapping literals are all found
+    assert LiteralFilter(['youtube', 'tube', 'be/']).search(
+        'youtube/') == {'youtube', 'tube', 'be/'}
+
+
+def test_literal_filter_folds_like_ignorecase():
+    github = re.compile('.*github.*', re.I)
+    literals = required_literals(github)
+    # Dotless i, capital dotted I and the Kelvin sign match ASCII letters
+    # case-insensitively, so the filter mustn't rule them out
+    for text in ['G\u0131THUB', 'G\u0130THUB', 'github', 'GITHUB']:
+        assert github.match(text)
+        assert LiteralFilter(literals).search(text) == literals
+    assert LiteralFilter(['kelvin']).search('\u212aELVIN') == {'kelvin'}
+    assert LiteralFilter(['sss']).search('S\u017fs') == {'sss'}
+    # A non-ASCII literal ends the run, but the rest is still used
+    assert required_literals(re.compile('.*stra\u00dfe.*', re.I)) == {'stra'}
+    assert LiteralFilter(['stra']).search('STRASSE') == {'stra'}
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""Tests for lpbot.hostmask"""
+from __future__ import unicode_literals
+
+from lpbot.config import Config
+from lpbot.hostmask import MaskSet, compile_glob, fold_nick, mask_set
+
+
+def test_mask_set_matches_like_a_scan():
+    masks = ['spammer', 'flood.*', r'.*\.badisp\.net', 'a+b', '(x|y)z',
+             'broken[', ' ']
+    blocks = MaskSet(masks, fold=fold_nick)
+    assert 'SPAMMER' in blocks and 'flooder' in blocks
+    assert 'host.BADISP.net' in blocks and 'aab' in blocks and 'yz' in blocks
+    # A mask is also matched as plain text, even if it isn't a valid regex
+    assert 'a+b' in blocks and 'broken{' in blocks
+    assert 'spammer2' not in blocks and 'badisp.net' not in blocks
+    assert len(blocks) == 5
+    admins = MaskSet(['owner', 'bob@*.example.org'], compile_glob)
+    assert 'Owner' in admins and 'bob@host.example.org' in admins
+    assert 'bob@example.org' not in admins
+
+
+def test_mask_set_follows_config_changes():
+    config = Config('', load=False)
+    config.core.nick_blocks = 'alice,bob'
+    blocks = mask_set(config.core, 'nick_blocks')
+    assert 'bob' in blocks
+    assert mask_set(config.core, 'nick_blocks') is blocks
+    # As .unignore does it
+    config.core.nick_blocks = 'alice'
+    assert 'bob' not in mask_set(config.core, 'nick_blocks')
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""Tests for lpbot.inbound"""
+from __future__ import unicode_literals
+
+import threading
+
+from lpbot.inbound import InboundQueue
+
+
+def test_inbound_queue_stops_reading_while_full():
+    release = threading.Event()
+    handled = []
+    reading = []
+
+    def handle(line):
+        release.wait()
+        handled.append(line)
+
+    inbound = InboundQueue(handle, size=4,
+                           pause=lambda: reading.append(False),
+                           resume=lambda: reading.append(True),
+                           call_soon=lambda callback: callback())
+    for number in range(3):
+        inbound.put(number)
+    while inbound.metrics()['depth'] > 2:
+        threading.Event().wait(0.01)
+    # One line is being handled, so two wait; the queue isn't full yet
+    assert reading == []
+    inbound.put(3)
+    assert reading == []
+    inbound.put(4)
+    assert reading == [False]
+    assert inbound.metrics()['paused']
+    # The rest of what was read is still queued, without stopping again
+    inbound.put(5)
+    assert reading == [False]
+    release.set()
+    while inbound.metrics()['handled'] < 6:
+        threading.Event().wait(0.01)
+    # Reading starts again once, when half the queue has drained
+    assert reading == [False, True]
+    assert handled == list(range(6))
+    metrics = inbound.metrics()
+    assert metrics['depth'] == 0
+    assert metrics['max_depth'] == 5
+    assert metrics['pauses'] == 1
+    assert not metrics['paused']
+    assert metrics['wait_max'] >= metrics['wait_mean'] > 0
+
+
+def test_inbound_queue_clear_waits_for_old_connection():
+    started = threading.Event()
+    release = threading.Event()
+    handled = []
+
+    def handle(line):
+        if line == 'old':
+            started.set()
+            release.wait()
+        handled.append(line)
+
+    inbound = InboundQueue(handle)
+    inbound.put('old')
+    inbound.put('stale')
+    started.wait()
+    clearing = threading.Thread(target=inbound.clear)
+    clearing.start()
+    # The new connection waits for the line in hand, not for the rest
+    clearing.join(0.05)
+    assert clearing.is_alive()
+    release.set()
+    clearing.join()
+    inbound.put('new')
+    while inbound.metrics()['handled'] < 2:
+        threading.Event().wait(0.01)
+    assert handled == ['old', 'new']
+    assert inbound.generation == 1
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""Tests for the connection level parts of lpbot.irc"""
+from __future__ import unicode_literals
+
+import asyncio
+import inspect
+import socket
+import threading
+import time
+from datetime import datetime
+
+from lpbot.irc import Bot, LineFramer
+from lpbot.outbound import split_text
+from lpbot.trigger import PreTrigger
+
+
+class MockCore(object):
+    """A ``[core]`` section, which is also what the bot takes as its
+    config. Options which aren't set are ``None``."""
+
+    def __init__(self, **options):
+        self.nick = 'TestBot'
+        self.user = 'test'
+        self.name = 'Test'
+        self.host = '127.0.0.1'
+        self.timeout = 120
+        self.log_raw = False
+        self.__dict__.update(options)
+        self.core = self
+
+    def __getattr__(self, name):
+        return None
+
+
+class MockBot(Bot):
+    network = None
+    shard = 0
+
+    def __init__(self, **options):
+        self.config = MockCore(**options)
+        Bot.__init__(self, self.config)
+        self.dispatched = []
+
+    def dispatch(self, pretrigger):
+        self.dispatched.append(pretrigger.event)
+
+    def debug(self, tag, text, level):
+        pass
+
+
+def serve_once(script):
+    """Listen on a free port and run ``script(send, expect)`` with the first
+    client to connect, in a thread. Returns the port and the thread."""
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+
+    def run():
+        client, _ = listener.accept()
+        client.settimeout(10)
+        lines = client.makefile('rb')
+
+        def send(line):
+            client.sendall(line.encode('utf-8') + b'\r\n')
+
+        def expect(prefix):
+            while True:
+                line = lines.readline().decode('utf-8').rstrip('\r\n')
+                if not line or line.startswith(prefix):
+                    return line
+
+        try:
+            script(send, expect)
+        finally:
+            client.close()
+            listener.close()
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return listener.getsockname()[1], thread
+
+
+def test_framer_splits_lines():
+    framer = LineFramer()
+    assert framer.feed(b'PING :a\r\nPING :b\r\nPING') == ['PING :a', 'PING :b']
+    assert framer.feed(b' :c\r') == []
+    assert framer.feed(b'\n') == ['PING :c']
+
+
+def test_framer_multibyte_across_chunks():
+    framer = LineFramer()
+    data = ':nick!u@h PRIVMSG #c :žvaka\r\n'.encode('utf-8')
+    split = data.index(b'\xbe')  # second byte of the two byte 'ž'
+    assert framer.feed(data[:split]) == []
+    assert framer.feed(data[split:]) == [':nick!u@h PRIVMSG #c :žvaka']
+
+
+def test_framer_fallback_remembered_per_sender():
+    framer = LineFramer()
+    line = ':legacy!u@h PRIVMSG #c :caf\xe9\r\n'.encode('cp1252')
+    assert framer.feed(line) == [':legacy!u@h PRIVMSG #c :café']
+    assert framer._encodings[b'legacy'] == 'cp1252'
+    # Only undefined in cp1252, so it falls through to iso8859-1
+    assert framer.feed(b':other!u@h PRIVMSG #c :\x81\r\n') == [
+        ':other!u@h PRIVMSG #c :\x81']
+    assert framer._encodings[b'other'] == 'iso8859-1'
+
+
+def test_split_text_words_and_bytes():
+    assert split_text('aa bb cc dd', 5) == ['aa bb', 'cc dd']
+    # Two bytes per character; must not cut one in half
+    assert split_text('žžžžž', 3) == ['ž', 'ž', 'ž', 'ž', 'ž']
+    assert split_text('abcdefgh ij', 4) == ['abcd', 'efgh', 'ij']
+    assert split_text('short', 400) == ['short']
+
+
+def test_split_text_keep_space():
+    pieces = split_text('aa bb cc dd', 5, keep_space=True)
+    assert pieces == ['aa ', 'bb ', 'cc dd']
+    assert ''.join(pieces) == 'aa bb cc dd'
+
+
+def test_bot_runs_connection_on_event_loop():
+    bot = MockBot()
+    bot.hasquit = True
+    seen = {}
+
+    def script(send, expect):
+        seen['user'] = expect('USER')
+        send('PING :abc')
+        seen['pong'] = expect('PONG')
+        send(':srv 001 TestBot :Welcome')
+        send('ERROR :Closing link')
+
+    port, server = serve_once(script)
+    bot.run('127.0.0.1', port)
+    server.join(5)
+    assert seen == {'user': 'USER test +iw TestBot :Test', 'pong': 'PONG abc'}
+    while len(bot.dispatched) < 3:
+        time.sleep(0.01)
+    assert bot.dispatched == ['PING', '001', 'ERROR']
+    # Everything is torn down once run returns
+    assert bot.loop.is_closed() and not bot.connected and not bot._timers
+
+
+def test_timers_are_replaced_not_kept():
+    bot = MockBot(timeout=0)
+    bot.loop = asyncio.new_event_loop()
+    try:
+        bot.connected = True
+        bot.last_ping_time = datetime.now()
+        bot._timers = {
+            'timeout': bot.loop.call_later(0, bot._timeout_check),
+            'ping': bot.loop.call_later(0, bot._send_ping),
+        }
+        # Each check puts off the next one, many times over
+        bot.loop.run_until_complete(asyncio.sleep(0.05))
+        assert sorted(bot._timers) == ['ping', 'timeout']
+        bot._cancel_timers()
+        assert bot._timers == {}
+    finally:
+        bot.loop.close()
+
+
+def test_multiline_needs_max_bytes():
+    bot = MockBot()
+    bot.hostmask = 'TestBot!test@host'
+    bot.enabled_capabilities = set(['draft/multiline'])
+    bot.server_capabilities = {'draft/multiline': 'max-lines=10'}
+    sent = []
+    bot.write = lambda args, text=None: sent.append(text)
+    bot._send_multiline = lambda recipient, pieces: sent.append(pieces)
+    text = 'word ' * 200
+    # Without max-bytes, the message is sent as separate PRIVMSGs
+    assert bot._multiline_limits() is None
+    bot.msg('#c', text, max_messages=5)
+    assert len(sent) == 3 and all(isinstance(piece, str) for piece in sent)
+    del sent[:]
+    bot.server_capabilities = {'draft/multiline': 'max-bytes=4096'}
+    assert bot._multiline_limits() == (4096, None)
+    bot.msg('#c', text + 'more', max_messages=5)
+    assert len(sent) == 1 and ''.join(sent[0]) == text + 'more'
+
+
+class MockTransport(object):
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def is_closing(self):
+        return False
+
+
+def test_send_coalesces_writes():
+    bot = MockBot()
+    bot.loop = asyncio.new_event_loop()
+    try:
+        bot.transport = MockTransport()
+        for line in (b'PRIVMSG #a :1\r\n', b'PRIVMSG #a :2\r\n'):
+            bot.send(line)
+        bot.loop.run_until_complete(asyncio.sleep(0))
+        assert bot.transport.writes == [b'PRIVMSG #a :1\r\nPRIVMSG #a :2\r\n']
+        # Nothing is written while the transport's buffer is full
+        bot.pause_writing()
+        bot.send(b'PRIVMSG #a :3\r\n')
+        bot.loop.run_until_complete(asyncio.sleep(0))
+        assert len(bot.transport.writes) == 1
+        bot.resume_writing()
+        assert bot.transport.writes[-1] == b'PRIVMSG #a :3\r\n'
+    finally:
+        bot.loop.close()
+
+
+def test_connecting_again_starts_afresh():
+    bot = MockBot()
+    bot.loop = asyncio.new_event_loop()
+    try:
+        bot.nick = 'TestBot_'
+        bot.channels = ['#a']
+        bot.hostmask = 'TestBot_!test@host'
+        bot.isupport.update_token('LINELEN=1024')
+        bot.handle_connect(MockTransport())
+        assert bot.connected
+        assert bot.nick == 'TestBot' and bot.channels == []
+        assert bot.hostmask is None and bot.isupport.linelen == 512
+        bot.loop.run_until_complete(asyncio.sleep(0))
+        assert bot.transport.writes[0].startswith(b'NICK TestBot\r\n')
+        bot._cancel_timers()
+    finally:
+        bot.loop.close()
+
+
+def test_batches_are_collected():
+    bot = MockBot()
+
+    def collect(line):
+        message = PreTrigger(bot.nick, line)
+        return bot._collect_batch(message), message
+
+    assert collect('BATCH +split netsplit a.example b.example')[0]
+    assert collect('@batch=split :alice!a@h QUIT :a.example b.example')[0]
+    assert collect('@batch=split :bob!b@h QUIT :a.example b.example')[0]
+    # Other kinds of batch are dispatched line by line, as before
+    assert not collect('BATCH +other example.com/other')[0]
+    assert not collect('@batch=other :carol!c@h PRIVMSG #a :hi')[0]
+    taken, end = collect('BATCH -split')
+    assert not taken
+    assert end.batch.type == 'netsplit'
+    assert end.batch.params == ['a.example', 'b.example']
+    assert [message.nick for message in end.batch.messages] == ['alice', 'bob']
+    assert bot._batches == {}
+
+
+def test_nested_batches_are_collected_whole():
+    bot = MockBot()
+    lines = ['BATCH +outer chathistory #a',
+             '@batch=outer BATCH +inner example.com/inner',
+             '@batch=inner :alice!a@h PRIVMSG #a :in the inner batch',
+             '@batch=outer BATCH -inner',
+             '@batch=outer :bob!b@h PRIVMSG #a :in the outer batch']
+    for line in lines:
+        assert bot._collect_batch(PreTrigger(bot.nick, line))
+    end = PreTrigger(bot.nick, 'BATCH -outer')
+    assert not bot._collect_batch(end)
+    inner_end = end.batch.messages[1]
+    assert inner_end.batch.type == 'example.com/inner'
+    assert inner_end.batch.messages[0].text == 'in the inner batch'
+    assert end.batch.messages[2].nick == 'bob'
+
+
+def test_run_coroutine_needs_a_loop():
+    bot = MockBot()
+
+    async def never():
+        pass
+    coroutine = never()
+    assert not bot.run_coroutine(coroutine)
+    assert inspect.getcoroutinestate(coroutine) == inspect.CORO_CLOSED
+
+
+def test_coroutines_run_as_tasks():
+    bot = MockBot()
+    errors = []
+    bot.error = lambda trigger=None: errors.append(trigger)
+    bot.loop = asyncio.new_event_loop()
+    bot._loop_thread = threading.get_ident()
+    done = []
+
+    async def finish(name):
+        done.append(name)
+
+    async def fail():
+        raise ValueError('fail')
+
+    async def wait():
+        await asyncio.sleep(60)
+        done.append('waited')
+
+    try:
+        assert bot.run_coroutine(finish('loop'))
+        # Other threads hand theirs to the loop
+        thread = threading.Thread(
+            target=lambda: bot.run_coroutine(finish('thread')))
+        thread.start()
+        thread.join()
+        bot.run_coroutine(fail())
+        bot.run_coroutine(wait())
+        bot.loop.run_until_complete(asyncio.sleep(0.01))
+        assert done == ['loop', 'thread']
+        assert errors == [None]
+        # What's still running when the bot stops is cancelled, not left
+        bot._cancel_tasks()
+        assert not bot._tasks and done == ['loop', 'thread']
+        assert errors == [None]
+    finally:
+        bot.loop.close()
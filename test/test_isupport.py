@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""Tests for lpbot.isupport"""
+from __future__ import unicode_literals
+
+from lpbot.isupport import ISupport
+
+LEVELS = {'v': 1, 'h': 2, 'o': 4, 'a': 8, 'q': 16}
+
+
+def test_isupport_defaults_and_tokens():
+    isupport = ISupport(LEVELS)
+    assert isupport.modes == 3
+    assert isupport.linelen == 512
+    assert isupport.targets('JOIN') == 1
+    assert 'o' in isupport.parameter_modes['-']
+    for token in ('PREFIX=(qaohv)~&@%+', 'CHANMODES=beI,k,l,imnpst',
+                  'MODES=4', 'TARGMAX=JOIN:,PRIVMSG:4', 'LINELEN=1024',
+                  'CHANLIMIT=#:120', 'NICKLEN=30', 'NETWORK=Example\\x20Net'):
+        isupport.update_token(token)
+    assert isupport.prefix[0] == ('q', '~')
+    assert isupport.symbol_privileges['%'] < isupport.symbol_privileges['@']
+    assert 'l' in isupport.parameter_modes['+']
+    assert 'l' not in isupport.parameter_modes['-']
+    assert isupport.modes == 4
+    assert isupport.targets('join') is None
+    assert isupport.targets('PRIVMSG') == 4
+    assert isupport.linelen == 1024
+    assert isupport.chanlimit == {'#': 120}
+    assert isupport.nicklen == 30
+    assert isupport['NETWORK'] == 'Example Net'
+    isupport.update_token('MODES')
+    assert isupport.modes is None
+    isupport.update_token('-MODES')
+    assert isupport.modes == 3 and 'MODES' not in isupport
+
+
+def test_isupport_ignores_malformed_numbers():
+    isupport = ISupport(LEVELS)
+    for token in ('MODES=x', 'MAXTARGETS=lots', 'LINELEN=abc', 'NICKLEN=',
+                  'CHANLIMIT=#:²', 'CASEMAPPING=ascii'):
+        isupport.update_token(token)
+    assert isupport.modes == 3
+    assert isupport.targets('PRIVMSG') == 1
+    assert isupport.linelen == 512
+    assert isupport.nicklen is None
+    assert isupport.chanlimit == {'#': None}
+    # Tokens after the malformed ones are still applied
+    assert isupport.casemapping == 'ascii'
+    assert isupport['LINELEN'] == 'abc'
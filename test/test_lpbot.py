@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""Tests for the reconnecting in lpbot's package itself"""
+from __future__ import unicode_literals
+
+import lpbot
+
+
+def test_reconnect_delay_doubles_within_bounds():
+    for attempt in range(40):
+        delay = min(600, 20 * 2 ** attempt)
+        waits = [lpbot._reconnect_delay(attempt, 20, 600)
+                 for _ in range(50)]
+        assert all(delay / 2 <= wait <= delay for wait in waits)
+        # Jittered, so that bots don't all come back at once
+        assert len(set(waits)) > 1
+
+
+class MockCore(object):
+    host = 'irc.example.net'
+    port = '6667'
+    delay = '10'
+    reconnect_max = '80'
+
+
+class MockConfig(object):
+    core = MockCore()
+    exit_on_error = False
+
+
+class MockBot(object):
+    config = MockConfig()
+
+    def __init__(self, runs):
+        self.runs = runs
+        self.hasquit = False
+
+    def run(self, host, port):
+        self.runs -= 1
+        if not self.runs:
+            self.hasquit = True
+
+
+def test_run_network_reconnects_with_backoff(monkeypatch):
+    waits = []
+    monkeypatch.setattr(lpbot.time, 'sleep', waits.append)
+    bot = MockBot(runs=6)
+    lpbot._run_network(bot)
+    assert bot.runs == 0
+    assert len(waits) == 5
+    for attempt, wait in enumerate(waits):
+        delay = min(80, 10 * 2 ** attempt)
+        assert delay / 2 <= wait <= delay
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Tests for lpbot.membership"""
+from __future__ import unicode_literals
+
+import pytest
+
+from lpbot.membership import Memberships, PrivilegeLevelView
+from lpbot import tools
+from lpbot.tools import Identifier
+
+# Privilege levels, as in lpbot.module (which can't be imported on its own)
+VOICE, OP = 1, 4
+
+
+def test_quit_only_touches_shared_channels():
+    store = Memberships()
+    store.add(Identifier('#a'), Identifier('Alice'), 4)
+    store.add(Identifier('#b'), Identifier('alice'))
+    store.add(Identifier('#b'), Identifier('bob'))
+    assert store.channels_of(Identifier('ALICE')) == set(['#a', '#b'])
+    assert store.quit(Identifier('alice')) == set(['#a', '#b'])
+    assert store.privileges == {'#a': {}, '#b': {'bob': 0}}
+    assert store.channels_of(Identifier('alice')) == set()
+
+
+def test_rename_keeps_privileges():
+    store = Memberships()
+    store.add(Identifier('#a'), Identifier('alice'), 4)
+    assert store.rename(Identifier('alice'), Identifier('carol')) == set(['#a'])
+    assert store.privileges[Identifier('#a')] == {'carol': 4}
+    assert store.channels_of(Identifier('carol')) == set(['#a'])
+
+
+def test_remove_channel_forgets_members():
+    store = Memberships()
+    store.add(Identifier('#a'), Identifier('alice'))
+    store.add(Identifier('#b'), Identifier('alice'))
+    store.remove_channel(Identifier('#a'))
+    store.remove(Identifier('#b'), Identifier('alice'))
+    assert store.channels_of(Identifier('alice')) == set()
+    assert store.privileges == {'#b': {}}
+
+
+def test_ids_are_reused():
+    store = Memberships()
+    store.add(Identifier('#a'), Identifier('alice'))
+    store.quit(Identifier('alice'))
+    store.add(Identifier('#a'), Identifier('bob'))
+    assert store._users.ids == {'bob': 0}
+    assert list(store.privileges[Identifier('#a')]) == ['bob']
+
+
+def test_untracked_channels_only_track_own_nick():
+    nicks = [Identifier('lpbot')]
+    store = Memberships(own_nick=lambda: nicks[-1], untracked=['#Big'])
+    store.add(Identifier('#big'), Identifier('alice'))
+    store.add(Identifier('#big'), Identifier('LPBOT'), OP)
+    assert dict(store.privileges[Identifier('#big')]) == {'lpbot': OP}
+    # After a nick change, it's the new nick which is tracked
+    nicks.append(Identifier('lpbot_'))
+    store.add(Identifier('#big'), Identifier('lpbot_'), VOICE)
+    store.add(Identifier('#big'), Identifier('lpbot'))
+    assert dict(store.privileges[Identifier('#big')]) == {'lpbot': OP,
+                                                           'lpbot_': VOICE}
+
+
+def test_privilege_level_view():
+    store = Memberships()
+    store.add(Identifier('#a'), Identifier('alice'), OP)
+    store.add(Identifier('#a'), Identifier('bob'), VOICE)
+    store.add(Identifier('#a'), Identifier('carol'))
+    ops = PrivilegeLevelView(store, OP)
+    voices = PrivilegeLevelView(store, VOICE)
+    assert ops[Identifier('#a')] == set(['alice'])
+    assert voices[Identifier('#a')] == set(['alice', 'bob'])
+    with pytest.raises(TypeError):
+        store.privileges[Identifier('#a')]['carol'] = OP
+
+
+def test_refold_after_casemapping_switch():
+    store = Memberships(untracked=['#Big^'])
+    store.add(Identifier('#a^'), Identifier('Alice^'), OP)
+    try:
+        assert tools.set_casemapping('ascii')
+        store.refold()
+        assert store.get(Identifier('#A^'), Identifier('alice^')) == OP
+        assert store.get(Identifier('#a~'), Identifier('alice~')) is None
+        assert store.channels_of(Identifier('ALICE^')) == {'#a^'}
+        store.add(Identifier('#big^'), Identifier('bob'))
+        assert Identifier('#big^') not in store.privileges
+    finally:
+        tools._network_casemappings.clear()
+        tools.set_casemapping('rfc1459')
+        tools._network_casemappings.clear()
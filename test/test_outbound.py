@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""Tests for lpbot.outbound"""
+from __future__ import unicode_literals
+
+import asyncio
+
+from lpbot.outbound import OutboundScheduler, TokenBucket
+
+
+def test_token_bucket_delay():
+    bucket = TokenBucket(burst=2.0, refill=1.0)
+    bucket.consume('x' * 512, now=bucket._last)
+    bucket.consume('x' * 512, now=bucket._last)
+    start = bucket._last
+    # Two long lines cost two seconds each, two more than the burst allows
+    assert bucket.delay(now=start) == 2.0
+    assert bucket.delay(now=start + 1.5) == 0.5
+    assert bucket.delay(now=start + 2.0) == 0.0
+
+
+def test_scheduler_takes_turns_between_targets():
+    sent = []
+    scheduler = OutboundScheduler(sent.append, burst=10.0, refill=1.0)
+    loop = asyncio.new_event_loop()
+    try:
+        scheduler.attach(loop)
+        for line in ['a1', 'a2', 'a3']:
+            scheduler.put(line, target='#a')
+        scheduler.put('b1', target='#b')
+        scheduler.put('PONG x', priority=True)
+        loop.run_until_complete(asyncio.sleep(0.01))
+        assert sent == ['PONG x', 'a1', 'b1', 'a2', 'a3']
+        # Past the burst, lines wait for the bucket rather than going out
+        for number in range(4, 20):
+            scheduler.put('a%d' % number, target='#a')
+        loop.run_until_complete(asyncio.sleep(0.01))
+        assert len(sent) < 15 and scheduler.pending('#a') > 0
+    finally:
+        loop.close()
+
+
+def test_scheduler_keeps_extended_lines_together():
+    sent = []
+    scheduler = OutboundScheduler(sent.append, burst=10.0, refill=1.0)
+    loop = asyncio.new_event_loop()
+    try:
+        scheduler.attach(loop)
+        scheduler.put('a1', target='#a')
+        scheduler.extend(['BATCH +x', 'a2', 'a3', 'BATCH -x'], target='#a')
+        scheduler.put('b1', target='#b')
+        scheduler.put('b2', target='#b')
+        assert scheduler.pending('#a') == 5
+        loop.run_until_complete(asyncio.sleep(0.01))
+        assert sent == ['a1', 'b1', 'BATCH +x', 'a2', 'a3', 'BATCH -x', 'b2']
+    finally:
+        loop.close()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""Tests for lpbot.rawlog"""
+from __future__ import unicode_literals
+
+import gzip
+import os
+
+from lpbot.rawlog import RawLogWriter
+
+
+def test_raw_log_rotates_by_size(tmpdir):
+    path = str(tmpdir.join('raw.log'))
+    writer = RawLogWriter(path, max_size=10, compress=True)
+    writer.start()
+    writer.write('first line\n')
+    writer.stop()
+    writer = RawLogWriter(path, max_size=10, compress=True)
+    writer.start()
+    writer.write('second line\n')
+    writer.stop()
+    rotated = [name for name in os.listdir(str(tmpdir)) if name != 'raw.log']
+    assert len(rotated) == 1 and rotated[0].endswith('.gz')
+    with gzip.open(str(tmpdir.join(rotated[0])), 'rt') as old:
+        assert old.read() == 'first line\n'
+    assert tmpdir.join('raw.log').read() == 'second line\n'
+
+
+def test_raw_log_survives_failed_rotation(tmpdir, monkeypatch):
+    path = str(tmpdir.join('raw.log'))
+    writer = RawLogWriter(path, max_size=10)
+    writer.retry_delay = 0
+    writer._reopen()
+    writer._write(['0123456789\n'])
+
+    def fail(source, target):
+        raise OSError('rename failed')
+    monkeypatch.setattr(os, 'rename', fail)
+    # Rotating fails, so the line goes on the end of the same file
+    writer._write(['kept\n'])
+    assert tmpdir.join('raw.log').read() == '0123456789\nkept\n'
+    assert writer.dropped == 0
+    monkeypatch.undo()
+    writer._write(['new\n'])
+    writer._file.close()
+    assert tmpdir.join('raw.log').read() == 'new\n'
+    assert len(tmpdir.listdir()) == 2
+
+
+def test_raw_log_drops_lines_when_full(tmpdir):
+    writer = RawLogWriter(str(tmpdir.join('raw.log')), queue_size=2)
+    for number in range(5):
+        writer.write('%d\n' % number)
+    assert writer.dropped == 3
+    writer.start()
+    writer.stop()
+    assert tmpdir.join('raw.log').read() == '0\n1\n'
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Tests for lpbot.tls"""
+from __future__ import unicode_literals
+
+import shutil
+import ssl
+import subprocess
+
+import pytest
+
+from lpbot.tls import TLSConnection
+
+
+@pytest.fixture(scope='module')
+def server_context(tmpdir_factory):
+    if shutil.which('openssl') is None:
+        pytest.skip('openssl is needed to make a certificate')
+    directory = tmpdir_factory.mktemp('tls')
+    cert, key = str(directory.join('cert.pem')), str(directory.join('key.pem'))
+    subprocess.check_call(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+         '-keyout', key, '-out', cert, '-days', '1', '-subj', '/CN=localhost'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+def client_context():
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class MemoryServer(object):
+    """The server's end of a TLS connection, over memory BIOs."""
+
+    def __init__(self, context):
+        self.incoming = ssl.MemoryBIO()
+        self.outgoing = ssl.MemoryBIO()
+        self.sslobj = context.wrap_bio(self.incoming, self.outgoing,
+                                       server_side=True)
+
+    def feed(self, data):
+        """Take ``data`` from the client; return what to send back and the
+        plaintext it held."""
+        self.incoming.write(data)
+        plaintext = b''
+        try:
+            self.sslobj.do_handshake()
+            while True:
+                plaintext += self.sslobj.read(65536)
+        except (ssl.SSLWantReadError, ssl.SSLZeroReturnError):
+            pass
+        return self.outgoing.read(), plaintext
+
+    def send(self, data):
+        self.sslobj.write(data)
+        return self.outgoing.read()
+
+
+def connect(client, server):
+    """Run the handshake between ``client`` and ``server``."""
+    data = client.start()
+    while data:
+        reply, _ = server.feed(data)
+        client.feed(reply)
+        data = client.outgoing()
+
+
+def test_session_is_resumed(server_context):
+    context = client_context()
+    first = TLSConnection(context, 'localhost')
+    connect(first, MemoryServer(server_context))
+    assert first.established and not first.session_reused
+    server = MemoryServer(server_context)
+    second = TLSConnection(context, 'localhost', first.session)
+    connect(second, server)
+    assert second.established and second.session_reused
+
+
+def test_unwritten_data_is_kept(server_context):
+    client = TLSConnection(client_context(), 'localhost')
+    server = MemoryServer(server_context)
+    connect(client, server)
+
+    class Busy(object):
+        """An SSLObject which is waiting for the server, as during a
+        renegotiation."""
+
+        def __init__(self, sslobj):
+            self.sslobj = sslobj
+
+        def write(self, data):
+            raise ssl.SSLWantReadError()
+
+        def __getattr__(self, name):
+            return getattr(self.sslobj, name)
+
+    real = client.sslobj
+    client.sslobj = Busy(real)
+    assert client.encrypt(b'PRIVMSG #a :first\r\n') == b''
+    assert client.encrypt(b'PRIVMSG #a :second\r\n') == b''
+    client.sslobj = real
+    # Once the server is heard from, what was held back goes out, in order
+    plaintext, _ = client.feed(server.send(b'PING :x\r\n'))
+    assert plaintext == b'PING :x\r\n'
+    _, received = server.feed(client.outgoing())
+    assert received == b'PRIVMSG #a :first\r\nPRIVMSG #a :second\r\n'
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""Tests for lpbot.tools"""
+from __future__ import unicode_literals
+
+import pytest
+
+from lpbot import tools
+from lpbot.tools import Identifier, set_casemapping
+
+
+@pytest.fixture
+def casemapping():
+    yield
+    tools._network_casemappings.clear()
+    set_casemapping('rfc1459')
+    tools._network_casemappings.clear()
+
+
+def test_identifier_casemapping(casemapping):
+    assert Identifier('Nick[a]') == 'nick{A}'
+    assert Identifier('nick^') == 'NICK~'
+    assert set_casemapping('strict-rfc1459')
+    assert Identifier('nick^') != 'nick~'
+    assert Identifier('Nick|') == 'nick\\'
+    assert set_casemapping('ascii')
+    assert Identifier('Nick[a]') != 'nick{a}'
+    assert not set_casemapping('unknown')
+    # Non-ASCII letters are still folded, as database keys always have been
+    assert Identifier('ŽNick').lower() == 'žnick'
+    assert Identifier('ŽNick') == 'žnick'
+
+
+def test_networks_must_agree_on_casemapping(casemapping):
+    assert set_casemapping('ascii', 'example')
+    assert set_casemapping('ascii', 'other')
+    assert not set_casemapping('rfc1459', 'other')
+    assert Identifier('Nick^') != 'nick~'
+    # A network may change its own, while it's the only one with any
+    tools._network_casemappings.pop('other')
+    assert set_casemapping('rfc1459', 'example')
+    assert Identifier('Nick^') == 'nick~'
+
+
+def test_refold_after_casemapping_switch(casemapping):
+    times = {Identifier('Nick^'): 1, Identifier('Other'): 2, 'plain': 3}
+    stale = Identifier('Nick^')
+    assert set_casemapping('ascii')
+    # Identifiers made before the switch still fold the old way
+    assert Identifier('nick^') not in times
+    assert stale.lower() == 'nick~'
+    tools.refold(times)
+    assert times[Identifier('nick^')] == 1
+    assert times[Identifier('OTHER')] == 2 and times['plain'] == 3
+    assert Identifier('nick~') not in times
+
+
+def test_identifier_interned():
+    nick = Identifier('SomeNick')
+    assert Identifier('SomeNick') is nick
+    assert Identifier(nick) is nick
+    assert Identifier('somenick') is not nick
+    assert hash(Identifier('somenick')) == hash(nick)
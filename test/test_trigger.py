@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""Tests for lpbot.trigger"""
+from __future__ import unicode_literals
+
+import re
+
+from lpbot.trigger import PreTrigger, Trigger, TriggerLine
+
+
+def test_pretrigger_parses_lazily():
+    line = ('@time=12:00;msgid=a\\sb\\:c\\\\d;flag;odd=e\\ :Nick!~user@host '
+            'PRIVMSG lpbot :\x01ACTION waves\x01')
+    message = PreTrigger('LPBot', line)
+    assert message.event == 'PRIVMSG'
+    assert message.args == ['lpbot', 'waves']
+    assert message._tags is None and message._nick is None
+    assert message.tags == {'time': '12:00', 'msgid': 'a b;c\\d',
+                            'flag': None, 'odd': 'e', 'intent': 'ACTION'}
+    assert (message.nick, message.user, message.host) == (
+        'nick', '~user', 'host')
+    # Sent to lpbot directly, so the sender is whoever sent it
+    assert message.sender == 'Nick'
+
+
+def test_pretrigger_without_source():
+    message = PreTrigger('lpbot', 'PING :irc.example.net')
+    assert message.hostmask is None
+    assert message.args == ['irc.example.net']
+    assert message.nick == '' and message.tags == {}
+
+
+class MockCore(object):
+    def __init__(self, admins):
+        self.admins = admins
+        self.lookups = 0
+
+    def get_list(self, name):
+        self.lookups += 1
+        return getattr(self, name).split(',')
+
+
+class MockConfig(object):
+    def __init__(self, admins):
+        self.core = MockCore(admins)
+
+
+def test_triggers_share_their_line():
+    config = MockConfig('Someone,Nick')
+    message = PreTrigger('lpbot', ':Nick!~user@host PRIVMSG #lpbot :.t x')
+    line = TriggerLine(config, message)
+    first = Trigger(config, message, re.match(r'\.(\w+)', '.t x'), line=line)
+    second = Trigger(config, message, re.match(r'(.*)', '.t x'), line=line)
+    assert first == second == '.t x'
+    assert (first.group(1), second.group(1)) == ('t', '.t x')
+    assert first.sender == '#lpbot' and not first.is_privmsg
+    assert first.admin and second.admin
+    assert config.core.lookups == 1
+    # Made on its own, a Trigger still works everything out for itself
+    alone = Trigger(config, message, first.match)
+    assert alone.nick == 'Nick' and alone.admin
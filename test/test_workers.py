@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Tests for lpbot.workers"""
+from __future__ import unicode_literals
+
+import threading
+
+from lpbot.workers import WorkerPool
+
+
+def callable_in(module_name):
+    def func():
+        pass
+    func.__module__ = module_name
+    return func
+
+
+def test_worker_pool_limits():
+    pool = WorkerPool(workers=4, module_workers=2, queue_size=2)
+    release = threading.Event()
+    lock = threading.Lock()
+    running = []
+    peak = {}
+
+    def work(name):
+        with lock:
+            running.append(name)
+            peak[name] = max(peak.get(name, 0), running.count(name))
+        release.wait()
+        with lock:
+            running.remove(name)
+
+    def wait_for(count):
+        while len(running) < count:
+            threading.Event().wait(0.01)
+
+    slow, other = callable_in('slow'), callable_in('other')
+    other.concurrency = 1
+    assert pool.submit(slow, work, ('slow',))
+    assert pool.submit(slow, work, ('slow',))
+    wait_for(2)
+    assert pool.submit(slow, work, ('slow',))
+    assert pool.submit(other, work, ('other',))
+    wait_for(3)
+    assert pool.submit(other, work, ('other',))
+    # Two slow calls and an other are running, the rest wait
+    assert pool.metrics()['depth'] == 2
+    assert not pool.submit(slow, work, ('slow',))
+    assert pool.dropped == 1
+    # Only forced calls get past a full queue
+    assert pool.submit(slow, work, ('slow',), force=True)
+    release.set()
+    while pool.metrics()['completed'] < 6:
+        threading.Event().wait(0.01)
+    assert peak == {'slow': 2, 'other': 1}
+    assert pool.metrics()['threads'] <= 4
+    assert pool.metrics()['depth'] == 0
+
+
+def test_worker_pool_coalesces():
+    pool = WorkerPool(workers=1, queue_size=2, overflow='coalesce')
+    release = threading.Event()
+    calls = []
+    first, second = callable_in('a'), callable_in('b')
+    pool.submit(first, release.wait)
+    while pool.metrics()['depth']:
+        threading.Event().wait(0.01)
+    pool.submit(first, calls.append, (1,))
+    pool.submit(second, calls.append, (2,))
+    # The queue is full: the newer call replaces the waiting one, where it is
+    assert pool.submit(first, calls.append, (3,))
+    assert not pool.submit(first, calls.append, (4,), coalesce=True)
+    # With another key, it can't run ahead of that key's earlier calls
+    assert pool.submit(second, calls.append, (5,), key='#a')
+    release.set()
+    while pool.metrics()['completed'] < 3:
+        threading.Event().wait(0.01)
+    assert calls == [3, 5]
+    assert pool.coalesced == 3
+
+
+def test_worker_pool_orders_by_key():
+    pool = WorkerPool(workers=4)
+    gate = threading.Event()
+    done = []
+
+    def work(key, number):
+        if key == '#a' and number == 0:
+            gate.wait()
+        done.append((key, number))
+
+    func = callable_in('m')
+    for number in range(3):
+        pool.submit(func, work, ('#a', number), key='#a')
+    pool.submit(func, work, ('#b', 0), key='#b')
+    # #b doesn't wait for #a
+    while ('#b', 0) not in done:
+        threading.Event().wait(0.01)
+    assert not [item for item in done if item[0] == '#a']
+    gate.set()
+    while pool.metrics()['completed'] < 4:
+        threading.Event().wait(0.01)
+    assert [item for item in done if item[0] == '#a'] == [
+        ('#a', 0), ('#a', 1), ('#a', 2)]